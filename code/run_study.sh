@@ -0,0 +1,12 @@
+#!/bin/bash
+#SBATCH --ntasks=1
+#SBATCH --job-name=run_study
+#SBATCH --cpus-per-task=64
+#SBATCH --mem=128G
+#SBATCH --time=72:00:00
+#SBATCH --partition=general
+#SBATCH --output=run_study.out
+
+cd /work/users/y/u/yuukias/BIOS-Material/BIOS992/src/data_script
+
+python -u ./step4_run_study.py
@@ -12,6 +12,10 @@ setup(
         "pandas",
         "numpy",
         "dask",
+        "pyarrow",  # Parquet mirror of the main CSV
+        
+        # Train/test split
+        "scikit-learn",
         
         # ECG processing
         "neurokit2",
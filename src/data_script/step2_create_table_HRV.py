@@ -6,6 +6,7 @@ from utils.sql_utils import generate_table_from_result_csv
 from utils.constants import TableNames, ColumnNames
 
 if __name__ == "__main__":
+    # * extract_HRV.py writes these tables directly, this script only loads HRV CSV files exported before
     # generate_table_from_result_csv(TableNames.HRV_TIME, "../step2_process_ECG/hrv_time_indices.csv")
     # generate_table_from_result_csv(TableNames.HRV_FREQ, "../step2_process_ECG/hrv_frequency_indices.csv")
 
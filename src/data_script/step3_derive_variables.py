@@ -0,0 +1,16 @@
+import sys
+
+sys.path.append("../..")
+
+from utils.sql_utils import generate_long_table
+from utils.derived_variables import derive_variables, derive_event, derive_medication
+from utils.constants import TableNames
+
+if __name__ == "__main__":
+    # Needs the Confounders, ECG, ICD and HRV_time tables from step1 and step2
+    derive_variables()
+
+    generate_long_table(TableNames.ICD_LONG, code_field=41270, date_field=41280)
+    generate_long_table(TableNames.MEDICATION_LONG, code_field=20003, code_type="INTEGER")
+    derive_event()
+    derive_medication()
@@ -0,0 +1,14 @@
+import sys
+
+sys.path.append("../..")
+
+from utils.batch_runner import study_jobs, run_jobs
+
+if __name__ == "__main__":
+    # Needs the tables of step1 to step3 and the imputed values (split_utils.store_imputed_values).
+    # Runs the models, their evaluation, variable importance and risk groups in one allocation,
+    # jobs whose inputs did not change since their last run are skipped.
+    jobs = study_jobs(impute_type=None, include_statin=None, n_cpus=16, mem_gb=32, eval_mem_gb=64)
+    status = run_jobs(jobs)
+    if any(s == "failed" for s in status.values()):
+        sys.exit(1)
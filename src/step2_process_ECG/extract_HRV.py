@@ -6,31 +6,52 @@ from functools import partial
 
 sys.path.append("../../")
 
-from utils.constants import DatabaseConfig
-from utils.ecg_processor import ECG_Processor
-from utils.sql_utils import query_eids
-
+from utils.constants import DatabaseConfig, TableNames, ColumnNames
+from utils.ecg_processor import ECG_Processor, ecg_file_path
+from utils.hrv_cache import HRVCache, processing_params
+from utils.sql_utils import query_eids, generate_table_from_batches
+
+
+def process_single_subject(eid, data_dir, stage="noload", lead="consensus", cache=None):
+    """
+    Process a single subject's ECG data.
+
+    Results, including failures caused by the data, are read from and written to the
+    cache if one is given, so only new subjects or changed inputs are processed.
+    """
+    if cache is not None:
+        cache_key = cache.key(
+            ecg_file_path(data_dir, eid), stage, lead, params=processing_params()
+        )
+        cached_result = cache.get(cache_key)
+        if cached_result is not None:
+            return {**cached_result, "cached": True}
 
-def process_single_subject(eid, data_dir):
-    """Process a single subject's ECG data"""
     try:
         ecg_processor = ECG_Processor(data_dir=data_dir, subject=str(eid))
-        hrv_time, hrv_freq, hrv_nonlinear = ecg_processor.process_signal("noload")
+        hrv_time, hrv_freq, hrv_nonlinear = ecg_processor.process_signal(stage, lead)
 
         # Add eid to each DataFrame
         hrv_time["eid"] = eid
         hrv_freq["eid"] = eid
         hrv_nonlinear["eid"] = eid
 
-        return {
+        result = {
             "success": True,
             "eid": eid,
             "time": hrv_time,
             "freq": hrv_freq,
             "nonlinear": hrv_nonlinear,
         }
-    except Exception as e:
+    except (OSError, MemoryError) as e:
+        # Not caused by the data, so not cached
         return {"success": False, "eid": eid, "error": str(e)}
+    except Exception as e:
+        result = {"success": False, "eid": eid, "error": str(e)}
+
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
 
 
 if __name__ == "__main__":
@@ -45,9 +66,14 @@ if __name__ == "__main__":
         n_cores = max(1, cpu_count() - 1)  # Leave one core free
         print(f"Using {n_cores} cores for parallel processing")
 
-        # Create partial function with fixed data_dir
+        # Create partial function with fixed data_dir, stage, lead and cache
+        cache = HRVCache()
         process_func = partial(
-            process_single_subject, data_dir=DatabaseConfig.ECG_FOLDER
+            process_single_subject,
+            data_dir=DatabaseConfig.ECG_FOLDER,
+            stage="noload",
+            lead="consensus",
+            cache=cache,
         )
 
         time_indices = []
@@ -55,6 +81,7 @@ if __name__ == "__main__":
         nonlinear_indices = []
         cnt_processed = 0
         cnt_success = 0
+        cnt_cached = 0
 
         with Pool(n_cores) as pool:
             pbar = tqdm(
@@ -64,6 +91,7 @@ if __name__ == "__main__":
             )
             for result in pbar:
                 cnt_processed += 1
+                cnt_cached += result.get("cached", False)
                 if result["success"]:
                     time_indices.append(result["time"])
                     freq_indices.append(result["freq"])
@@ -74,6 +102,7 @@ if __name__ == "__main__":
                         {
                             "success": f"{cnt_success}/{cnt_processed}",
                             "rate": f"{(cnt_success / cnt_processed * 100):.1f}%",
+                            "cached": cnt_cached,
                         }
                     )
                 else:
@@ -81,6 +110,9 @@ if __name__ == "__main__":
                         f"Error processing ECG data for eid {result['eid']}: {result['error']}"
                     )
 
+        print(f"{cnt_cached}/{cnt_total} subjects were read from the HRV cache")
+        cache.evict()
+
         if cnt_success == 0:
             raise ValueError("No ECG data was successfully processed")
 
@@ -99,11 +131,20 @@ if __name__ == "__main__":
             f"\nHRV indices extracted for {cnt_success}/{cnt_total} subjects -> {(cnt_success / cnt_total * 100):.2f}%"
         )
 
-        time_df.to_csv("hrv_time_indices.csv", index=False)
-        freq_df.to_csv("hrv_frequency_indices.csv", index=False)
-        nonlinear_df.to_csv("hrv_nonlinear_indices.csv", index=False)
+        # Split nonlinear indices into 3 tables, as the column names can lead to confusion
+        hrv_tables = [
+            (TableNames.HRV_TIME, time_df, None),
+            (TableNames.HRV_FREQ, freq_df, None),
+            (TableNames.HRV_POINCARE, nonlinear_df, ColumnNames.POINCARE_COLUMNS_NAME),
+            (TableNames.HRV_ENTROPY, nonlinear_df, ColumnNames.ENTROPY_COLUMNS_NAME),
+            (TableNames.HRV_FRACTAL, nonlinear_df, ColumnNames.FRACTAL_COLUMNS_NAME),
+        ]
+        for table_name, df, column_names in hrv_tables:
+            generate_table_from_batches(
+                table_name, df, column_names=column_names, drop_NA=True, precision=6
+            )
 
-        print("Extracted HRV indices are saved to CSV files")
+        print("Extracted HRV indices are saved to the database")
 
     except Exception as e:
         print(f"Error when extracting HRV indices: {str(e)}")
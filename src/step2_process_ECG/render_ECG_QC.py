@@ -0,0 +1,18 @@
+import sys
+
+sys.path.append("../../")
+
+from utils.constants import DatabaseConfig
+from utils.ecg_processor import render_qc_images
+from utils.sql_utils import query_eids
+
+if __name__ == "__main__":
+    eids = query_eids()
+    if not eids:
+        raise ValueError("No eids found in database")
+
+    # One PNG per subject with the whole recording of lead 2, one minute per row
+    results = render_qc_images(
+        eids, output_dir="ecg_qc", data_dir=DatabaseConfig.ECG_FOLDER, stage=None, lead="2"
+    )
+    results.to_csv("ecg_qc/render_results.csv", index=False)
@@ -0,0 +1,146 @@
+import argparse
+import pandas as pd
+from tqdm import tqdm
+import sys
+from multiprocessing import Pool, cpu_count
+from functools import partial
+
+sys.path.append("../../")
+
+from utils.constants import DatabaseConfig
+from utils.ecg_processor import ECG_Processor, ecg_file_path, sweep_configs, config_tag
+from utils.hrv_cache import HRVCache, processing_params
+from utils.sql_utils import query_eids
+
+
+def sweep_single_subject(eid, data_dir, configs, cache=None):
+    """
+    Process a single subject's ECG data under several configurations.
+
+    The ECG is loaded and decoded once, and only for the configurations that are not
+    in the cache. Returns one result per configuration, in the order of configs.
+    """
+    results = [None] * len(configs)
+    cache_keys = [None] * len(configs)
+    if cache is not None:
+        for i, config in enumerate(configs):
+            cache_keys[i] = cache.key(
+                ecg_file_path(data_dir, eid),
+                config["stage"],
+                config["lead"],
+                params=processing_params(config["clean_method"], config["peak_method"]),
+            )
+            cached_result = cache.get(cache_keys[i])
+            if cached_result is not None:
+                results[i] = {**cached_result, "cached": True}
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    try:
+        ecg_processor = ECG_Processor(data_dir=data_dir, subject=str(eid))
+        sweep_results = ecg_processor.process_sweep([configs[i] for i in missing])
+    except (OSError, MemoryError) as e:
+        # Not caused by the data, so not cached
+        for i in missing:
+            results[i] = {"success": False, "eid": eid, "error": str(e)}
+        return results
+    except Exception as e:
+        sweep_results = [{"success": False, "error": str(e)} for _ in missing]
+
+    for i, sweep_result in zip(missing, sweep_results):
+        result = {"success": sweep_result["success"], "eid": eid}
+        if sweep_result["success"]:
+            for domain in ["time", "freq", "nonlinear"]:
+                sweep_result[domain]["eid"] = eid
+                result[domain] = sweep_result[domain]
+        else:
+            result["error"] = sweep_result["error"]
+        if cache is not None:
+            cache.put(cache_keys[i], result)
+        results[i] = result
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Extract HRV indices under a grid of processing configurations"
+    )
+    parser.add_argument("--stages", nargs="+", default=["noload"])
+    parser.add_argument("--leads", nargs="+", default=["2"])
+    parser.add_argument("--clean-methods", nargs="+", default=["neurokit"])
+    parser.add_argument("--peak-methods", nargs="+", default=["neurokit"])
+    parser.add_argument("--n-subjects", type=int, default=None, help="Only the first N eids")
+    parser.add_argument("--n-cores", type=int, default=max(1, cpu_count() - 1))
+    parser.add_argument("--output-prefix", default="hrv_sweep")
+    parser.add_argument("--no-cache", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        eids = query_eids()
+        if not eids:
+            raise ValueError("No eids found in database")
+        if args.n_subjects is not None:
+            eids = eids[: args.n_subjects]
+
+        configs = sweep_configs(
+            args.stages, args.leads, args.clean_methods, args.peak_methods
+        )
+        tags = [config_tag(config) for config in configs]
+        print(f"Sweeping {len(configs)} configurations over {len(eids)} subjects")
+        print(f"Using {args.n_cores} cores for parallel processing")
+
+        cache = None if args.no_cache else HRVCache()
+        process_func = partial(
+            sweep_single_subject,
+            data_dir=DatabaseConfig.ECG_FOLDER,
+            configs=configs,
+            cache=cache,
+        )
+
+        indices = {"time": [], "freq": [], "nonlinear": []}
+        cnt_success = {tag: 0 for tag in tags}
+        cnt_cached = 0
+
+        with Pool(args.n_cores) as pool:
+            pbar = tqdm(
+                pool.imap_unordered(process_func, eids),
+                total=len(eids),
+                desc="Sweeping HRV configurations",
+            )
+            for results in pbar:
+                for config, tag, result in zip(configs, tags, results):
+                    cnt_cached += result.get("cached", False)
+                    if not result["success"]:
+                        continue
+                    cnt_success[tag] += 1
+                    for domain in indices:
+                        # Tag every row with its configuration
+                        indices[domain].append(
+                            result[domain].assign(config=tag, **config)
+                        )
+
+        print(f"{cnt_cached}/{len(eids) * len(configs)} results were read from the HRV cache")
+        for tag in tags:
+            print(f"{tag}: HRV indices extracted for {cnt_success[tag]}/{len(eids)} subjects")
+        if cache is not None:
+            cache.evict()
+
+        if not any(cnt_success.values()):
+            raise ValueError("No ECG data was successfully processed")
+
+        config_columns = ["eid", "config", "stage", "lead", "clean_method", "peak_method"]
+        for domain, file_suffix in [("time", "time"), ("freq", "frequency"), ("nonlinear", "nonlinear")]:
+            df = pd.concat(indices[domain], ignore_index=True)
+            df = df[config_columns + [col for col in df.columns if col not in config_columns]]
+            df.to_csv(f"{args.output_prefix}_{file_suffix}_indices.csv", index=False)
+
+        print("Extracted HRV indices are saved to CSV files")
+
+    except Exception as e:
+        print(f"Error when sweeping HRV configurations: {str(e)}")
+        sys.exit(1)
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.csv_utils import (
+    build_row_index,
+    convert_csv_to_parquet,
+    create_descriptive_stats,
+    get_column_names,
+    load_row_index,
+    read_mirror,
+    read_rows_by_eids,
+)
+
+
+def _participants(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "event": rng.integers(0, 2, n),
+            "smoking": rng.choice([0, 1, 2], n),
+            "age": rng.normal(55, 8, n),
+            "sex": rng.choice(["M", "F"], n),
+        }
+    )
+
+
+def _write_main_csv(file_path, n=60, seed=0):
+    """Tiny main CSV in the UK Biobank <field>-<instance>.<array> layout, with eids out of order."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "eid": rng.permutation(np.arange(1000, 1000 + n)),
+            "31-0.0": rng.integers(0, 2, n),
+            "21001-0.0": rng.normal(27, 4, n).round(4),
+            "20116-0.0": np.where(rng.random(n) < 0.3, np.nan, rng.integers(0, 3, n)),
+            "53-0.0": pd.date_range("2008-01-01", periods=n).strftime("%Y-%m-%d"),
+            "4080-0.0": np.nan,
+            "4080-0.1": np.where(rng.random(n) < 0.5, np.nan, rng.integers(90, 180, n)),
+            "6032-0.0": rng.choice(["a", "b"], n),
+        }
+    )
+    df.to_csv(file_path, index=False)
+    return df
+
+
+def _as_in_describe_participant(df):
+    """Dtypes set up as in src/paper_writing/describe_participant.ipynb."""
+    df = df.copy()
+    df["smoking"] = df["smoking"].astype("category").cat.set_categories([0, 1, 2, -3])
+    df["event"] = df["event"].astype("category")
+    return df
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_descriptive_stats_with_unused_categories(n_workers):
+    df = _as_in_describe_participant(_participants())
+    df["sex"] = df["sex"].astype("category").cat.set_categories(["M", "F", "U"])
+
+    descriptive_stats = create_descriptive_stats(df, "event", n_workers=n_workers)
+
+    for col in ["smoking", "sex"]:
+        assert 0 <= descriptive_stats[col]["p_value"] <= 1
+    # unused categories are still listed, with a count of 0
+    assert descriptive_stats["smoking"]["stats"].loc[(0, -3)] == "0 (0.00%)"
+    assert descriptive_stats["sex"]["stats"].loc[(1, "U")] == "0 (0.00%)"
+
+
+def test_descriptive_stats_chi_square_ignores_unused_categories():
+    df = _participants()
+    df["smoking"] = df["smoking"].astype("category")
+    with_unused = _as_in_describe_participant(df)
+
+    p_value = create_descriptive_stats(df, "event")["smoking"]["p_value"]
+    assert create_descriptive_stats(with_unused, "event")["smoking"]["p_value"] == pytest.approx(p_value)
+
+
+@pytest.mark.parametrize("max_chunk_cells", [2_000_000, 9])
+def test_parquet_mirror_matches_csv(tmp_path, max_chunk_cells):
+    file_path = str(tmp_path / "ukb.csv")
+    _write_main_csv(file_path)
+    expected = pd.read_csv(file_path)
+
+    # a small max_chunk_cells reads the file in several passes of a few rows
+    convert_csv_to_parquet(file_path, chunk_size=25, columns_per_file=2, max_chunk_cells=max_chunk_cells)
+    mirror = pd.concat(read_mirror(get_column_names(file_path), file_path, chunk_size=7), ignore_index=True)
+
+    pd.testing.assert_frame_equal(mirror.astype(object), expected.astype(object), check_dtype=False)
+
+
+def test_row_index_points_to_each_row(tmp_path):
+    file_path = str(tmp_path / "ukb.csv")
+    df = _write_main_csv(file_path)
+
+    eids, offsets = build_row_index(file_path)
+
+    np.testing.assert_array_equal(eids, df["eid"])
+    with open(file_path, "rb") as f:
+        for eid, offset in zip(eids, offsets):
+            f.seek(offset)
+            assert f.readline().startswith(f"{eid},".encode())
+
+
+def test_row_index_is_rebuilt_when_the_csv_changes(tmp_path):
+    file_path = str(tmp_path / "ukb.csv")
+    _write_main_csv(file_path, n=60)
+    build_row_index(file_path)
+
+    df = _write_main_csv(file_path, n=30, seed=1)
+
+    eids, _ = load_row_index(file_path)
+    np.testing.assert_array_equal(eids, df["eid"])
+
+
+@pytest.mark.parametrize("chunk_size", [5000, 7])
+def test_read_rows_by_eids(tmp_path, chunk_size):
+    file_path = str(tmp_path / "ukb.csv")
+    df = _write_main_csv(file_path)
+    build_row_index(file_path)
+    # out of order, with duplicates and eids that are not in the CSV
+    eids = [*df["eid"].sample(25, random_state=0), int(df["eid"].iloc[3]), 1, 999_999]
+    columns = ["21001-0.0", "4080-0.1", "6032-0.0"]
+
+    chunks = list(read_rows_by_eids(columns, eids, file_path, chunk_size=chunk_size))
+
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    result = pd.concat(chunks, ignore_index=True)
+    expected = pd.read_csv(file_path, dtype=str)
+    # rows come in file order, once per eid
+    expected = expected[expected["eid"].astype(int).isin(eids)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected[["eid", *columns]])
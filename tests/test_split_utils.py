@@ -0,0 +1,163 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pytest
+
+from utils.constants import TableNames
+from utils.cohort_utils import materialize_cohort
+from utils.sql_utils import EXPORT_TABLES, db_connection, export_joined_data
+from utils.split_utils import create_split, export_split_data, list_splits, read_split_data
+
+N_SUBJECTS = 40
+
+
+@pytest.fixture
+def analysis_db(tmp_path):
+    """Database with the PROCESSED table and every table of EXPORT_TABLES for N_SUBJECTS subjects."""
+    rng = np.random.default_rng(0)
+    eids = list(range(1, N_SUBJECTS + 1))
+    status = pd.DataFrame(
+        {
+            "eid": eids,
+            "event": rng.integers(0, 2, N_SUBJECTS),
+            "time": rng.integers(100, 5000, N_SUBJECTS),
+            "statins": rng.integers(0, 2, N_SUBJECTS),
+            "ecg_hrv_ok": (rng.random(N_SUBJECTS) < 0.9).astype(int),
+            "ecg_before_cvd": 0,
+        }
+    )
+    # smoking is only known for the first subjects, so the last chunks of an export are all NULL
+    smoking = [
+        int(value) if eid <= N_SUBJECTS // 2 else None for eid, value in zip(eids, rng.integers(0, 3, N_SUBJECTS))
+    ]
+    recruitment_dates = pd.date_range("2008-01-01", periods=N_SUBJECTS, freq="7D").strftime("%Y-%m-%d")
+
+    db_file_path = str(tmp_path / "test.db")
+    with db_connection(db_file_path) as conn:
+        conn.execute(f"CREATE TABLE {TableNames.PROCESSED} (eid INTEGER PRIMARY KEY);")
+        conn.executemany(f"INSERT INTO {TableNames.PROCESSED} VALUES (?);", [(eid,) for eid in eids])
+        conn.execute(
+            f"CREATE TABLE {TableNames.STATUS} (eid INTEGER PRIMARY KEY, event INTEGER, time INTEGER, "
+            "statins INTEGER, ecg_hrv_ok INTEGER, ecg_before_cvd INTEGER);"
+        )
+        conn.executemany(
+            f"INSERT INTO {TableNames.STATUS} VALUES (?, ?, ?, ?, ?, ?);",
+            [tuple(int(value) for value in row) for row in status.itertuples(index=False)],
+        )
+        conn.execute(
+            f"CREATE TABLE {TableNames.COVARIATES} (eid INTEGER PRIMARY KEY, age REAL, smoking INTEGER, "
+            "recruitment_date DATE, sex TEXT);"
+        )
+        sexes = rng.choice(["Female", "Male"], N_SUBJECTS).tolist()
+        conn.executemany(
+            f"INSERT INTO {TableNames.COVARIATES} VALUES (?, ?, ?, ?, ?);",
+            list(zip(eids, rng.normal(55, 8, N_SUBJECTS).tolist(), smoking, recruitment_dates, sexes)),
+        )
+        hrv_tables = [table_name for table_name in EXPORT_TABLES if table_name.startswith("HRV")]
+        for table_name in hrv_tables:
+            conn.execute(f"CREATE TABLE {table_name} (eid INTEGER PRIMARY KEY, `{table_name}_value` REAL);")
+            conn.executemany(
+                f"INSERT INTO {table_name} VALUES (?, ?);", [(eid, float(rng.random())) for eid in eids]
+            )
+    eligible = status.query("statins == 0 and ecg_hrv_ok == 1 and ecg_before_cvd == 0")["eid"].tolist()
+    return db_file_path, eligible
+
+
+def test_split_of_materialized_cohort(analysis_db):
+    db_file_path, eligible = analysis_db
+
+    df_split = create_split("main", db_file_path=db_file_path)
+
+    conn = sqlite3.connect(db_file_path)
+    cohort_eids = [row[0] for row in conn.execute("SELECT eid FROM Cohort_eligible ORDER BY eid;")]
+    conn.close()
+    assert cohort_eids == eligible
+    assert sorted(df_split["eid"]) == eligible
+    assert list_splits(db_file_path).loc[0, "cohort"] == "eligible"
+
+    train = read_split_data("main", "train", db_file_path=db_file_path)
+    test = read_split_data("main", "test", db_file_path=db_file_path)
+    assert sorted(train["eid"].tolist() + test["eid"].tolist()) == eligible
+
+
+def test_split_of_another_cohort(analysis_db):
+    db_file_path, _ = analysis_db
+
+    df_split = create_split("statin", cohort="eligible_with_statins", db_file_path=db_file_path)
+
+    conn = sqlite3.connect(db_file_path)
+    cohort_eids = [row[0] for row in conn.execute("SELECT eid FROM Cohort_eligible_with_statins ORDER BY eid;")]
+    conn.close()
+    assert sorted(df_split["eid"]) == cohort_eids
+    with pytest.raises(ValueError, match="Unknown cohort"):
+        create_split("unknown", cohort="unknown", db_file_path=db_file_path)
+
+
+def _fold_data(db_file_path, fold):
+    """Exported columns of a fold, joined with pandas as in export_split_data.ipynb."""
+    eids = read_split_data("main", fold, db_file_path=db_file_path)["eid"]
+    conn = sqlite3.connect(db_file_path)
+    df = pd.read_sql(f"SELECT eid, event, time FROM {TableNames.STATUS};", conn)
+    for table_name in [table_name for table_name in EXPORT_TABLES if table_name != TableNames.STATUS]:
+        df = df.merge(pd.read_sql(f"SELECT * FROM {table_name};", conn), on="eid")
+    conn.close()
+    return df[df["eid"].isin(eids)].sort_values("eid").reset_index(drop=True)
+
+
+def test_export_split_data_to_csv(analysis_db, tmp_path):
+    db_file_path, _ = analysis_db
+    create_split("main", db_file_path=db_file_path)
+    output_path = str(tmp_path / "train.csv")
+
+    # small chunks, so that smoking is NULL in some rows of a chunk and in every row of the last ones
+    n_rows = export_split_data(output_path, "main", "train", db_file_path=db_file_path, chunk_size=3)
+
+    expected = _fold_data(db_file_path, "train")
+    assert n_rows == len(expected)
+    with open(output_path) as f:
+        header = f.readline().rstrip("\n").split(",")
+        smoking = [line.rstrip("\n").split(",")[header.index("smoking")] for line in f]
+    # integer categories are never written as 1.0
+    assert smoking == [str(value) if pd.notna(value) else "" for value in expected["smoking"].astype("Int64")]
+    df = pd.read_csv(output_path, index_col=0)
+    assert list(df.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("compression", [None, "uncompressed"])
+def test_export_joined_data_typed(analysis_db, tmp_path, compression):
+    db_file_path, eligible = analysis_db
+    cohort_table = materialize_cohort("eligible", db_file_path=db_file_path)
+    output_path = str(tmp_path / "eligible.csv")
+
+    n_rows = export_joined_data(
+        output_path,
+        cohort_table,
+        db_file_path=db_file_path,
+        chunk_size=3,
+        output_formats=["csv", "parquet", "feather"],
+        compression=compression,
+    )
+
+    assert n_rows == len(eligible)
+    parquet_table = pq.read_table(str(tmp_path / "eligible.parquet"))
+    feather_table = feather.read_table(str(tmp_path / "eligible.feather"))
+    assert parquet_table.schema.equals(feather_table.schema)
+    types = dict(zip(parquet_table.schema.names, parquet_table.schema.types))
+    assert types["eid"] == pa.int64()
+    assert types["time"] == pa.int64()
+    assert types["smoking"] == pa.int64()
+    assert types["age"] == pa.float64()
+    assert types["recruitment_date"] == pa.date32()
+    assert types["sex"] == pa.string()
+    assert parquet_table.equals(feather_table)
+    assert parquet_table["eid"].to_pylist() == eligible
+
+    df_csv = pd.read_csv(output_path, parse_dates=["recruitment_date"])
+    df_parquet = parquet_table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+    df_parquet["recruitment_date"] = pd.to_datetime(df_parquet["recruitment_date"])
+    pd.testing.assert_frame_equal(df_csv, df_parquet, check_dtype=False)
@@ -0,0 +1,225 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.constants import TableNames
+from utils.csv_utils import build_row_index, generate_column_defs
+from utils.sql_utils import (
+    db_connection,
+    drop_columns_from_table,
+    generate_table_from_main_csv,
+    read_array_field,
+    read_subject_arrays,
+    update_table_from_csv,
+)
+
+N_SUBJECTS = 20
+N_PROCESSED = 15
+ARRAY_LENGTH = 6
+
+
+@pytest.fixture
+def main_csv(tmp_path):
+    """Main CSV with a numeric (5983) and a text (5987) array field, its catalog and row index, and a database."""
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(0, ARRAY_LENGTH + 1, N_SUBJECTS)
+    heart_rates = rng.integers(60, 180, (N_SUBJECTS, ARRAY_LENGTH)).astype(float)
+    heart_rates[np.arange(ARRAY_LENGTH)[None, :] >= lengths[:, None]] = np.nan
+    heart_rates[lengths >= 3, 1] = np.nan  # gap inside the array
+    phases = np.where(
+        np.arange(ARRAY_LENGTH)[None, :] < lengths[:, None],
+        rng.choice(["Pretest", "Exercise", "Rest"], (N_SUBJECTS, ARRAY_LENGTH)),
+        None,
+    )
+
+    df = pd.DataFrame({"eid": np.arange(1, N_SUBJECTS + 1), "6032-0.0": rng.integers(50, 200, N_SUBJECTS)})
+    # only subjects missing from the PROCESSED table have a value
+    df["4080-0.0"] = np.where(df["eid"] > N_PROCESSED, rng.integers(90, 180, N_SUBJECTS), np.nan)
+    for j in range(ARRAY_LENGTH):
+        df[f"5983-0.{j}"] = pd.array(heart_rates[:, j], dtype="Int64")
+        df[f"5987-0.{j}"] = phases[:, j]
+        df[f"5984-0.{j}"] = np.nan  # no subject has a value
+    csv_file_path = str(tmp_path / "ukb.csv")
+    df.to_csv(csv_file_path, index=False)
+    build_row_index(csv_file_path)
+    generate_column_defs(csv_file_path, n_workers=1)
+
+    db_file_path = str(tmp_path / "test.db")
+    with db_connection(db_file_path) as conn:
+        conn.execute(f"CREATE TABLE {TableNames.PROCESSED} (eid INTEGER PRIMARY KEY);")
+        conn.executemany(
+            f"INSERT INTO {TableNames.PROCESSED} VALUES (?);", [(eid,) for eid in range(1, N_PROCESSED + 1)]
+        )
+    return csv_file_path, db_file_path, heart_rates, phases
+
+
+def test_main_csv_table_without_empty_columns(main_csv, capsys):
+    csv_file_path, db_file_path, _, _ = main_csv
+
+    generate_table_from_main_csv("Fitness", [6032, 4080, 5984], csv_file_path, db_file_path, chunk_size=4)
+
+    conn = sqlite3.connect(db_file_path)
+    # 5984 has no value at all, 4080 has none for the eids of the PROCESSED table
+    assert [row[1] for row in conn.execute("PRAGMA table_info(Fitness);")] == ["eid", "6032-0.0"]
+    assert conn.execute("SELECT COUNT(*) FROM Fitness;").fetchone()[0] == N_PROCESSED
+    assert conn.execute("PRAGMA foreign_key_list(Fitness);").fetchone()[2] == TableNames.PROCESSED
+    conn.close()
+    # the columns are settled before the table is created, it is not rebuilt
+    assert "have been removed" not in capsys.readouterr().out
+
+
+def _trimmed(values):
+    """Values up to the last present one, as rebuilt by the array readers."""
+    present = np.nonzero(pd.notna(values))[0]
+    return values[: present[-1] + 1] if len(present) else values[:0]
+
+
+@pytest.mark.parametrize("array_storage", ["long", "blob"])
+def test_array_fields_round_trip(main_csv, array_storage):
+    csv_file_path, db_file_path, heart_rates, phases = main_csv
+
+    generate_table_from_main_csv(
+        "Fitness",
+        [6032, 5983, 5987],
+        csv_file_path,
+        db_file_path,
+        chunk_size=4,
+        array_fields=[5983, 5987],
+        array_storage=array_storage,
+    )
+
+    conn = sqlite3.connect(db_file_path)
+    wide_columns = [row[1] for row in conn.execute("PRAGMA table_info(Fitness);")]
+    assert wide_columns == ["eid", "6032-0.0"]
+    cursor = conn.cursor()
+    for eid in range(1, N_PROCESSED + 1):
+        heart_rate = read_array_field(eid, 5983, array_table_name="Fitness_array", cursor=cursor)
+        assert heart_rate.dtype == np.float64
+        np.testing.assert_array_equal(heart_rate, _trimmed(heart_rates[eid - 1]))
+
+        arrays = read_subject_arrays(eid, "Fitness_array", cursor=cursor)
+        assert list(arrays.get((5987, 0), [])) == list(_trimmed(phases[eid - 1]))
+    # subjects missing from the PROCESSED table are not stored
+    assert read_subject_arrays(N_SUBJECTS, "Fitness_array", cursor=cursor) == {}
+    conn.close()
+
+
+@pytest.mark.parametrize("array_storage", ["long", "blob"])
+def test_array_fields_without_values(main_csv, array_storage):
+    csv_file_path, db_file_path, _, _ = main_csv
+
+    generate_table_from_main_csv(
+        "Fitness", [6032, 5984], csv_file_path, db_file_path, array_fields=[5984], array_storage=array_storage
+    )
+
+    conn = sqlite3.connect(db_file_path)
+    assert conn.execute("SELECT COUNT(*) FROM Fitness;").fetchone()[0] == N_PROCESSED
+    assert conn.execute("SELECT COUNT(*) FROM Fitness_array;").fetchone()[0] == 0
+    conn.close()
+
+
+@pytest.mark.parametrize("sqlite_version_info", [sqlite3.sqlite_version_info, (3, 32, 0)])
+def test_update_table_from_csv(main_csv, monkeypatch, sqlite_version_info):
+    csv_file_path, db_file_path, heart_rates, _ = main_csv
+    generate_table_from_main_csv("Fitness", [6032], csv_file_path, db_file_path)
+    # the rows of the table are referenced, deleting them while refilling must not break the foreign key
+    with db_connection(db_file_path) as conn:
+        conn.execute("CREATE TABLE Child (eid INTEGER PRIMARY KEY, FOREIGN KEY (eid) REFERENCES Fitness(eid));")
+        conn.executemany("INSERT INTO Child VALUES (?);", [(eid,) for eid in range(1, N_PROCESSED + 1)])
+    # older SQLite refills the table instead of using UPDATE ... FROM
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", sqlite_version_info)
+
+    update_table_from_csv("Fitness", [5983, 4080], csv_file_path, db_file_path, chunk_size=4)
+
+    conn = sqlite3.connect(db_file_path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(Fitness);")]
+    assert columns == ["eid", "6032-0.0", *[f"5983-0.{j}" for j in range(ARRAY_LENGTH)]]
+    df = pd.read_sql("SELECT * FROM Fitness ORDER BY eid;", conn)
+    np.testing.assert_array_equal(df["5983-0.0"].to_numpy(dtype=float), heart_rates[:N_PROCESSED, 0])
+    assert conn.execute("SELECT COUNT(*) FROM Child;").fetchone()[0] == N_PROCESSED
+    assert conn.execute("PRAGMA foreign_key_check;").fetchall() == []
+    assert conn.execute("PRAGMA foreign_key_list(Fitness);").fetchone()[2] == TableNames.PROCESSED
+    conn.close()
+
+
+@pytest.fixture
+def constrained_db(tmp_path):
+    """Database with a table carrying every kind of constraint and indexes, referenced by another table."""
+    db_file_path = str(tmp_path / "test.db")
+    with db_connection(db_file_path) as conn:
+        conn.execute(f"CREATE TABLE {TableNames.PROCESSED} (eid INTEGER PRIMARY KEY);")
+        conn.executemany(f"INSERT INTO {TableNames.PROCESSED} VALUES (?);", [(eid,) for eid in range(1, 11)])
+        conn.execute(f"""
+            CREATE TABLE Fitness (
+                eid INTEGER PRIMARY KEY,
+                code TEXT NOT NULL UNIQUE,
+                `6032-0.0` REAL DEFAULT 1.5,
+                `4080-0.0` INTEGER,
+                `5987-0.0` TEXT,
+                FOREIGN KEY (eid) REFERENCES {TableNames.PROCESSED}(eid)
+            );
+        """)
+        conn.executemany(
+            "INSERT INTO Fitness VALUES (?, ?, ?, ?, ?);",
+            [(eid, f"c{eid}", eid / 2, eid * 10, "Rest") for eid in range(1, 11)],
+        )
+        conn.execute("CREATE INDEX idx_Fitness_6032 ON Fitness (`6032-0.0`);")
+        conn.execute("CREATE INDEX idx_Fitness_4080 ON Fitness (`4080-0.0`);")
+        conn.execute("CREATE INDEX idx_Fitness_4080_5987 ON Fitness (`4080-0.0`, `5987-0.0`);")
+        conn.execute("CREATE TABLE Child (eid INTEGER PRIMARY KEY, FOREIGN KEY (eid) REFERENCES Fitness(eid));")
+        conn.executemany("INSERT INTO Child VALUES (?);", [(eid,) for eid in range(1, 11)])
+    return db_file_path
+
+
+@pytest.mark.parametrize(
+    "column_names, method, kept_indexes",
+    [
+        (["5987-0.0"], "ALTER TABLE DROP COLUMN", ["idx_Fitness_4080", "idx_Fitness_6032"]),
+        (["4080-0.0", "5987-0.0"], "rebuilding the table", ["idx_Fitness_6032"]),
+    ],
+)
+def test_drop_columns_from_table(constrained_db, capsys, column_names, method, kept_indexes):
+    drop_columns_from_table("Fitness", column_names, constrained_db)
+
+    assert f"by {method}" in capsys.readouterr().out
+    conn = sqlite3.connect(constrained_db)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    table_info = conn.execute("PRAGMA table_info(Fitness);").fetchall()
+    kept_columns = [col for col in ["eid", "code", "6032-0.0", "4080-0.0", "5987-0.0"] if col not in column_names]
+    assert [row[1] for row in table_info] == kept_columns
+    # PRIMARY KEY, NOT NULL and DEFAULT
+    assert [row[1] for row in table_info if row[5] > 0] == ["eid"]
+    assert table_info[1][3] == 1
+    assert table_info[2][4] == "1.5"
+    # UNIQUE, through its automatic index
+    assert any(row[2] == 1 and row[3] == "u" for row in conn.execute("PRAGMA index_list(Fitness);"))
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO Fitness (eid, code) VALUES (1, 'c2');")
+    indexes = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'Fitness' AND sql IS NOT NULL "
+        "ORDER BY name;"
+    ).fetchall()
+    assert [row[0] for row in indexes] == kept_indexes
+    # the foreign key to PROCESSED still holds, and the referencing table is untouched
+    assert conn.execute("PRAGMA foreign_key_list(Fitness);").fetchone()[2:5] == (TableNames.PROCESSED, "eid", "eid")
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO Fitness (eid, code) VALUES (11, 'c11');")
+    assert conn.execute("PRAGMA foreign_key_check;").fetchall() == []
+    assert conn.execute("SELECT COUNT(*) FROM Child;").fetchone()[0] == 10
+    df = pd.read_sql("SELECT * FROM Fitness ORDER BY eid;", conn)
+    assert df["6032-0.0"].tolist() == [eid / 2 for eid in range(1, 11)]
+    conn.close()
+
+
+def test_drop_columns_from_table_errors(constrained_db):
+    with pytest.raises(ValueError, match="primary key"):
+        drop_columns_from_table("Fitness", ["eid"], constrained_db)
+    with pytest.raises(ValueError, match="not found"):
+        drop_columns_from_table("Fitness", ["6032-0.0", "unknown"], constrained_db)
+
+    # nothing is changed when a check fails
+    conn = sqlite3.connect(constrained_db)
+    assert len(conn.execute("PRAGMA table_info(Fitness);").fetchall()) == 5
+    conn.close()
@@ -0,0 +1,558 @@
+"""
+Batch runner for the survival models and their evaluation.
+
+The study used to be run as one SLURM job per Quarto document (code/cox_*.sh, rsf_*.sh, xgb_*.sh,
+eval_*.sh, var_imp_*.sh, sensitivity_*.sh, predict_risk.sh), each requesting its own cores and
+reloading the same datasets. This module runs all of them inside a single allocation:
+- The analysis datasets are exported from the database once, as the CSV files the documents read
+  and as uncompressed Feather files that can be memory-mapped. Jobs running at the same time read
+  the same files, so the data is held once in the page cache of the node
+- The documents form a job graph (models -> evaluation, variable importance and risk groups),
+  and ready jobs are started as long as their cores and memory fit in the budget of the allocation
+- A job is skipped when its command, its input files and the outputs of the jobs it depends on
+  did not change since its last successful run, so the intermediate .RData files and reports are
+  reused. Exported datasets are only replaced when their content changed, so a write to an
+  unrelated table of the database does not rerun the models
+
+Note:
+    Cache keys use the size and modification time of the input files, as the row index of the
+    main CSV file in csv_utils, so that large inputs do not have to be hashed.
+
+Dependencies:
+    - subprocess: For rendering the Quarto documents
+    - concurrent.futures: For running jobs in parallel
+"""
+
+import datetime
+import filecmp
+import functools
+import hashlib
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .constants import DatabaseConfig, TableNames
+from .split_utils import create_split, export_split_data, list_splits, FOLDS
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(PROJECT_DIR, "src")
+DATA_DIR = os.path.dirname(DatabaseConfig.DB_PATH)
+CACHE_MANIFEST_PATH = os.path.join(DATA_DIR, "batch_runs.json")
+LOG_DIR = os.path.join(DATA_DIR, "batch_logs")
+
+# * Split name and cohort of the datasets read by the documents (include_statin = "no" / "yes")
+STUDY_SPLITS = {
+    "main": ("eligible", ""),
+    "statin": ("eligible_with_statins", "_statin"),
+}
+# * Imputed table of each impute_type
+STUDY_IMPUTATIONS = {
+    "unimputed": None,
+    "imputed": TableNames.IMPUTED_MISSFOREST,
+}
+ADJUST_TYPES = ["full", "partial", "minimal"]
+# * Folder and file prefix of every survival model in step4_build_survival_model
+MODELS = {
+    "cox": ("Cox", "Cox"),
+    "rsf": ("RSF", "RSF"),
+    "xgb": ("XGBoost", "XGBoost"),
+}
+
+
+class Job:
+    """
+    A node of the job graph.
+
+    Attributes:
+        name (str): Unique name of the job
+        command (list[str] | callable): Command line run in a subprocess, or a function without
+            arguments run in the driver process
+        cwd (str): Working directory of the command
+        inputs (list[str]): Files read by the job, e.g. the document and the datasets
+        outputs (list[str]): Files written by the job. The job is run again if one of them is missing
+        depends_on (list[str]): Names of the jobs that must succeed before this one
+        n_cpus (int): Number of cores used by the job
+        mem_gb (float): Peak memory of the job in GB, 0 if it is not budgeted
+    """
+
+    def __init__(self, name, command, cwd=None, inputs=None, outputs=None, depends_on=None, n_cpus=1, mem_gb=0):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.depends_on = depends_on or []
+        self.n_cpus = n_cpus
+        self.mem_gb = mem_gb
+
+    def __repr__(self):
+        return f"Job({self.name!r}, n_cpus={self.n_cpus}, mem_gb={self.mem_gb}, depends_on={self.depends_on})"
+
+
+def _file_fingerprint(file_path):
+    """Size and modification time of a file, or None if it does not exist."""
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def _command_signature(command):
+    """Stable description of a command, used in the cache key."""
+    if isinstance(command, functools.partial):
+        return [
+            _command_signature(command.func),
+            [repr(arg) for arg in command.args],
+            {key: repr(value) for key, value in sorted(command.keywords.items())},
+        ]
+    if callable(command):
+        return f"{command.__module__}.{command.__qualname__}"
+    return list(command)
+
+
+def job_cache_key(job, jobs_by_name):
+    """
+    Cache key of a job.
+
+    Args:
+        job (Job): Job
+        jobs_by_name (dict): Mapping from job name to job, containing the jobs in job.depends_on
+
+    Returns:
+        str: SHA-256 hex digest of the command, the working directory, and the fingerprints of the
+            inputs and of the outputs of the upstream jobs
+    """
+    payload = {
+        "command": _command_signature(job.command),
+        "cwd": job.cwd,
+        "inputs": {path: _file_fingerprint(path) for path in job.inputs},
+        "upstream": {
+            name: {path: _file_fingerprint(path) for path in jobs_by_name[name].outputs} for name in job.depends_on
+        },
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _check_job_graph(jobs):
+    """
+    Check that job names are unique, dependencies exist and the graph has no cycle.
+
+    Args:
+        jobs (list[Job]): Jobs
+
+    Raises:
+        ValueError: If the graph is invalid
+    """
+    job_names = [job.name for job in jobs]
+    duplicated_names = sorted({name for name in job_names if job_names.count(name) > 1})
+    if duplicated_names:
+        raise ValueError(f"Duplicated job names: {duplicated_names}")
+
+    jobs_by_name = {job.name: job for job in jobs}
+    for job in jobs:
+        unknown_dependencies = [name for name in job.depends_on if name not in jobs_by_name]
+        if unknown_dependencies:
+            raise ValueError(f"Job {job.name} depends on unknown jobs: {unknown_dependencies}")
+
+    # Kahn's algorithm, the jobs left over are on a cycle
+    n_pending = {job.name: len(job.depends_on) for job in jobs}
+    ready = [name for name, n in n_pending.items() if n == 0]
+    n_visited = 0
+    while ready:
+        name = ready.pop()
+        n_visited += 1
+        for job in jobs:
+            if name in job.depends_on:
+                n_pending[job.name] -= 1
+                if n_pending[job.name] == 0:
+                    ready.append(job.name)
+    if n_visited < len(jobs):
+        raise ValueError(f"Job graph has a cycle: {sorted(name for name, n in n_pending.items() if n > 0)}")
+
+
+def _load_manifest(cache_path):
+    """Read the cache manifest, mapping from job name to its last successful run."""
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, cache_path):
+    """Write the cache manifest atomically, so an interrupted run does not corrupt it."""
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    temp_path = f"{cache_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, cache_path)
+
+
+def _run_job(job, n_cpus, log_dir):
+    """
+    Run one job.
+
+    Args:
+        job (Job): Job
+        n_cpus (int): Number of cores granted to the job
+        log_dir (str): Folder of the log files, one <name>.log per job
+
+    Returns:
+        float: Elapsed time in seconds
+
+    Notes:
+        - OMP_NUM_THREADS, RF_CORES (randomForestSRC) and MC_CORES (parallel) are set to the granted
+          cores, so concurrent jobs do not oversubscribe the allocation
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails
+    """
+    start_time = time.time()
+    if callable(job.command):
+        job.command()
+        return time.time() - start_time
+
+    env = dict(os.environ)
+    env.update({var: str(n_cpus) for var in ["OMP_NUM_THREADS", "RF_CORES", "MC_CORES"]})
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, f"{job.name}.log"), "w") as log_file:
+        subprocess.run(job.command, cwd=job.cwd, env=env, stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    return time.time() - start_time
+
+
+def default_cpu_budget():
+    """
+    Number of cores of the allocation.
+
+    Returns:
+        int: SLURM_CPUS_PER_TASK if set, otherwise the cores available to the process
+    """
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def default_mem_budget():
+    """
+    Memory of the allocation.
+
+    Returns:
+        float: SLURM_MEM_PER_NODE (MB) if set, otherwise SLURM_MEM_PER_CPU (MB) times the cores of
+            default_cpu_budget(), otherwise the physical memory of the node, in GB
+    """
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        return int(os.environ["SLURM_MEM_PER_NODE"]) / 1024
+    if os.environ.get("SLURM_MEM_PER_CPU"):
+        return int(os.environ["SLURM_MEM_PER_CPU"]) * default_cpu_budget() / 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+def run_jobs(
+    jobs,
+    total_cpus=None,
+    max_jobs=None,
+    cache_path=CACHE_MANIFEST_PATH,
+    log_dir=LOG_DIR,
+    force=False,
+    total_mem_gb=None,
+):
+    """
+    Run a job graph with a CPU and memory budget, skipping the jobs whose cached outputs are up to date.
+
+    Args:
+        jobs (list[Job]): Jobs to run
+        total_cpus (int, optional): Number of cores shared by the jobs. Defaults to default_cpu_budget()
+        max_jobs (int, optional): Maximum number of jobs running at the same time. If None, only the
+            CPU and memory budgets limit the concurrency. Defaults to None
+        cache_path (str, optional): Path to the cache manifest. Defaults to CACHE_MANIFEST_PATH
+        log_dir (str, optional): Folder of the log files of the commands. Defaults to LOG_DIR
+        force (bool | list[str], optional): Whether to run all jobs, or the names of the jobs to run,
+            even if they are up to date. Defaults to False
+        total_mem_gb (float, optional): Memory shared by the jobs in GB. Defaults to default_mem_budget()
+
+    Returns:
+        dict: Mapping from job name to its status, one of "cached", "succeeded", "failed" and "skipped"
+            (an upstream job failed)
+
+    Process:
+        1. Checks the job graph
+        2. Whenever all dependencies of a job succeeded, computes its cache key from the current inputs:
+           - If the key and the outputs match the manifest, the job is marked as cached
+           - Otherwise it is started as soon as its cores and its memory fit in the budget
+        3. Records every successful run in the manifest, and skips the dependents of failed jobs
+
+    Notes:
+        - Jobs are started in the order of the list when several are ready, so the longest jobs
+          should come first
+        - A job requesting more cores than total_cpus is granted total_cpus and runs alone, likewise
+          for the memory
+        - The memory of a job is a reservation, its actual use is not measured
+
+    Raises:
+        ValueError: If the job graph is invalid
+    """
+    _check_job_graph(jobs)
+    if total_cpus is None:
+        total_cpus = default_cpu_budget()
+    if total_mem_gb is None:
+        total_mem_gb = default_mem_budget()
+    if max_jobs is None:
+        max_jobs = len(jobs)
+    forced_jobs = {job.name for job in jobs} if force is True else set(force or [])
+
+    jobs_by_name = {job.name: job for job in jobs}
+    manifest = _load_manifest(cache_path)
+    status = {}
+    pending = list(jobs)
+    running = {}  # future -> (job, cache key, granted cores, granted memory)
+    cpus_in_use = 0
+    mem_in_use = 0
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        while pending or running:
+            # * Step1/2: Resolve the cached jobs and start the ready ones that fit in the budget
+            progressed = True
+            while progressed:
+                progressed = False
+                for job in list(pending):
+                    dependency_status = [status.get(name) for name in job.depends_on]
+                    if any(s in ("failed", "skipped") for s in dependency_status):
+                        status[job.name] = "skipped"
+                        print(f"Job {job.name} is skipped, an upstream job failed")
+                    elif all(s in ("cached", "succeeded") for s in dependency_status):
+                        cache_key = job_cache_key(job, jobs_by_name)
+                        cached_run = manifest.get(job.name, {})
+                        if (
+                            job.name not in forced_jobs
+                            and cached_run.get("key") == cache_key
+                            and all(os.path.exists(path) for path in job.outputs)
+                        ):
+                            status[job.name] = "cached"
+                            print(f"Job {job.name} is up to date")
+                        else:
+                            n_cpus = min(job.n_cpus, total_cpus)
+                            mem_gb = min(job.mem_gb, total_mem_gb)
+                            if (
+                                len(running) >= max_jobs
+                                or cpus_in_use + n_cpus > total_cpus
+                                or mem_in_use + mem_gb > total_mem_gb
+                            ):
+                                continue
+                            future = executor.submit(_run_job, job, n_cpus, log_dir)
+                            running[future] = (job, cache_key, n_cpus, mem_gb)
+                            cpus_in_use += n_cpus
+                            mem_in_use += mem_gb
+                            print(
+                                f"Job {job.name} has started with {n_cpus} cores and {mem_gb:g}GB "
+                                f"({cpus_in_use}/{total_cpus} cores, {mem_in_use:g}/{total_mem_gb:g}GB in use)"
+                            )
+                    else:
+                        continue
+                    pending.remove(job)
+                    progressed = True
+
+            if not running:
+                break
+
+            # * Step2/2: Wait for a job to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, cache_key, n_cpus, mem_gb = running.pop(future)
+                cpus_in_use -= n_cpus
+                mem_in_use -= mem_gb
+                try:
+                    elapsed_time = future.result()
+                except Exception as e:
+                    status[job.name] = "failed"
+                    print(f"Job {job.name} has failed: {str(e)}")
+                    continue
+                status[job.name] = "succeeded"
+                manifest[job.name] = {
+                    "key": cache_key,
+                    "elapsed_seconds": round(elapsed_time, 1),
+                    "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                }
+                _save_manifest(manifest, cache_path)
+                print(f"Job {job.name} has succeeded in {elapsed_time:.0f}s")
+
+    counts = {s: sum(1 for v in status.values() if v == s) for s in ["succeeded", "cached", "failed", "skipped"]}
+    print(", ".join(f"{n} {s}" for s, n in counts.items()))
+    return status
+
+
+def study_data_path(fold, impute_type, include_statin, data_dir=DATA_DIR, extension=".csv"):
+    """
+    Path to an analysis dataset, as read by the Quarto documents.
+
+    Args:
+        fold (str): "train" or "test"
+        impute_type (str): "unimputed" or "imputed"
+        include_statin (str): "yes" or "no"
+        data_dir (str, optional): Folder of the datasets. Defaults to DATA_DIR
+        extension (str, optional): File extension. Defaults to ".csv"
+
+    Returns:
+        str: Path to <fold>_data_<impute_type>[_statin]<extension>
+    """
+    suffix = STUDY_SPLITS["statin" if include_statin == "yes" else "main"][1]
+    return os.path.join(data_dir, f"{fold}_data_{impute_type}{suffix}{extension}")
+
+
+def export_study_data(include_statin=("no",), data_dir=DATA_DIR, db_file_path=DatabaseConfig.DB_PATH):
+    """
+    Export the train and test datasets of the study once, for all jobs of the run.
+
+    Args:
+        include_statin (list[str], optional): Values of the include_statin parameter to export.
+            Defaults to ("no",)
+        data_dir (str, optional): Folder of the datasets. Defaults to DATA_DIR
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+
+    Process:
+        1. Creates the splits of STUDY_SPLITS that are not stored yet, from the materialized cohort tables
+        2. Exports every fold, unimputed and imputed, as CSV with the leading index column read by
+           the documents, and as uncompressed Feather for memory-mapped reading
+           (arrow::read_feather(mmap = TRUE), pyarrow.feather.read_table(memory_map=True))
+        3. Replaces the files in data_dir only if their content changed
+    """
+    staging_dir = os.path.join(data_dir, ".staging")
+    os.makedirs(staging_dir, exist_ok=True)
+    stored_splits = set(list_splits(db_file_path)["split_name"])
+    for statin in include_statin:
+        split_name = "statin" if statin == "yes" else "main"
+        if split_name not in stored_splits:
+            cohort_name = STUDY_SPLITS[split_name][0]
+            create_split(split_name, cohort=cohort_name, db_file_path=db_file_path)
+        for impute_type, imputed_table in STUDY_IMPUTATIONS.items():
+            for fold in FOLDS:
+                output_path = study_data_path(fold, impute_type, statin, data_dir)
+                staging_path = os.path.join(staging_dir, os.path.basename(output_path))
+                export_split_data(
+                    staging_path,
+                    split_name=split_name,
+                    fold=fold,
+                    imputed_table=imputed_table,
+                    db_file_path=db_file_path,
+                    output_formats=("csv", "feather"),
+                    compression="uncompressed",
+                )
+                # Keep the existing file, and its modification time, if the content is the same
+                for extension in [".csv", ".feather"]:
+                    staged_file = os.path.splitext(staging_path)[0] + extension
+                    output_file = os.path.splitext(output_path)[0] + extension
+                    if os.path.exists(output_file) and filecmp.cmp(staged_file, output_file, shallow=False):
+                        os.remove(staged_file)
+                    else:
+                        os.replace(staged_file, output_file)
+    os.rmdir(staging_dir)
+
+
+def _render_job(name, document, depends_on, data_paths, params, n_cpus, mem_gb):
+    """Job rendering a Quarto document to PDF, with the parameters it declares."""
+    cwd = os.path.dirname(document)
+    command = ["quarto", "render", os.path.basename(document), "--to", "pdf"]
+    if params:
+        with open(document) as f:
+            declares_params = "\nparams:" in f.read()
+        if declares_params:
+            for param_name, value in params.items():
+                command += ["-P", f"{param_name}:{value}"]
+    return Job(
+        name,
+        command,
+        cwd=cwd,
+        inputs=[document, os.path.join(PROJECT_DIR, "utils", "csv_utils.r")] + data_paths,
+        outputs=[os.path.splitext(document)[0] + ".pdf"],
+        depends_on=depends_on,
+        n_cpus=n_cpus,
+        mem_gb=mem_gb,
+    )
+
+
+def study_jobs(
+    impute_type=None,
+    include_statin=None,
+    n_cpus=16,
+    mem_gb=32,
+    eval_mem_gb=64,
+    data_dir=DATA_DIR,
+    db_file_path=DatabaseConfig.DB_PATH,
+):
+    """
+    Job graph of the study, replacing the SLURM scripts in code/.
+
+    Args:
+        impute_type (str, optional): impute_type parameter of the documents. If None, the default
+            of each document is used. Defaults to None
+        include_statin (str, optional): include_statin parameter of the documents. If None, the
+            default of each document is used. Defaults to None
+        n_cpus (int, optional): Cores of every render job, as requested by the SLURM scripts. Defaults to 16
+        mem_gb (int, optional): Memory of the export and of the render jobs in GB, as requested by the
+            SLURM scripts. Defaults to 32
+        eval_mem_gb (int, optional): Memory of the evaluation jobs in GB, as requested by code/eval_*.sh.
+            Defaults to 64
+        data_dir (str, optional): Folder of the datasets. Defaults to DATA_DIR
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+
+    Returns:
+        list[Job]: Jobs, longest first
+            - export_data: datasets of the study, see export_study_data
+            - <model>_<adjust_type>: models of step4_build_survival_model
+            - sensitivity_<model>: models of step8_sensitivity_analysis
+            - eval_<adjust_type>, sensitivity_eval: evaluation of the models on the test fold
+            - var_imp_<model>: selected variables of step6, needs the three adjust types of the model
+            - predict_risk: risk groups of step7, needs the full RSF and XGBoost models
+    """
+    params = {name: value for name, value in [("impute_type", impute_type), ("include_statin", include_statin)] if value}
+    statin_values = [include_statin] if include_statin else ["no"]
+    impute_types = [impute_type] if impute_type else list(STUDY_IMPUTATIONS)
+    train_paths = [study_data_path("train", i, s, data_dir) for s in statin_values for i in impute_types]
+    test_paths = [study_data_path("test", i, s, data_dir) for s in statin_values for i in impute_types]
+
+    jobs = [
+        Job(
+            "export_data",
+            functools.partial(export_study_data, tuple(statin_values), data_dir, db_file_path),
+            inputs=[db_file_path],
+            outputs=[
+                study_data_path(fold, i, s, data_dir, ext)
+                for s in statin_values
+                for i in STUDY_IMPUTATIONS
+                for fold in FOLDS
+                for ext in [".csv", ".feather"]
+            ],
+            mem_gb=mem_gb,
+        )
+    ]
+
+    model_dir = os.path.join(SRC_DIR, "step4_build_survival_model")
+    sensitivity_dir = os.path.join(SRC_DIR, "step8_sensitivity_analysis")
+    for model, (folder, prefix) in MODELS.items():
+        for adjust_type in ADJUST_TYPES:
+            document = os.path.join(model_dir, folder, f"{prefix}_{adjust_type}.qmd")
+            job_name = f"{model}_{adjust_type}"
+            jobs.append(_render_job(job_name, document, ["export_data"], train_paths, params, n_cpus, mem_gb))
+    for model, (_, prefix) in MODELS.items():
+        document = os.path.join(sensitivity_dir, f"sensitivity_{prefix}.qmd")
+        jobs.append(_render_job(f"sensitivity_{model}", document, ["export_data"], train_paths, params, n_cpus, mem_gb))
+
+    eval_dir = os.path.join(SRC_DIR, "step5_compare_model_performance")
+    for adjust_type in ADJUST_TYPES:
+        document = os.path.join(eval_dir, f"evaluate_performance_{adjust_type}.qmd")
+        depends_on = [f"{model}_{adjust_type}" for model in MODELS]
+        jobs.append(_render_job(f"eval_{adjust_type}", document, depends_on, test_paths, params, n_cpus, eval_mem_gb))
+    document = os.path.join(sensitivity_dir, "evaluate_performance.qmd")
+    depends_on = [f"sensitivity_{model}" for model in MODELS]
+    jobs.append(_render_job("sensitivity_eval", document, depends_on, test_paths, params, n_cpus, eval_mem_gb))
+
+    var_imp_dir = os.path.join(SRC_DIR, "step6_obtain_selected_variables")
+    for model, (_, prefix) in MODELS.items():
+        document = os.path.join(var_imp_dir, f"{prefix}_selected_variables.qmd")
+        depends_on = [f"{model}_{adjust_type}" for adjust_type in ADJUST_TYPES]
+        jobs.append(_render_job(f"var_imp_{model}", document, depends_on, test_paths, params, n_cpus, mem_gb))
+
+    document = os.path.join(SRC_DIR, "step7_predict_risk_group", "predict_risk.qmd")
+    depends_on = ["rsf_full", "xgb_full"]
+    jobs.append(_render_job("predict_risk", document, depends_on, train_paths + test_paths, params, n_cpus, mem_gb))
+    return jobs
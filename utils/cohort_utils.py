@@ -0,0 +1,252 @@
+"""
+Materialized analysis cohorts.
+
+The exclusion criteria in CohortCriteria are evaluated once against the STATUS and PROCESSED
+tables and stored as indexed tables Cohort_<name> (one eid per row). Export and analysis
+queries join against these tables instead of re-evaluating the criteria.
+
+A cohort is rebuilt only when its criteria or the data of STATUS/PROCESSED changed since it was
+materialized. Changes are tracked by triggers that bump a counter in the TABLE_VERSIONS table.
+
+Dependencies:
+    - sqlite3: For database operations
+    - pandas: For reading cohort data
+"""
+
+import datetime
+import json
+import pandas as pd
+from .constants import DatabaseConfig, TableNames, CohortCriteria, ConnectionProfiles
+from .sql_utils import db_connection
+
+COHORT_SOURCE_TABLES = [TableNames.STATUS, TableNames.PROCESSED]
+
+
+def cohort_table_name(name):
+    """
+    Name of the table that stores a cohort.
+
+    Args:
+        name (str): Name of the cohort
+
+    Returns:
+        str: Table name, Cohort_<name>
+    """
+    return f"{TableNames.COHORT_PREFIX}{name}"
+
+
+def register_cohort(name, criteria):
+    """
+    Register a named exclusion criterion, e.g. for a sensitivity analysis.
+
+    Args:
+        name (str): Name of the cohort. An existing cohort with the same name is replaced
+        criteria (str): SQL condition over STATUS (alias s) and PROCESSED (alias p)
+    """
+    CohortCriteria.CRITERIA[name] = criteria
+
+
+def _track_table_versions(cursor, table_names):
+    """
+    Make sure the change counters of the tables exist, and read them.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        table_names (list[str]): Names of the tracked tables
+
+    Returns:
+        dict: Mapping from table name to its version
+
+    Notes:
+        - SQLite only has row-level triggers. To keep bulk updates cheap, a trigger only writes
+          to TABLE_VERSIONS for the first changed row after the version was read (checked = 1).
+        - If a table was dropped and created again, its triggers are gone. They are created
+          again and the version is bumped, since the changes in between are unknown.
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TableNames.TABLE_VERSIONS} (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            checked INTEGER NOT NULL
+        );
+    """)
+
+    versions = {}
+    for table_name in table_names:
+        cursor.execute(f"INSERT OR IGNORE INTO {TableNames.TABLE_VERSIONS} VALUES (?, 0, 0);", (table_name,))
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?;", (table_name,))
+        existing_triggers = {row[0] for row in cursor.fetchall()}
+        operations = ["INSERT", "UPDATE", "DELETE"]
+        if any(f"trg_{table_name}_version_{op.lower()}" not in existing_triggers for op in operations):
+            for op in operations:
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table_name}_version_{op.lower()}
+                    AFTER {op} ON {table_name}
+                    BEGIN
+                        UPDATE {TableNames.TABLE_VERSIONS} SET version = version + 1, checked = 0
+                        WHERE table_name = '{table_name}' AND checked = 1;
+                    END;
+                """)
+            cursor.execute(
+                f"UPDATE {TableNames.TABLE_VERSIONS} SET version = version + 1 WHERE table_name = ?;", (table_name,)
+            )
+
+        cursor.execute(f"UPDATE {TableNames.TABLE_VERSIONS} SET checked = 1 WHERE table_name = ?;", (table_name,))
+        cursor.execute(f"SELECT version FROM {TableNames.TABLE_VERSIONS} WHERE table_name = ?;", (table_name,))
+        versions[table_name] = cursor.fetchone()[0]
+    return versions
+
+
+def materialize_cohort(name, force=False, db_file_path=DatabaseConfig.DB_PATH, primary_key="eid"):
+    """
+    Create or refresh the table of a cohort.
+
+    Args:
+        name (str): Name of the cohort in CohortCriteria.CRITERIA
+        force (bool, optional): Whether to rebuild the table even if it is up to date. Defaults to False
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        str: Name of the cohort table
+
+    Process:
+        1. Reads the versions of STATUS and PROCESSED and the registry entry of the cohort
+        2. Returns early if the criteria and the versions did not change
+        3. Otherwise rebuilds Cohort_<name> from the criteria and updates the registry
+
+    Raises:
+        ValueError: If the cohort is not registered
+    """
+    if name not in CohortCriteria.CRITERIA:
+        raise ValueError(f"Unknown cohort: {name}")
+    criteria = CohortCriteria.CRITERIA[name]
+    table_name = cohort_table_name(name)
+
+    with db_connection(db_file_path) as conn:
+        cursor = conn.cursor()
+
+        # * Step1/3: Compare with the registry
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TableNames.COHORTS} (
+                name TEXT PRIMARY KEY,
+                criteria TEXT NOT NULL,
+                source_versions TEXT NOT NULL,
+                n_subjects INTEGER,
+                materialized_at TEXT
+            );
+        """)
+        source_versions = json.dumps(_track_table_versions(cursor, COHORT_SOURCE_TABLES), sort_keys=True)
+
+        cursor.execute(f"SELECT criteria, source_versions FROM {TableNames.COHORTS} WHERE name = ?;", (name,))
+        registry_entry = cursor.fetchone()
+        table_existing = cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;", (table_name,)
+        ).fetchone()
+
+        # * Step2/3: Skip if up to date
+        if not force and table_existing and registry_entry == (criteria, source_versions):
+            print(f"Cohort {name} is up to date")
+            return table_name
+
+        # * Step3/3: Rebuild the cohort table
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cursor.execute(f"""
+            CREATE TABLE {table_name} (
+                {primary_key} INTEGER PRIMARY KEY,
+                FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
+            );
+        """)
+        cursor.execute(f"""
+            INSERT INTO {table_name}
+            SELECT s.{primary_key} FROM {TableNames.STATUS} s
+            INNER JOIN {TableNames.PROCESSED} p ON s.{primary_key} = p.{primary_key}
+            WHERE {criteria};
+        """)
+        n_subjects = cursor.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
+        cursor.execute(
+            f"INSERT OR REPLACE INTO {TableNames.COHORTS} VALUES (?, ?, ?, ?, ?);",
+            (name, criteria, source_versions, n_subjects, datetime.datetime.now().isoformat(timespec="seconds")),
+        )
+
+    print(f"Cohort {name} has been materialized with {n_subjects} subjects")
+    return table_name
+
+
+def refresh_cohorts(names=None, db_file_path=DatabaseConfig.DB_PATH):
+    """
+    Refresh the cohort tables that are out of date.
+
+    Args:
+        names (list[str], optional): Names of the cohorts. If None, all registered cohorts are refreshed.
+            Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+
+    Returns:
+        dict: Mapping from cohort name to its table name
+    """
+    if names is None:
+        names = list(CohortCriteria.CRITERIA.keys())
+    return {name: materialize_cohort(name, db_file_path=db_file_path) for name in names}
+
+
+def list_cohorts(db_file_path=DatabaseConfig.DB_PATH):
+    """
+    List the materialized cohorts.
+
+    Args:
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+
+    Returns:
+        pd.DataFrame: Registry with columns name, criteria, source_versions, n_subjects and materialized_at
+    """
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        table_existing = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;", (TableNames.COHORTS,)
+        ).fetchone()
+        if not table_existing:
+            return pd.DataFrame(columns=["name", "criteria", "source_versions", "n_subjects", "materialized_at"])
+        return pd.read_sql_query(f"SELECT * FROM {TableNames.COHORTS} ORDER BY name;", conn)
+
+
+def cohort_query(name, table_name, columns=None, primary_key="eid"):
+    """
+    SQL query that selects the rows of a table that belong to a cohort.
+
+    Args:
+        name (str): Name of the cohort
+        table_name (str): Name of the table to select from
+        columns (list[str], optional): Columns to select. If None, all columns are selected. Defaults to None
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        str: SQL query joining the table with Cohort_<name>
+
+    Notes:
+        - The cohort table must be materialized first, see materialize_cohort
+    """
+    select_sql = ", ".join(f"t.`{col}`" for col in columns) if columns else "t.*"
+    return f"""
+        SELECT {select_sql} FROM {table_name} t
+        INNER JOIN {cohort_table_name(name)} c ON t.{primary_key} = c.{primary_key};
+    """
+
+
+def read_cohort_data(name, table_name, columns=None, db_file_path=DatabaseConfig.DB_PATH, primary_key="eid"):
+    """
+    Read the rows of a table that belong to a cohort, refreshing the cohort first if needed.
+
+    Args:
+        name (str): Name of the cohort
+        table_name (str): Name of the table to read
+        columns (list[str], optional): Columns to read. If None, all columns are read. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        pd.DataFrame: Rows of the table for the cohort
+    """
+    materialize_cohort(name, db_file_path=db_file_path, primary_key=primary_key)
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        return pd.read_sql_query(cohort_query(name, table_name, columns, primary_key), conn)
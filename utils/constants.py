@@ -8,16 +8,18 @@ class DatabaseConfig:
 
     Attributes:
         CSV_PATH (str): Path to the main UKBB CSV file.
-        TOTAL_ROWS (int): Total number of rows in the database.
+        TOTAL_ROWS (int): Total number of rows in the database. For reference only,
+            csv_utils.count_row_numbers reads the actual count from the row index.
         USED_ROWS (int): Number of rows actually used in analysis.
         DB_PATH (str): Path to the SQLite database file.
         ECG_FOLDER (str): Path to the ECG folder.
+        HRV_CACHE_DIR (str): Path to the cache of per-subject HRV results, see hrv_cache.
+        HRV_CACHE_MAX_BYTES (int): Size above which the least recently used HRV results are evicted.
         SAMPLING_RATE (int): Sampling rate of the ECG data.
         CENSOR_DATE (datetime): Cutoff date for data censoring.
     """
 
     CSV_PATH = "/work/users/y/u/yuukias/BIOS-Material/BIOS992/data/ukbiobank.csv"
-    COLUMN_DEFS_PATH = "/work/users/y/u/yuukias/BIOS-Material/BIOS992/data/column_defs.pkl"
     TOTAL_ROWS = 502368
     USED_ROWS = 77888
 
@@ -25,11 +27,50 @@ class DatabaseConfig:
     DB_PATH = "/work/users/y/u/yuukias/BIOS-Material/BIOS992/data/ukbiobank.db"
 
     ECG_FOLDER = "/users/y/u/yuukias/database/UKBiobank/6025"
+    HRV_CACHE_DIR = "/work/users/y/u/yuukias/BIOS-Material/BIOS992/data/hrv_cache"
+    HRV_CACHE_MAX_BYTES = 2 * 1024**3  # 2 GiB
     SAMPLING_RATE = 500
 
     CENSOR_DATE = datetime.datetime(2022, 10, 31)
 
 
+class ConnectionProfiles:
+    """
+    SQLite PRAGMA settings applied when a connection is opened.
+
+    Attributes:
+        SAFE (dict): Profile for normal use. Rollback journal and full synchronization,
+            so every committed transaction is durable.
+        BULK_LOAD (dict): Profile for building tables. WAL journal with relaxed
+            synchronization, large page cache, memory-mapped I/O and in-memory temporary
+            storage. A crash may lose the last transaction but will not corrupt the database.
+        READ_ONLY (dict): Profile for helpers that only read. Writes are refused and the journal
+            mode is left as it is, so a reader never needs the exclusive lock of a journal switch.
+        BULK_INSERT_BATCH_SIZE (int): Number of rows sent to each executemany call.
+    """
+
+    SAFE = {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "foreign_keys": "ON",
+    }
+    BULK_LOAD = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -1048576,  # negative value is in KiB -> 1 GiB
+        "mmap_size": 8 * 1024**3,  # 8 GiB
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    }
+    READ_ONLY = {
+        "query_only": "ON",
+        "mmap_size": 8 * 1024**3,  # 8 GiB
+        "temp_store": "MEMORY",
+    }
+
+    BULK_INSERT_BATCH_SIZE = 10000
+
+
 class TableNames:
     """
     Database table names.
@@ -41,6 +82,7 @@ class TableNames:
     """
     CONFOUNDERS = "Confounders"  # correspond to CONFOUNDER_COLUMNS_ID
     ECG = "ECG"  # correspond to ECG_COLUMNS_ID
+    ECG_ARRAY = "ECG_array"  # correspond to ECG_ARRAY_COLUMNS_ID, see sql_utils.generate_table_from_main_csv
     ICD = "ICD"  # correspond to ICD_COLUMNS_ID
 
     # HRV indices extracted using neurokit2
@@ -52,9 +94,111 @@ class TableNames:
 
     PROCESSED = "Processed"  # processed variables
 
+    # long format of the array fields in ICD: one row per (eid, instance, array index)
+    ICD_LONG = "ICD_long"  # 41270 codes with the 41280 dates
+    MEDICATION_LONG = "Medication_long"  # 20003 treatment codes
+
     COVARIATES = "Covariates"  # covariates that will be used for survival analysis
     STATUS = "Status"  # health status of that will be used for participant selection and survival analysis
 
+    COHORTS = "Cohorts"  # registry of the materialized cohort tables, see cohort_utils
+    TABLE_VERSIONS = "TableVersions"  # change counters of the tables that cohorts depend on
+    COHORT_PREFIX = "Cohort_"  # Cohort_<name> holds the eids of a materialized cohort
+
+    SPLITS = "Splits"  # train/test assignment of every subject, see split_utils
+    SPLIT_METADATA = "SplitMetadata"  # seed and stratification of every split
+    IMPUTED_MISSFOREST = "Imputed_missForest"  # covariates of the eligible cohort imputed by MissForest
+
+    COLUMN_CATALOG = "ColumnCatalog"  # columns of the main CSV, in its sidecar catalog, see csv_utils.build_column_catalog
+
+
+class TableIndexes:
+    """
+    Secondary indexes that should exist in the analysis database.
+
+    Attributes:
+        INDEXES (dict): Mapping from table name to a list of column tuples. Each tuple
+            becomes one (possibly composite) index named idx_<table>_<columns>.
+
+    Notes:
+        - eid is declared as INTEGER PRIMARY KEY in every table, so it is the rowid and joins
+          on eid are already index-backed. Only filter columns need to be declared here.
+        - Column order of a composite index matters: equality filters should come first.
+    """
+
+    INDEXES = {
+        TableNames.STATUS: [
+            ("statins", "ecg_hrv_ok", "ecg_before_cvd"),  # exclusion criteria used by the export notebooks
+            ("event",),
+        ],
+        TableNames.PROCESSED: [
+            ("CVD",),
+            ("HRV_available",),
+        ],
+        TableNames.ICD_LONG: [
+            ("code", "date"),  # prefix matching of diagnoses and earliest date
+        ],
+        TableNames.MEDICATION_LONG: [
+            ("code",),
+        ],
+    }
+
+
+class EventDefinitions:
+    """
+    Code lists used to derive outcomes and medication flags from the long tables.
+
+    Attributes:
+        CVD_ICD10_PREFIXES (list): ICD10 code prefixes (field 41270) that define a CVD event.
+        STATIN_CODES (list): Treatment codes (field 20003) of statins.
+
+    Notes:
+        - ICD10 codes are stored without the dot, e.g. "I251", so a prefix also matches
+          all sub-codes.
+        - Sensitivity analyses can pass other lists to derived_variables.derive_event
+          and derived_variables.derive_medication.
+    """
+
+    CVD_ICD10_PREFIXES = [
+        # Ischamic Heart Disease
+        "I20", "I21", "I22", "I23", "I24", "I25",
+        # Arrhythmia
+        "I44", "I45", "I46", "I47", "I48", "I49",
+        # Heart Failure
+        "I50",
+        # Cerebrovascular Disease
+        "I60", "I61", "I62", "I63", "I64", "I65", "I66", "I67", "I68", "I69",
+        # Cardiomyopathy
+        "I420", "I428", "I429",
+    ]
+
+    STATIN_CODES = [
+        1141146234,  # Atorvastatin
+        1141192410,  # Rosuvastatin
+        1140861958,  # Simvastatin
+        1140888648,  # Pravastatin
+        1140888594,  # Fluvastatin
+    ]
+
+
+class CohortCriteria:
+    """
+    Named exclusion criteria of the analysis cohorts.
+
+    Each criterion is a SQL condition over the STATUS table (alias s) and the PROCESSED table (alias p).
+    cohort_utils materializes every criterion as a table Cohort_<name> with the eids that satisfy it.
+
+    Attributes:
+        CRITERIA (dict): Mapping from cohort name to its SQL condition.
+            - eligible: main analysis, participants without statins whose ECG was recorded before CVD
+            - eligible_with_statins: sensitivity analysis that keeps statin users
+    """
+
+    CRITERIA = {
+        "eligible": "s.statins = 0 AND s.ecg_hrv_ok = 1 AND s.ecg_before_cvd = 0",
+        "eligible_with_statins": "s.ecg_hrv_ok = 1 AND s.ecg_before_cvd = 0",
+    }
+
 
 class ColumnIDs:
     """
@@ -65,6 +209,7 @@ class ColumnIDs:
             smoking status, gender, diabetes, blood pressure, ethnicity, BMI, etc.
         ECG_COLUMNS_ID (list): Column IDs for ECG-related measurements including workload, 
             heart rate, chest pain, bike method, and test phases.
+        ECG_ARRAY_COLUMNS_ID (list): Column IDs of the ECG trend fields, stored as arrays.
         ICD10_COLUMNS_ID (list): Column IDs for ICD10 diagnosis codes and dates.
     """
 
@@ -134,6 +279,9 @@ class ColumnIDs:
         5988,
     ]
 
+    # Trend fields of ECG_COLUMNS_ID with up to 114 values, stored in TableNames.ECG_ARRAY instead of wide columns
+    ECG_ARRAY_COLUMNS_ID = [5983, 5984, 5985, 5986, 5987, 5988]
+
     ICD_COLUMNS_ID = [
         # ICD10 code: primary + secondary
         41270,
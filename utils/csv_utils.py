@@ -4,30 +4,127 @@ Utility functions for CSV file operations.
 This module provides functions for reading and manipulating CSV files without any
 database interactions. It includes functions for:
 - Counting rows in CSV files
-- Reading column names and definitions
+- Building a byte-offset row index to read selected participants with seeks
+- Converting the main CSV to a columnar Parquet mirror, which readers use when it exists
+- Reading column names and definitions from an indexed SQLite column catalog
 - Previewing CSV data
-- Extracting specific columns from CSV files
+- Extracting specific columns from CSV files, lazily through DataQuery
 
 Note:
     All functions in this module operate directly on CSV files and do not require
-    or interact with any database connections.
+    or interact with the project database. The column catalog is a SQLite file stored
+    next to the CSV file, like the row index and the Parquet mirror.
 
 Dependencies:
     - pandas: For DataFrame operations
+    - numpy: For storing the row index
+    - pyarrow: For writing and reading the Parquet mirror
+    - sqlite3: For the column catalog
     - dask: For handling large CSV files
     - IPython: For display in Jupyter notebooks
 """
 
+import copy
 import csv
+import io
+import json
+import os
+import sqlite3
+from multiprocessing import Pool, cpu_count
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from IPython.display import display, HTML
 import dask.dataframe as dd
-import pickle
 import scipy.stats as stats
 from tqdm import tqdm
 import warnings
 
-from .constants import DatabaseConfig
+from .constants import DatabaseConfig, TableNames
+
+
+def _row_index_path(file_path):
+    """
+    Get the path of the sidecar row index of a CSV file.
+
+    Args:
+        file_path (str): Path to the CSV file
+
+    Returns:
+        str: Path to the row index file, stored next to the CSV file
+    """
+    return f"{file_path}.rowidx.npz"
+
+
+def build_row_index(file_path=DatabaseConfig.CSV_PATH):
+    """
+    Build and save the byte-offset row index of a CSV file.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Process:
+        1. Scans the file line by line in binary mode, without parsing any field
+        2. Records the eid (first field) and the byte offset where each line starts
+        3. Saves eids, offsets and the size/modification time of the CSV next to the file
+
+    Returns:
+        tuple: (eids, offsets)
+            - eids (np.ndarray): eid of each data row, in file order
+            - offsets (np.ndarray): Byte offset of each data row, in file order
+
+    Notes:
+        - Assumes that no quoted field contains a line break, which holds for the UK Biobank main CSV
+    """
+    eids = []
+    offsets = []
+    file_stat = os.stat(file_path)
+    with open(file_path, "rb") as f, tqdm(total=file_stat.st_size, desc="Indexing CSV", unit="B", unit_scale=True) as pbar:
+        header = f.readline()
+        offset = len(header)
+        pbar.update(offset)
+        for line in f:
+            if line.strip():
+                eids.append(int(line[: line.find(b",")].strip(b'"')))
+                offsets.append(offset)
+            offset += len(line)
+            pbar.update(len(line))
+
+    eids = np.array(eids, dtype=np.int64)
+    offsets = np.array(offsets, dtype=np.int64)
+    np.savez(
+        _row_index_path(file_path),
+        eids=eids,
+        offsets=offsets,
+        file_size=file_stat.st_size,
+        file_mtime=file_stat.st_mtime_ns,
+    )
+    print(f"Row index of {len(eids)} rows has been saved to {_row_index_path(file_path)}")
+    return eids, offsets
+
+
+def load_row_index(file_path=DatabaseConfig.CSV_PATH):
+    """
+    Load the byte-offset row index of a CSV file, (re)building it if needed.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        tuple: (eids, offsets), see build_row_index
+
+    Notes:
+        - The index is rebuilt if it is missing or the size/modification time of the CSV has changed
+    """
+    index_path = _row_index_path(file_path)
+    if os.path.exists(index_path):
+        file_stat = os.stat(file_path)
+        with np.load(index_path) as row_index:
+            if row_index["file_size"] == file_stat.st_size and row_index["file_mtime"] == file_stat.st_mtime_ns:
+                return row_index["eids"], row_index["offsets"]
+        print(f"Row index of {file_path} is outdated and will be rebuilt")
+    return build_row_index(file_path)
 
 
 def count_row_numbers(file_path=DatabaseConfig.CSV_PATH):
@@ -39,11 +136,649 @@ def count_row_numbers(file_path=DatabaseConfig.CSV_PATH):
 
     Returns:
         int: Total number of rows in the CSV file, including header
+
+    Notes:
+        - Uses the row index, so the count is instant once the index has been built
     """
-    with open(file_path, mode="r", encoding="utf-8") as csvfile:
-        reader = csv.reader(csvfile)
-        row_count = sum(1 for row in reader)
-    return row_count
+    eids, _ = load_row_index(file_path)
+    return len(eids) + 1
+
+
+def read_rows_by_eids(target_column_names, eids, file_path=DatabaseConfig.CSV_PATH, chunk_size=5000):
+    """
+    Read specific columns for selected participants by seeking to their rows.
+
+    Args:
+        target_column_names (list): List of column names to extract from the CSV
+        eids (list): List of eids whose rows should be read
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        chunk_size (int, optional): Number of rows in each yielded chunk. Defaults to 5000
+
+    Yields:
+        pd.DataFrame: Chunk with eid and the target columns, all read as str
+
+    Notes:
+        - Rows are read in file order. eids that are not in the CSV are ignored
+        - Only the lines of the selected eids are read, instead of the whole file
+        - Columns are selected by position if the column catalog exists
+    """
+    index_eids, index_offsets = load_row_index(file_path)
+    selected_offsets = index_offsets[np.isin(index_eids, np.asarray(eids, dtype=np.int64))]
+    usecols = _usecols(target_column_names, file_path)
+
+    with open(file_path, "rb") as f:
+        header = f.readline()
+        for start in range(0, len(selected_offsets), chunk_size):
+            lines = []
+            for offset in selected_offsets[start : start + chunk_size]:
+                f.seek(offset)
+                lines.append(f.readline())
+            yield pd.read_csv(io.BytesIO(header + b"".join(lines)), dtype=str, usecols=usecols)
+
+
+def _field_id(column_name):
+    """
+    Get the field ID of a UK Biobank column name, e.g. 41270 for "41270-0.12".
+
+    Args:
+        column_name (str): Column name in the format <field>-<instance>.<array>
+
+    Returns:
+        int: Field ID
+    """
+    return int(column_name.split("-")[0])
+
+
+def _profile_chunk(chunk):
+    """
+    Summarize the values of every column in a chunk read as str.
+
+    Args:
+        chunk (pd.DataFrame): Chunk read from the CSV file with dtype=str
+
+    Returns:
+        pd.DataFrame: One row per column with n_rows, non_null, all_int, all_numeric,
+            all_date and max_length
+    """
+    not_null = chunk.notna()
+    numeric = chunk.apply(pd.to_numeric, errors="coerce")
+    is_date = chunk.apply(lambda col: col.astype(object).str.fullmatch(r"\d{4}-\d{2}-\d{2}", na=False).astype(bool))
+    return pd.DataFrame(
+        {
+            "n_rows": len(chunk),
+            "non_null": not_null.sum(),
+            "all_numeric": (numeric.notna() | ~not_null).all(),
+            "all_int": ((numeric % 1 == 0) | ~not_null).all(),
+            "all_date": (is_date | ~not_null).all(),
+            "max_length": chunk.apply(lambda col: col.astype(object).str.len().max()).fillna(0).astype("int64"),
+        }
+    )
+
+
+def _merge_type_profiles(profile_a, profile_b):
+    """
+    Merge two column profiles, i.e. join the type lattices of the two row blocks.
+
+    Args:
+        profile_a (pd.DataFrame or None): Profile returned by _profile_chunk, or None
+        profile_b (pd.DataFrame): Profile returned by _profile_chunk
+
+    Returns:
+        pd.DataFrame: Profile that describes the rows of both inputs
+    """
+    if profile_a is None:
+        return profile_b
+    return pd.DataFrame(
+        {
+            "n_rows": profile_a["n_rows"] + profile_b["n_rows"],
+            "non_null": profile_a["non_null"] + profile_b["non_null"],
+            "all_numeric": profile_a["all_numeric"] & profile_b["all_numeric"],
+            "all_int": profile_a["all_int"] & profile_b["all_int"],
+            "all_date": profile_a["all_date"] & profile_b["all_date"],
+            "max_length": np.maximum(profile_a["max_length"], profile_b["max_length"]),
+        }
+    )
+
+
+def _profile_row_block(file_path, column_names, start_offset, n_rows, chunk_size):
+    """
+    Profile the columns of a block of consecutive rows. Runs in a worker process.
+
+    Args:
+        file_path (str): Path to the CSV file
+        column_names (list): Columns to profile
+        start_offset (int): Byte offset of the first row of the block
+        n_rows (int): Number of rows in the block
+        chunk_size (int): Number of rows to parse at once
+
+    Returns:
+        pd.DataFrame: Profile of the block, see _profile_chunk
+    """
+    profile = None
+    with open(file_path, "rb") as f:
+        header = f.readline()
+        f.seek(start_offset)
+        for start in range(0, n_rows, chunk_size):
+            lines = [f.readline() for _ in range(min(chunk_size, n_rows - start))]
+            chunk = pd.read_csv(io.BytesIO(header + b"".join(lines)), dtype=str, usecols=column_names)
+            profile = _merge_type_profiles(profile, _profile_chunk(chunk[column_names]))
+    return profile
+
+
+def profile_column_types(
+    file_path=DatabaseConfig.CSV_PATH, column_names=None, chunk_size=5000, n_workers=None, max_chunk_cells=2_000_000
+):
+    """
+    Profile the type of columns over the whole CSV file with parallel worker processes.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        column_names (list, optional): Columns to profile. If None, all columns except eid. Defaults to None
+        chunk_size (int, optional): Maximum number of rows each worker parses at once. Defaults to 5000
+        n_workers (int, optional): Number of worker processes. If None, all cores available to the
+            process but one. Defaults to None
+        max_chunk_cells (int, optional): Maximum number of values (rows x columns) each worker parses
+            at once. Defaults to 2_000_000
+
+    Process:
+        1. Splits the rows into blocks using the byte-offset row index
+        2. Each worker profiles its blocks: non-null count, whether all values are
+           integers / numbers / dates, and the maximum text length
+        3. Merges the block profiles and resolves the type of every column
+
+    Returns:
+        pd.DataFrame: One row per column with dtype ("int64", "float64", "date" or "object"),
+            nullable, non_null and max_length
+
+    Notes:
+        - Types follow the lattice int64 < float64 < object and date < object. A column that
+          has no value at all is object
+        - Values are parsed as str, so the rows per chunk shrink with the number of columns to keep
+          the memory of every worker bounded by max_chunk_cells
+        - The cores available to the process (e.g. a SLURM allocation) are used, not every core of the node
+    """
+    if column_names is None:
+        column_names = [col for col in get_column_names(file_path) if col != "eid"]
+    if n_workers is None:
+        n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else cpu_count()
+        n_workers = max(1, n_cpus - 1)  # Leave one core free
+    chunk_size = max(1, min(chunk_size, max_chunk_cells // max(1, len(column_names))))
+
+    _, offsets = load_row_index(file_path)
+    n_blocks = min(len(offsets), n_workers * 4)  # several blocks per worker to balance the load
+    block_starts = np.linspace(0, len(offsets), n_blocks + 1, dtype=np.int64)
+    tasks = [
+        (file_path, column_names, int(offsets[start]), int(end - start), chunk_size)
+        for start, end in zip(block_starts[:-1], block_starts[1:])
+        if end > start
+    ]
+
+    profile = None
+    with Pool(n_workers) as pool:
+        for block_profile in tqdm(pool.starmap(_profile_row_block, tasks), desc="Merging column profiles"):
+            profile = _merge_type_profiles(profile, block_profile)
+
+    profile["dtype"] = np.select(
+        [profile["non_null"] == 0, profile["all_int"], profile["all_numeric"], profile["all_date"]],
+        ["object", "int64", "float64", "date"],
+        default="object",
+    )
+    profile["nullable"] = profile["non_null"] < profile["n_rows"]
+    return profile.loc[column_names, ["dtype", "nullable", "non_null", "max_length"]]
+
+
+def infer_column_types(file_path=DatabaseConfig.CSV_PATH, column_names=None, chunk_size=5000, n_workers=None):
+    """
+    Infer the data type of columns from the whole CSV file.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        column_names (list, optional): Columns to infer. If None, all columns except eid. Defaults to None
+        chunk_size (int, optional): Number of rows each worker parses at once. Defaults to 5000
+        n_workers (int, optional): Number of worker processes. If None, all cores available to the
+            process but one. Defaults to None
+
+    Returns:
+        dict: Mapping from column name to "int64", "float64", "date" or "object"
+    """
+    profile = profile_column_types(file_path, column_names, chunk_size, n_workers)
+    return profile["dtype"].to_dict()
+
+
+def _mirror_path(file_path):
+    """
+    Get the directory of the Parquet mirror of a CSV file.
+
+    Args:
+        file_path (str): Path to the CSV file
+
+    Returns:
+        str: Path to the mirror directory, stored next to the CSV file
+    """
+    return f"{file_path}.parquet"
+
+
+def _load_mirror_manifest(file_path=DatabaseConfig.CSV_PATH):
+    """
+    Load the manifest of the Parquet mirror if the mirror is complete and up to date.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        dict or None: Manifest of the mirror, or None if there is no valid mirror
+    """
+    manifest_path = os.path.join(_mirror_path(file_path), "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    file_stat = os.stat(file_path)
+    if manifest["file_size"] != file_stat.st_size or manifest["file_mtime"] != file_stat.st_mtime_ns:
+        print(f"Parquet mirror of {file_path} is outdated and will not be used")
+        return None
+    return manifest
+
+
+def _convert_chunk_types(chunk, column_types):
+    """
+    Convert columns of a chunk read as str to their inferred types.
+
+    Args:
+        chunk (pd.DataFrame): Chunk read from the CSV file with dtype=str
+        column_types (dict): Mapping from column name to "int64", "float64", "date" or "object"
+
+    Returns:
+        pd.DataFrame: Chunk with converted columns. Integer columns use the nullable Int64 type
+    """
+    chunk = chunk.copy()
+    for col, col_type in column_types.items():
+        if col_type == "int64":
+            chunk[col] = pd.to_numeric(chunk[col]).astype("Int64")
+        elif col_type == "float64":
+            chunk[col] = pd.to_numeric(chunk[col]).astype("float64")
+        elif col_type == "date":
+            chunk[col] = pd.to_datetime(chunk[col], format="%Y-%m-%d")
+    return chunk
+
+
+def convert_csv_to_parquet(
+    file_path=DatabaseConfig.CSV_PATH, chunk_size=10000, columns_per_file=500, max_chunk_cells=2_000_000
+):
+    """
+    Convert the main CSV file to a columnar Parquet mirror, partitioned by field ID groups.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        chunk_size (int, optional): Maximum number of rows to process at once. Defaults to 10000
+        columns_per_file (int, optional): Maximum number of columns in one Parquet file.
+            All columns of a field are kept in the same file, so a field with more columns
+            than this gets a file of its own. Defaults to 500
+        max_chunk_cells (int, optional): Maximum number of values (rows x columns) parsed at once.
+            Defaults to 2_000_000
+
+    Process:
+        1. Groups the columns by field ID and packs the groups into partitions
+        2. Infers the data type of every column from the whole file
+        3. Packs the partitions into passes of at most max_chunk_cells values per chunk, and streams
+           the columns of each pass from the CSV in chunks into their partition files
+        4. Writes the manifest, which marks the mirror as complete
+
+    Notes:
+        - Memory is bounded by max_chunk_cells, only the columns of one pass are parsed, as str, at a time
+        - The file is read once per pass. Rows per chunk shrink for a partition wider than
+          max_chunk_cells / chunk_size, so that its pass fits in the bound
+        - Every partition file contains eid and rows in the same order as the CSV file, with row groups
+          of the same size, so read_mirror can read the files side by side
+        - The mirror is ignored by readers once the CSV file changes (size or modification time)
+    """
+    mirror_path = _mirror_path(file_path)
+    os.makedirs(mirror_path, exist_ok=True)
+    manifest_path = os.path.join(mirror_path, "manifest.json")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)  # the mirror is invalid until the conversion is finished
+
+    # * Step1/4: Pack the field groups into partitions
+    column_names = [col for col in get_column_names(file_path) if col != "eid"]
+    partitions = []
+    for col in column_names:
+        same_field = partitions and _field_id(partitions[-1][-1]) == _field_id(col)
+        if partitions and (same_field or len(partitions[-1]) < columns_per_file):
+            partitions[-1].append(col)
+        else:
+            partitions.append([col])
+    partition_files = {f"part_{i:04d}.parquet": columns for i, columns in enumerate(partitions)}
+    print(f"{len(column_names)} columns will be written to {len(partition_files)} Parquet files")
+
+    # * Step2/4: Determine the type of every column
+    column_types = infer_column_types(file_path, column_names, chunk_size)
+    arrow_types = {"int64": pa.int64(), "float64": pa.float64(), "date": pa.date32(), "object": pa.string()}
+
+    # * Step3/4: Stream the CSV file into the partition files, one pass of partitions at a time
+    # the same rows per chunk in every pass, so all files have the same row groups
+    chunk_size = max(1, min(chunk_size, max_chunk_cells // (max(map(len, partitions), default=0) + 1)))
+    passes, pass_width = [], 0
+    for file_name, columns in partition_files.items():
+        if passes and pass_width + len(columns) <= max_chunk_cells // chunk_size - 1:
+            passes[-1].append(file_name)
+            pass_width += len(columns)
+        else:
+            passes.append([file_name])
+            pass_width = len(columns)
+    print(f"The CSV file will be read in {len(passes)} passes of {chunk_size} rows per chunk")
+
+    for i, pass_files in enumerate(passes):
+        pass_columns = [col for file_name in pass_files for col in partition_files[file_name]]
+        writers = {}
+        for file_name in pass_files:
+            fields = [(col, arrow_types[column_types[col]]) for col in partition_files[file_name]]
+            writers[file_name] = pq.ParquetWriter(
+                os.path.join(mirror_path, file_name), pa.schema([("eid", pa.int64()), *fields])
+            )
+        chunks = pd.read_csv(file_path, chunksize=chunk_size, dtype=str, usecols=_usecols(pass_columns, file_path))
+        try:
+            for chunk in tqdm(chunks, desc=f"Writing Parquet mirror ({i + 1}/{len(passes)})"):
+                chunk["eid"] = chunk["eid"].astype("int64")
+                chunk = _convert_chunk_types(chunk, {col: column_types[col] for col in pass_columns})
+                for file_name, writer in writers.items():
+                    columns = ["eid", *partition_files[file_name]]
+                    writer.write_table(pa.Table.from_pandas(chunk[columns], schema=writer.schema, preserve_index=False))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    # * Step4/4: Write the manifest
+    file_stat = os.stat(file_path)
+    manifest = {
+        "file_size": file_stat.st_size,
+        "file_mtime": file_stat.st_mtime_ns,
+        "columns": ["eid", *column_names],
+        "column_types": column_types,
+        "partitions": partition_files,
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    print(f"Parquet mirror has been saved to {mirror_path}")
+
+
+def read_mirror(target_column_names, file_path=DatabaseConfig.CSV_PATH, eids=None, chunk_size=10000, nrows=None):
+    """
+    Read specific columns from the Parquet mirror of a CSV file.
+
+    Args:
+        target_column_names (list): List of column names to extract
+        file_path (str, optional): Path to the CSV file whose mirror is read. Defaults to DatabaseConfig.CSV_PATH
+        eids (list, optional): List of specific eids to filter the data. Defaults to None
+        chunk_size (int, optional): Number of rows in each batch read from the files. Defaults to 10000
+        nrows (int, optional): Stop after this many rows of the file. Defaults to None
+
+    Yields:
+        pd.DataFrame: Chunk with eid and the target columns. Missing values are NaN and
+            dates are ISO strings, the same as reading the CSV file
+
+    Raises:
+        FileNotFoundError: If there is no valid mirror for the CSV file
+
+    Notes:
+        - Only the partition files that contain the target columns are opened, and only
+          the bytes of those columns are read
+    """
+    manifest = _load_mirror_manifest(file_path)
+    if manifest is None:
+        raise FileNotFoundError(f"No valid Parquet mirror exists for {file_path}")
+
+    target_column_names = [col for col in target_column_names if col != "eid"]
+    column_to_file = {col: file_name for file_name, columns in manifest["partitions"].items() for col in columns}
+    file_columns = {}
+    for col in target_column_names:
+        file_columns.setdefault(column_to_file[col], []).append(col)
+    if not file_columns:  # only eid is requested
+        file_columns[next(iter(manifest["partitions"]))] = []
+
+    batch_iterators = [
+        pq.ParquetFile(os.path.join(_mirror_path(file_path), file_name)).iter_batches(
+            batch_size=chunk_size, columns=["eid", *columns]
+        )
+        for file_name, columns in file_columns.items()
+    ]
+    n_rows_read = 0
+    # * Every partition has the same row groups, so the batches of all files are aligned
+    for batches in zip(*batch_iterators):
+        frames = [batch.to_pandas() for batch in batches]
+        chunk = pd.concat([frames[0][["eid"]], *[frame.drop(columns="eid") for frame in frames]], axis=1)
+        if nrows is not None:
+            chunk = chunk.iloc[: nrows - n_rows_read]
+            n_rows_read += len(chunk)
+        if eids is not None:
+            chunk = chunk[chunk["eid"].isin(eids)]
+        chunk = chunk[["eid", *target_column_names]]
+        date_columns = [col for col in target_column_names if manifest["column_types"][col] == "date"]
+        for col in date_columns:
+            chunk[col] = pd.to_datetime(chunk[col]).dt.strftime("%Y-%m-%d")
+        string_columns = [col for col in chunk.columns if chunk[col].dtype == object]
+        chunk[string_columns] = chunk[string_columns].where(chunk[string_columns].notna(), np.nan)  # None -> NaN, as read_csv
+        yield chunk
+        if nrows is not None and n_rows_read >= nrows:
+            break
+
+
+def iter_selected_rows(target_column_names, eids, file_path=DatabaseConfig.CSV_PATH, chunk_size=5000):
+    """
+    Read specific columns for selected participants from the fastest available source.
+
+    Args:
+        target_column_names (list): List of column names to extract
+        eids (list): List of eids whose rows should be read
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        chunk_size (int, optional): Number of rows to process at once. Defaults to 5000
+
+    Yields:
+        pd.DataFrame: Chunk with eid and the target columns
+
+    Notes:
+        - Uses the Parquet mirror if it exists, otherwise seeks to the rows with the row index
+    """
+    if _load_mirror_manifest(file_path) is not None:
+        yield from read_mirror(target_column_names, file_path, eids=eids, chunk_size=chunk_size)
+    else:
+        yield from read_rows_by_eids(target_column_names, eids, file_path, chunk_size)
+
+
+def _catalog_path(file_path):
+    """
+    Get the path of the sidecar column catalog of a CSV file.
+
+    Args:
+        file_path (str): Path to the CSV file
+
+    Returns:
+        str: Path to the SQLite catalog, stored next to the CSV file
+    """
+    return f"{file_path}.catalog.db"
+
+
+def _read_header(file_path):
+    """Read the column names from the first row of a CSV file."""
+    with open(file_path, "r", newline="") as csvfile:
+        return next(csv.reader(csvfile))
+
+
+def _parse_column_name(column_name):
+    """
+    Split a UK Biobank column name, e.g. (41270, 0, 12) for "41270-0.12".
+
+    Args:
+        column_name (str): Column name in the format <field>-<instance>.<array>
+
+    Returns:
+        tuple: (field_id, instance, array_index), all None for eid
+    """
+    if column_name == "eid":
+        return None, None, None
+    field, instance_array = column_name.split("-")
+    instance, array_index = instance_array.split(".")
+    return int(field), int(instance), int(array_index)
+
+
+def build_column_catalog(file_path=DatabaseConfig.CSV_PATH, profile=None, n_workers=None):
+    """
+    Build and save the column catalog of a CSV file.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        profile (pd.DataFrame, optional): Column profiles returned by profile_column_types.
+            If None, the whole file is profiled. Defaults to None
+        n_workers (int, optional): Number of worker processes for profiling. Defaults to None
+
+    Process:
+        1. Reads the header and profiles the columns if no profile is given
+        2. Writes one row per column: field ID, instance, array index, dtype, position in the
+           CSV file, non-null count, nullability and maximum text length
+        3. Indexes the catalog by field ID and saves the size/modification time of the CSV file
+
+    Notes:
+        - The catalog is written to a temporary file and moved in place, so readers never see
+          a partial catalog
+        - Readers ignore the catalog once the CSV file changes (size or modification time)
+    """
+    column_names = _read_header(file_path)
+    if profile is None:
+        profile = profile_column_types(file_path, [col for col in column_names if col != "eid"], n_workers=n_workers)
+
+    rows = []
+    for position, col in enumerate(column_names):
+        field_id, instance, array_index = _parse_column_name(col)
+        if col == "eid":
+            rows.append((col, None, None, None, "int64", position, None, 0, None))
+            continue
+        col_profile = profile.loc[col]
+        rows.append(
+            (
+                col,
+                field_id,
+                instance,
+                array_index,
+                col_profile["dtype"],
+                position,
+                int(col_profile["non_null"]),
+                int(col_profile["nullable"]),
+                int(col_profile["max_length"]),
+            )
+        )
+
+    catalog_path = _catalog_path(file_path)
+    temp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    file_stat = os.stat(file_path)
+    conn = sqlite3.connect(temp_path)
+    try:
+        with conn:
+            conn.execute(f"""
+                CREATE TABLE {TableNames.COLUMN_CATALOG} (
+                    column_name TEXT PRIMARY KEY,
+                    field_id INTEGER,
+                    instance INTEGER,
+                    array_index INTEGER,
+                    dtype TEXT NOT NULL,
+                    csv_position INTEGER NOT NULL UNIQUE,
+                    non_null INTEGER,
+                    nullable INTEGER,
+                    max_length INTEGER
+                );
+            """)
+            conn.executemany(f"INSERT INTO {TableNames.COLUMN_CATALOG} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+            conn.execute(
+                f"CREATE INDEX idx_{TableNames.COLUMN_CATALOG}_field ON {TableNames.COLUMN_CATALOG} "
+                "(field_id, instance, array_index);"
+            )
+            conn.execute("CREATE TABLE CatalogSource (file_size INTEGER, file_mtime INTEGER);")
+            conn.execute("INSERT INTO CatalogSource VALUES (?, ?);", (file_stat.st_size, file_stat.st_mtime_ns))
+    finally:
+        conn.close()
+    os.replace(temp_path, catalog_path)
+    print(f"Column catalog of {len(rows)} columns has been saved to {catalog_path}")
+
+
+def _open_catalog(file_path=DatabaseConfig.CSV_PATH):
+    """
+    Open the column catalog if it exists and is up to date.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        sqlite3.Connection or None: Read-only connection to the catalog, or None if there is no valid catalog
+    """
+    catalog_path = _catalog_path(file_path)
+    if not os.path.exists(catalog_path):
+        return None
+    conn = sqlite3.connect(f"file:{catalog_path}?mode=ro", uri=True)
+    file_size, file_mtime = conn.execute("SELECT file_size, file_mtime FROM CatalogSource;").fetchone()
+    file_stat = os.stat(file_path)
+    if file_size != file_stat.st_size or file_mtime != file_stat.st_mtime_ns:
+        conn.close()
+        print(f"Column catalog of {file_path} is outdated and will not be used")
+        return None
+    return conn
+
+
+def query_column_catalog(field_ids=None, file_path=DatabaseConfig.CSV_PATH, column_names=None):
+    """
+    Look up columns in the column catalog.
+
+    Args:
+        field_ids (list, optional): Field IDs to look up. If None, all fields. Defaults to None
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        column_names (list, optional): Column names to look up instead of field IDs. Defaults to None
+
+    Returns:
+        pd.DataFrame: One row per column with column_name, field_id, instance, array_index, dtype,
+            csv_position, non_null, nullable and max_length, in CSV order. eid is only included when
+            it is requested by name or all fields are requested
+
+    Raises:
+        FileNotFoundError: If there is no valid catalog for the CSV file
+    """
+    conn = _open_catalog(file_path)
+    if conn is None:
+        raise FileNotFoundError(f"No valid column catalog exists for {file_path}, run generate_column_defs first")
+    try:
+        query = f"SELECT * FROM {TableNames.COLUMN_CATALOG}"
+        params = []
+        if column_names is not None:
+            params = list(column_names)
+            query += f" WHERE column_name IN ({', '.join('?' for _ in params)})"
+        elif field_ids is not None:
+            params = [int(field_id) for field_id in field_ids]
+            query += f" WHERE field_id IN ({', '.join('?' for _ in params)})"
+        return pd.read_sql_query(f"{query} ORDER BY csv_position;", conn, params=params)
+    finally:
+        conn.close()
+
+
+def _usecols(target_column_names, file_path=DatabaseConfig.CSV_PATH):
+    """
+    Columns to pass as usecols when reading the CSV file: positions from the catalog if it is valid, else names.
+
+    Args:
+        target_column_names (list): Column names to read, eid is always included
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        list: CSV positions (int) or column names, eid first
+    """
+    column_names = ["eid", *[col for col in target_column_names if col != "eid"]]
+    if not os.path.exists(_catalog_path(file_path)):
+        return column_names
+    try:
+        catalog = query_column_catalog(file_path=file_path, column_names=column_names)
+    except FileNotFoundError:
+        return column_names
+    if len(catalog) < len(set(column_names)):
+        missing_columns = sorted(set(column_names) - set(catalog["column_name"]))
+        raise ValueError(f"Columns {missing_columns} are not in the CSV file")
+    return catalog["csv_position"].tolist()
 
 
 def get_column_names(file_path=DatabaseConfig.CSV_PATH):
@@ -55,11 +790,25 @@ def get_column_names(file_path=DatabaseConfig.CSV_PATH):
 
     Returns:
         list: List of column names from the CSV header
+
+    Notes:
+        - Taken from the manifest of the Parquet mirror or the column catalog if they exist
     """
-    with open(file_path, "r", newline="") as csvfile:
-        reader = csv.reader(csvfile)
-        column_names = next(reader)
-    return column_names
+    manifest = _load_mirror_manifest(file_path)
+    if manifest is not None:
+        return manifest["columns"]
+    conn = _open_catalog(file_path)
+    if conn is not None:
+        try:
+            return [
+                row[0]
+                for row in conn.execute(
+                    f"SELECT column_name FROM {TableNames.COLUMN_CATALOG} ORDER BY csv_position;"
+                )
+            ]
+        finally:
+            conn.close()
+    return _read_header(file_path)
 
 
 def gen_column_names(target_column_ids, file_path=DatabaseConfig.CSV_PATH):
@@ -72,7 +821,16 @@ def gen_column_names(target_column_ids, file_path=DatabaseConfig.CSV_PATH):
 
     Returns:
         list: List of corresponding column names, excluding 'eid' column
+
+    Notes:
+        - Looked up by field ID in the column catalog if it exists, otherwise the header is scanned
     """
+    if os.path.exists(_catalog_path(file_path)):
+        try:
+            return query_column_catalog(target_column_ids, file_path)["column_name"].tolist()
+        except FileNotFoundError:
+            pass
+
     column_names = get_column_names(file_path)
     target_column_names = []
     for column_name in column_names:
@@ -104,16 +862,22 @@ def peek_data(
 
     Returns:
         pandas.DataFrame: DataFrame containing the preview data
+
+    Notes:
+        - Reads only the target columns from the Parquet mirror if it exists
     """
-    # * We specify all dtypes to be object, so that no error will be raised if some columns only have NA values.
-    # * If we only want first few rows, we don't need to use dd.read_csv, but pd.read_csv instead
-    df = pd.read_csv(
-        file_path,
-        usecols=["eid", *target_column_names],
-        header=0,
-        dtype={"eid": "int64", **{col: "object" for col in target_column_names}},
-        nrows=nrows,
-    )
+    if _load_mirror_manifest(file_path) is not None:
+        df = next(read_mirror(target_column_names, file_path, chunk_size=nrows, nrows=nrows))
+    else:
+        # * We specify all dtypes to be object, so that no error will be raised if some columns only have NA values.
+        # * If we only want first few rows, we don't need to use dd.read_csv, but pd.read_csv instead
+        df = pd.read_csv(
+            file_path,
+            usecols=_usecols(target_column_names, file_path),
+            header=0,
+            dtype={"eid": "int64", **{col: "object" for col in target_column_names}},
+            nrows=nrows,
+        )
 
     # After reading the data, convert columns to numeric if possible
     for col in df.columns:
@@ -136,6 +900,220 @@ def peek_data(
     return df
 
 
+def _load_column_types(file_path=DatabaseConfig.CSV_PATH):
+    """
+    Load the inferred data type of every column, if available.
+
+    Args:
+        file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        dict: Mapping from column name to "int64", "float64", "date" or "object". Empty if
+            neither the Parquet mirror nor the column catalog exist
+    """
+    manifest = _load_mirror_manifest(file_path)
+    if manifest is not None:
+        return manifest["column_types"]
+    conn = _open_catalog(file_path)
+    if conn is not None:
+        try:
+            return dict(
+                conn.execute(f"SELECT column_name, dtype FROM {TableNames.COLUMN_CATALOG} WHERE field_id IS NOT NULL;")
+            )
+        finally:
+            conn.close()
+    return {}
+
+
+def _convert_partition(partition, column_types):
+    """
+    Convert the numeric columns of a partition read as str. Runs on each partition in parallel.
+
+    Args:
+        partition (pd.DataFrame): Partition read from the CSV file
+        column_types (dict): Mapping from column name to "int64", "float64", "date" or "object"
+
+    Returns:
+        pd.DataFrame: Partition with int64 columns as nullable Int64 and float64 columns as float64
+    """
+    partition = partition.copy()
+    for col in partition.columns:
+        if col == "eid":
+            continue
+        if column_types.get(col) == "int64":
+            partition[col] = pd.to_numeric(partition[col]).astype("Int64")
+        elif column_types.get(col) == "float64":
+            partition[col] = pd.to_numeric(partition[col]).astype("float64")
+    return partition
+
+
+class DataQuery:
+    """
+    Lazy query over the main CSV file, or its Parquet mirror if it exists.
+
+    Nothing is read until the result is requested. The column selection and the eid filter
+    are applied while the file is scanned, so memory scales with the size of the result
+    instead of the size of the file.
+
+    Attributes:
+        file_path (str): Path to the CSV file
+        target_column_names (list): Columns to read, eid is always included
+        eids (list or None): eids to keep, None keeps all rows
+        blocksize (str or int): Size of each CSV partition
+        scheduler (str): Dask scheduler used to scan and convert the partitions in parallel
+
+    Example:
+        >>> query = DataQuery().select(gen_column_names([21000])).filter_eids(query_eids())
+        >>> df = query.to_pandas()
+        >>> for chunk in query.iter_chunks():
+        ...     pass
+        >>> query.to_csv("ethnicity.csv")
+    """
+
+    def __init__(self, file_path=DatabaseConfig.CSV_PATH, blocksize="64MB", scheduler="processes"):
+        """
+        Initialize a query that selects all columns and all rows.
+
+        Args:
+            file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+            blocksize (str or int, optional): Size of each CSV partition. Defaults to "64MB"
+            scheduler (str, optional): Dask scheduler, "processes" or "threads". Defaults to "processes"
+        """
+        self.file_path = file_path
+        self.target_column_names = None
+        self.eids = None
+        self.blocksize = blocksize
+        self.scheduler = scheduler
+
+    def select(self, target_column_names):
+        """
+        Select the columns to read.
+
+        Args:
+            target_column_names (list): List of column names to extract from the CSV
+
+        Returns:
+            DataQuery: New query with the column selection
+        """
+        query = copy.copy(self)
+        query.target_column_names = [col for col in target_column_names if col != "eid"]
+        return query
+
+    def filter_eids(self, eids):
+        """
+        Keep only the rows of specific participants.
+
+        Args:
+            eids (list): List of specific eids to filter the data
+
+        Returns:
+            DataQuery: New query with the eid filter
+
+        Raises:
+            ValueError: If eids is not a list
+        """
+        if not isinstance(eids, list):
+            raise ValueError("eids must be a list")
+        query = copy.copy(self)
+        query.eids = eids
+        return query
+
+    def _get_target_column_names(self):
+        if self.target_column_names is None:
+            return [col for col in get_column_names(self.file_path) if col != "eid"]
+        return self.target_column_names
+
+    def _to_dask(self):
+        """
+        Build the lazy dask DataFrame that scans the CSV file.
+
+        Returns:
+            dask.dataframe.DataFrame: Filtered and converted partitions
+        """
+        target_column_names = self._get_target_column_names()
+        ddf = dd.read_csv(
+            self.file_path,
+            usecols=_usecols(target_column_names, self.file_path),
+            header=0,
+            blocksize=self.blocksize,
+            dtype={"eid": "int64", **{col: "object" for col in target_column_names}},
+        )
+        ddf = ddf[["eid", *target_column_names]]
+        if self.eids is not None:
+            ddf = ddf[ddf["eid"].isin(self.eids)]
+        column_types = _load_column_types(self.file_path)
+        return ddf.map_partitions(_convert_partition, column_types, meta=_convert_partition(ddf._meta, column_types))
+
+    def iter_chunks(self, chunk_size=10000):
+        """
+        Read the result chunk by chunk.
+
+        Args:
+            chunk_size (int, optional): Number of rows in each chunk when reading the Parquet
+                mirror. The CSV file is read one partition at a time. Defaults to 10000
+
+        Yields:
+            pd.DataFrame: Chunk of the result
+        """
+        target_column_names = self._get_target_column_names()
+        if _load_mirror_manifest(self.file_path) is not None:
+            yield from read_mirror(target_column_names, self.file_path, eids=self.eids, chunk_size=chunk_size)
+        else:
+            for partition in self._to_dask().to_delayed():
+                yield partition.compute(scheduler="sync")
+
+    def to_pandas(self, drop_NA=False):
+        """
+        Read the whole result into a pandas DataFrame.
+
+        Args:
+            drop_NA (bool, optional): Whether to drop columns with all NA values. Defaults to False
+
+        Returns:
+            pd.DataFrame: DataFrame containing requested columns and filtered rows
+        """
+        if _load_mirror_manifest(self.file_path) is not None:
+            df = pd.concat(self.iter_chunks(), ignore_index=True)
+        else:
+            df = self._to_dask().compute(scheduler=self.scheduler)
+
+        # Drop all columns with all NA values, even if the row is in the eids list
+        if drop_NA:
+            cols_to_drop = [col for col in df.columns if col != "eid" and df[col].isna().all()]
+            df = df.drop(columns=cols_to_drop)
+        return df
+
+    def to_csv(self, output_path):
+        """
+        Write the result to a CSV file without loading it at once.
+
+        Args:
+            output_path (str): Path to the output CSV file
+        """
+        for i, chunk in enumerate(self.iter_chunks()):
+            chunk.to_csv(output_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        print(f"Query result has been saved to {output_path}")
+
+    def to_parquet(self, output_path):
+        """
+        Write the result to a Parquet file without loading it at once.
+
+        Args:
+            output_path (str): Path to the output Parquet file
+        """
+        writer = None
+        try:
+            for chunk in self.iter_chunks():
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        print(f"Query result has been saved to {output_path}")
+
+
 def get_data(
     target_column_names, file_path=DatabaseConfig.CSV_PATH, eids=None, drop_NA=False
 ):
@@ -149,9 +1127,9 @@ def get_data(
         drop_NA (bool, optional): Whether to drop columns with all NA values. Defaults to False
 
     Process:
-        1. Reads data efficiently using dask for large datasets
-        2. Filters rows by eids if provided
-        3. Converts string columns to numeric where possible
+        1. Builds a lazy DataQuery with the column selection and the eid filter
+        2. Scans the file by partitions in parallel, filtering rows by eids on the fly
+        3. Converts numeric columns in each partition based on the inferred column types
         4. Removes columns containing only NA values if drop_NA is True
 
     Returns:
@@ -159,75 +1137,82 @@ def get_data(
 
     Raises:
         ValueError: If eids is provided but is not a list
-    """
-
-    df = dd.read_csv(
-        file_path,
-        usecols=["eid", *target_column_names],
-        header=0,
-        sample=1000000,  # Uses 1MB for each block during sampling to determine dtypes
-        sample_rows=100,  # Number of rows that need to read in each block
-        dtype={"eid": "int64", **{col: "object" for col in target_column_names}},
-    ).compute()
 
+    Notes:
+        - Reads only the target columns from the Parquet mirror if it exists
+        - Use DataQuery directly to iterate over chunks or write the result to disk
+    """
+    query = DataQuery(file_path).select(target_column_names)
     if eids is not None:
-        if not isinstance(eids, list):
-            raise ValueError("eids must be a list")
-        df = df[df["eid"].isin(eids)]
+        query = query.filter_eids(eids)
+    return query.to_pandas(drop_NA=drop_NA)
 
-    for col in tqdm(df.columns, desc="Converting columns to numeric if possible"):
-        if col != "eid" and df[col].dtype == "string":
-            try:
-                converted = pd.to_numeric(df[col])
-                df[col] = converted
-            except ValueError:
-                pass
 
-    # Drop all rows with all NA values, even if the row is in the eids list
-    if drop_NA:
-        cols_to_drop = [
-            col for col in df.columns if col != "eid" and df[col].isna().all()
-        ]
-        df = df.drop(columns=cols_to_drop)
-    return df
-
-
-def generate_column_defs(file_path=DatabaseConfig.CSV_PATH):
+def generate_column_defs(file_path=DatabaseConfig.CSV_PATH, n_workers=None):
     """
-    Generate and save definitions for all columns in a CSV file to a pickle file.
+    Generate the definitions of all columns in a CSV file and save them to the column catalog.
 
     Args:
         file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+        n_workers (int, optional): Number of worker processes for type inference.
+            If None, all cores available to the process but one. Defaults to None
 
     Process:
         1. Gets all column names
-        2. Reads data sample to determine column data types
-        3. Generates column definitions (name and dtype)
-        4. Saves definitions to pickle a file
+        2. Profiles the whole file in parallel to determine column data types
+        3. Saves the column definitions and profiles to the column catalog, see build_column_catalog
 
     Returns:
-        None: Saves column definitions to file specified in DatabaseConfig.COLUMN_DEFS_PATH
+        None: Saves the catalog next to the CSV file, where sql_utils and the readers of this
+            module look up columns by field ID
     """
-    column_names = get_column_names(file_path)
+    column_names = [col for col in _read_header(file_path) if col != "eid"]
     print("Detecting data types of all columns")
-    df = peek_data(column_names, file_path)
-    # get the definitions of all columns
+    profile = profile_column_types(file_path, column_names, n_workers=n_workers)
     print("Generating column definitions")
-    column_defs = []
-    for col in df.columns:
-        column_defs.append(f"{col} {df[col].dtype}")
+    build_column_catalog(file_path, profile)
 
-    with open(DatabaseConfig.COLUMN_DEFS_PATH, "wb") as file:
-        pickle.dump(column_defs, file)
 
-    print(f"Column definitions have been saved to {DatabaseConfig.COLUMN_DEFS_PATH}.")
+def _summarize_continuous(df, event_col_name, columns):
+    """
+    Grouped count, mean and standard deviation of continuous columns, in one aggregation.
+
+    Args:
+        df (pd.DataFrame): Data with the event column
+        event_col_name (str): Name of the event column
+        columns (list[str]): Continuous columns to summarize
+
+    Returns:
+        pd.DataFrame: Index is the event value, columns are (column, "count" | "mean" | "std")
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=FutureWarning)
+        return df.groupby(event_col_name)[list(columns)].agg(["count", "mean", "std"])
+
 
 # This function is verified using R
 def create_descriptive_stats(
-    df, event_col_name, filter_cols=None, order=None
+    df, event_col_name, filter_cols=None, order=None, n_workers=1
 ):
     """
     Create descriptive statistics tables for continuous and categorical variables
+
+    Args:
+        df (pd.DataFrame): Data with the event column (0/1)
+        event_col_name (str): Name of the event column
+        filter_cols (list[str], optional): Columns to leave out. Defaults to None
+        order (list[str], optional): Order of the variables in the output. Defaults to None
+        n_workers (int, optional): Number of processes for the continuous summaries, useful for
+            wide HRV tables. Defaults to 1
+
+    Returns:
+        dict: Mapping from variable name to its "stats", "p_value", "missing_rate" and "missing_n"
+
+    Notes:
+        - Counts, means and standard deviations of all continuous columns come from one grouped
+          aggregation. Welch's t-tests are computed from these summaries for all columns at once
+        - Each categorical column needs one value_counts for its stats and one crosstab of the
+          observed values for the chi-square test
     """
     descriptive_stats = {}
 
@@ -236,56 +1221,63 @@ def create_descriptive_stats(
 
     continuous_cols = df.select_dtypes(include=["float64", "int64"]).columns
     categorical_cols = df.select_dtypes(include=["object", "category"]).columns
+    missing_n = df.isna().sum()
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=FutureWarning)
+    # * Here we will analyze by the CVD status
+    if n_workers > 1 and len(continuous_cols) > n_workers:
+        column_blocks = np.array_split(np.asarray(continuous_cols), n_workers)
+        tasks = [(df[[event_col_name, *[col for col in block if col != event_col_name]]], event_col_name, block) for block in column_blocks]
+        with Pool(n_workers) as pool:
+            summary = pd.concat(pool.starmap(_summarize_continuous, tasks), axis=1)
+    else:
+        summary = _summarize_continuous(df, event_col_name, continuous_cols)
 
-        # * Here we will analyze by the CVD status
-        for col in continuous_cols:
-            # remove NaN values
-            num_na = df[col].isna().sum()
+    # two sample t-test for independent samples, from the summaries of the two groups
+    with np.errstate(divide="ignore", invalid="ignore"):
+        group_stats = summary.reindex([0, 1])
+        means, stds, counts = (
+            group_stats.xs(stat, axis=1, level=1)[continuous_cols].to_numpy(dtype=float) for stat in ["mean", "std", "count"]
+        )
+        _, p_values = stats.ttest_ind_from_stats(
+            means[0], stds[0], counts[0], means[1], stds[1], counts[1], equal_var=False
+        )
+    p_values = pd.Series(p_values, index=continuous_cols)
 
-            numeric_stats = (
-                df.groupby(event_col_name)[col].agg(["count", "mean", "std"]).round(1)
-            )
-            numeric_stats["count"] = numeric_stats["count"].apply(
-                lambda x: f"{int(x):,d}"
-            )  # add comma as thousand separator
-            no_event = df[df[event_col_name] == 0][col].dropna()
-            event = df[df[event_col_name] == 1][col].dropna()
-            _, p_val = stats.ttest_ind(
-                no_event, event, equal_var=False
-            )  # two sample t-test for independent samples -> statistic, pvalue
-            descriptive_stats[col] = {
-                "stats": numeric_stats,
-                "p_value": p_val,
-                "missing_rate": num_na / len(df),
-                "missing_n": num_na,
-            }
-
-        for col in categorical_cols:
-            # remove NaN values
-            num_na = df[col].isna().sum()
-
-            categorical_counts = df.groupby(event_col_name)[col].value_counts()
-            categorical_freqs = (
-                df.groupby(event_col_name)[col].value_counts(normalize=True).mul(100).round(1)
-            )  # frequency in percentage
-
-            categorical_stats = pd.concat(
-                [categorical_counts, categorical_freqs], axis=1
-            ).apply(lambda x: f"{int(x[0]):,d} ({x[1]:.2f}%)", axis=1)
-
-            contingency = pd.crosstab(df[col], df[event_col_name])
-            _, p_val, _, _ = stats.chi2_contingency(
-                contingency
-            )  # Chi-square test ->statistic, pvalue, dof, expected_freq
-            descriptive_stats[col] = {
-                "stats": categorical_stats,
-                "p_value": p_val,
-                "missing_rate": num_na / len(df),
-                "missing_n": num_na,
-            }
+    summary = summary.round(1)
+    for col in continuous_cols:
+        numeric_stats = summary[col].copy()
+        numeric_stats.columns.name = None
+        numeric_stats["count"] = numeric_stats["count"].map(lambda x: f"{int(x):,d}")  # add comma as thousand separator
+        descriptive_stats[col] = {
+            "stats": numeric_stats,
+            "p_value": p_values[col],
+            "missing_rate": missing_n[col] / len(df),
+            "missing_n": missing_n[col],
+        }
+
+    for col in categorical_cols:
+        # unused categories are kept with a count of 0, as in the output of value_counts
+        categorical_counts = df.groupby(event_col_name, observed=False)[col].value_counts()
+        group_totals = categorical_counts.groupby(level=0, observed=False).transform("sum")
+        categorical_freqs = (categorical_counts / group_totals).fillna(0).mul(100).round(1)  # frequency in percentage
+
+        categorical_stats = (
+            categorical_counts.map(lambda x: f"{int(x):,d}") + categorical_freqs.map(lambda x: f" ({x:.2f}%)")
+        )
+        categorical_stats.name = None
+
+        # only observed values enter the chi-square test, unused categories would give empty rows
+        contingency = pd.crosstab(df[col], df[event_col_name])
+        contingency = contingency.loc[contingency.sum(axis=1) > 0, contingency.sum(axis=0) > 0]
+        _, p_val, _, _ = stats.chi2_contingency(
+            contingency
+        )  # Chi-square test ->statistic, pvalue, dof, expected_freq
+        descriptive_stats[col] = {
+            "stats": categorical_stats,
+            "p_value": p_val,
+            "missing_rate": missing_n[col] / len(df),
+            "missing_n": missing_n[col],
+        }
 
     if order:
         descriptive_stats_ordered = {}
@@ -0,0 +1,336 @@
+"""
+Vectorized derivation of processed variables.
+
+This module declares the variables of the PROCESSED table that are derived from the
+CONFOUNDERS, ECG and HRV tables. Each variable is declared either as a SQL expression
+or as a pandas function over the source columns, so the whole cohort is computed at once
+and written with one batched statement per variable, instead of one UPDATE per subject.
+
+Outcomes and medication flags (CVD, CVD_date, statins) are derived from the long tables
+created by sql_utils.generate_long_table, by prefix matching on the indexed code column
+and a group-min over the dates, so other event definitions can be derived in seconds.
+
+Note:
+    The rules follow src/step1_process_csv/analyze_variables.ipynb,
+    src/step1_process_csv/analyze_ICD.ipynb and src/step2_process_ECG/analyze_HRV.ipynb.
+
+Dependencies:
+    - sqlite3: For database operations
+    - pandas: For vectorized computation
+"""
+
+import fnmatch
+import pandas as pd
+from .constants import DatabaseConfig, TableNames, ConnectionProfiles, EventDefinitions
+from .sql_utils import db_connection, update_column
+
+
+class DerivedVariable:
+    """
+    Declaration of a variable derived from one source table.
+
+    Attributes:
+        name (str): Column name in the target table
+        sql_type (str): SQL type of the column, including the default value if any
+        source_table (str): Table that provides the inputs. Must have the eid column
+        source_columns (list[str]): Glob patterns of the input columns, e.g. "6150-0.*".
+            Only used by compute
+        sql_expression (str): SQL expression over the source table that gives the value
+        compute (callable): Function that takes a DataFrame of the source columns indexed
+            by eid and returns a Series of values indexed by eid
+        description (str): Short description of the variable
+
+    Notes:
+        - Exactly one of sql_expression and compute must be given
+        - Rows of the target table that are missing from the source table keep the default value
+    """
+
+    def __init__(
+        self,
+        name,
+        sql_type,
+        source_table,
+        source_columns=None,
+        sql_expression=None,
+        compute=None,
+        description="",
+    ):
+        if (sql_expression is None) == (compute is None):
+            raise ValueError(f"Variable {name}: exactly one of sql_expression and compute must be given")
+        self.name = name
+        self.sql_type = sql_type
+        self.source_table = source_table
+        self.source_columns = source_columns or []
+        self.sql_expression = sql_expression
+        self.compute = compute
+        self.description = description
+
+    def evaluate(self, cursor, primary_key="eid"):
+        """
+        Compute the variable for every subject of the source table.
+
+        Args:
+            cursor (sqlite3.Cursor): SQLite cursor
+            primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+        Returns:
+            pd.Series: Values indexed by the primary key
+        """
+        if self.sql_expression is not None:
+            cursor.execute(f"SELECT {primary_key}, {self.sql_expression} FROM {self.source_table};")
+            rows = cursor.fetchall()
+            return pd.Series([row[1] for row in rows], index=[row[0] for row in rows], name=self.name, dtype=object)
+
+        cursor.execute(f"PRAGMA table_info({self.source_table});")
+        existing_columns = [row[1] for row in cursor.fetchall()]
+        columns = [
+            col for col in existing_columns if any(fnmatch.fnmatchcase(col, pattern) for pattern in self.source_columns)
+        ]
+        cursor.execute(f"SELECT {primary_key}, {', '.join(f'`{col}`' for col in columns)} FROM {self.source_table};")
+        df = pd.DataFrame(cursor.fetchall(), columns=[primary_key, *columns]).set_index(primary_key)
+        return self.compute(df).rename(self.name)
+
+
+def _compute_BMI(df):
+    """BMI from standing height (cm, field 50) and weight (kg, field 21002)."""
+    height = pd.to_numeric(df["50-0.0"])
+    body_weight = pd.to_numeric(df["21002-0.0"])
+    return (body_weight / (height / 100) ** 2).round(4)
+
+
+def _compute_hypertension_treatment(df):
+    """
+    Hypertension treatment from self-reported diseases (6150) and medications (6153 for female, 6177 for male).
+    1 if blood pressure medication or high blood pressure is reported, NULL if both answers are unknown.
+    """
+    disease_reported = df.filter(regex=r"^6150-0\.")
+    medication = df.filter(regex=r"^(6153|6177)-0\.")
+
+    # 6153/6177: 2 -> Blood pressure medication, -1 -> Do not know, -3 -> Prefer not to answer
+    # 6150: 4 -> High blood pressure, -7 -> None of the above, -3 -> Prefer not to answer
+    hypertension_treatment = medication.isin([2]).any(axis=1) | disease_reported.isin([4]).any(axis=1)
+
+    medication_unknown = medication.isin([-1, -3]).any(axis=1)
+    disease_unknown = disease_reported.isin([-3, -7]).any(axis=1)
+    return hypertension_treatment.astype(int).astype(object).where(~(medication_unknown & disease_unknown), None)
+
+
+DERIVED_VARIABLES = {
+    variable.name: variable
+    for variable in [
+        DerivedVariable(
+            "ethnicity",
+            "INTEGER",
+            TableNames.CONFOUNDERS,
+            # same rule as the notebook: the last digit of the ethnic background code
+            sql_expression="CAST(substr(CAST(`21000-0.0` AS TEXT), -1) AS INTEGER)",
+            description="Ethnic background (field 21000)",
+        ),
+        DerivedVariable(
+            "BMI",
+            "REAL",
+            TableNames.CONFOUNDERS,
+            source_columns=["50-0.0", "21002-0.0"],
+            compute=_compute_BMI,
+            description="Body mass index in kg/m^2",
+        ),
+        DerivedVariable(
+            "birth_date",
+            "DATE",
+            TableNames.CONFOUNDERS,
+            # * SQL doesn't allow we only specify the year and month. We will use 01 as the placeholder.
+            sql_expression="""
+                CASE WHEN `34-0.0` IS NOT NULL AND `52-0.0` IS NOT NULL
+                THEN printf('%d-%02d-01', `34-0.0`, `52-0.0`) END
+            """,
+            description="Birth date from year (34) and month (52) of birth",
+        ),
+        DerivedVariable(
+            "hypertension_treatment",
+            "INTEGER DEFAULT 0",
+            TableNames.CONFOUNDERS,
+            source_columns=["6150-0.*", "6153-0.*", "6177-0.*"],
+            compute=_compute_hypertension_treatment,
+            description="Treatment for hypertension (fields 6150, 6153, 6177)",
+        ),
+        DerivedVariable(
+            "test_status",
+            "INTEGER DEFAULT 1",
+            TableNames.ECG,
+            # 6019: 1 -> bike used, 6020: 1 -> test completed
+            sql_expression="CASE WHEN `6019-0.0` = 1 AND `6020-0.0` = 1 THEN 1 ELSE 0 END",
+            description="Whether the subject used the bike and completed the fitness test",
+        ),
+        DerivedVariable(
+            "HRV_available",
+            "INTEGER DEFAULT 0",
+            TableNames.HRV_TIME,
+            sql_expression="1",
+            description="Whether HRV indices were extracted for the subject",
+        ),
+    ]
+}
+
+
+def _add_missing_columns(cursor, table_name, column_defs):
+    """
+    Add the columns that do not exist yet in a table.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        table_name (str): Name of the table
+        column_defs (dict): Mapping from column name to its SQL type
+    """
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    for column_name, sql_type in column_defs.items():
+        if column_name not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN `{column_name}` {sql_type};")
+
+
+def derive_variables(
+    variable_names=None,
+    target_table=TableNames.PROCESSED,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Compute derived variables for all subjects and write them into the target table.
+
+    Args:
+        variable_names (list[str], optional): Names of variables in DERIVED_VARIABLES to derive.
+            If None, all declared variables are derived. Defaults to None
+        target_table (str, optional): Table to write into. Defaults to TableNames.PROCESSED
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Process:
+        1. Adds the column to the target table if it does not exist yet
+        2. Computes the variable for the whole source table at once
+        3. Writes the values with one batched executemany
+
+    Raises:
+        ValueError: If a variable name is not declared in DERIVED_VARIABLES
+    """
+    if variable_names is None:
+        variable_names = list(DERIVED_VARIABLES.keys())
+    unknown_names = [name for name in variable_names if name not in DERIVED_VARIABLES]
+    if unknown_names:
+        raise ValueError(f"Unknown derived variables: {unknown_names}")
+
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+        _add_missing_columns(cursor, target_table, {name: DERIVED_VARIABLES[name].sql_type for name in variable_names})
+
+        for name in variable_names:
+            variable = DERIVED_VARIABLES[name]
+            values = variable.evaluate(cursor, primary_key)
+            n_rows = update_column(cursor, target_table, name, values, primary_key)
+            print(f"Variable {name} has been derived for {n_rows} subjects")
+
+
+def derive_event(
+    name="CVD",
+    code_prefixes=EventDefinitions.CVD_ICD10_PREFIXES,
+    date_name="CVD_date",
+    long_table=TableNames.ICD_LONG,
+    target_table=TableNames.PROCESSED,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Derive an event flag and the date of its earliest diagnosis from a long diagnosis table.
+
+    Args:
+        name (str, optional): Column of the event flag. Defaults to "CVD"
+        code_prefixes (list[str], optional): Code prefixes that define the event.
+            Defaults to EventDefinitions.CVD_ICD10_PREFIXES
+        date_name (str, optional): Column of the earliest diagnosis date. If None, no date is derived.
+            Defaults to "CVD_date"
+        long_table (str, optional): Long table with code and date columns. Defaults to TableNames.ICD_LONG
+        target_table (str, optional): Table to write into. Defaults to TableNames.PROCESSED
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Process:
+        1. Adds the columns to the target table if they do not exist yet, and resets them
+        2. Finds the earliest date of every subject with a matching code in one grouped query
+        3. Writes the flag and the date
+
+    Notes:
+        - Codes are matched with GLOB '<prefix>*', which can use the index on the code column
+        - Use other names and prefixes for sensitivity analyses, e.g. derive_event("CVD_IHD", ["I20", "I21"], "CVD_IHD_date")
+    """
+    column_defs = {name: "INTEGER DEFAULT 0"}
+    if date_name is not None:
+        column_defs[date_name] = "DATE"
+    match_sql = " OR ".join(["code GLOB ?"] * len(code_prefixes))
+    match_params = [f"{prefix}*" for prefix in code_prefixes]
+
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+
+        # * Step1/3: Add and reset the columns
+        _add_missing_columns(cursor, target_table, column_defs)
+        reset_sql = ", ".join([f"`{name}` = 0", *([f"`{date_name}` = NULL"] if date_name is not None else [])])
+        cursor.execute(f"UPDATE {target_table} SET {reset_sql};")
+
+        # * Step2/3: Group-min over the matching diagnoses
+        cursor.execute(
+            f"""
+            SELECT {primary_key}, MIN(date) FROM {long_table}
+            WHERE {match_sql}
+            GROUP BY {primary_key};
+            """,
+            match_params,
+        )
+        rows = cursor.fetchall()
+        eids = [row[0] for row in rows]
+
+        # * Step3/3: Write the flag and the date
+        n_rows = update_column(cursor, target_table, name, pd.Series(1, index=eids, dtype=object), primary_key)
+        if date_name is not None:
+            update_column(cursor, target_table, date_name, pd.Series([row[1] for row in rows], index=eids, dtype=object), primary_key)
+
+    print(f"Event {name} has been derived: {n_rows} subjects have the event")
+
+
+def derive_medication(
+    name="statins",
+    codes=EventDefinitions.STATIN_CODES,
+    instances=(0,),
+    long_table=TableNames.MEDICATION_LONG,
+    target_table=TableNames.PROCESSED,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Derive a medication flag from a long treatment table.
+
+    Args:
+        name (str, optional): Column of the medication flag. Defaults to "statins"
+        codes (list[int], optional): Treatment codes of the medication. Defaults to EventDefinitions.STATIN_CODES
+        instances (tuple[int], optional): Assessment instances to use. Defaults to (0,), the baseline visit
+        long_table (str, optional): Long table with the treatment codes. Defaults to TableNames.MEDICATION_LONG
+        target_table (str, optional): Table to write into. Defaults to TableNames.PROCESSED
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+    """
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+        _add_missing_columns(cursor, target_table, {name: "INTEGER DEFAULT 0"})
+        cursor.execute(
+            f"""
+            UPDATE {target_table}
+            SET `{name}` = {primary_key} IN (
+                SELECT {primary_key} FROM {long_table}
+                WHERE instance IN ({", ".join(["?"] * len(instances))})
+                AND code IN ({", ".join(["?"] * len(codes))})
+            );
+            """,
+            [*instances, *codes],
+        )
+        cursor.execute(f"SELECT COUNT(*) FROM {target_table} WHERE `{name}` = 1;")
+        n_rows = cursor.fetchone()[0]
+
+    print(f"Medication {name} has been derived: {n_rows} subjects take the medication")
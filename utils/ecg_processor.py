@@ -1,6 +1,15 @@
+import itertools
 import os
+from functools import partial
+from multiprocessing import Pool, cpu_count
 import numpy as np
+import pandas as pd
+import scipy.signal
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MultipleLocator
+from tqdm import tqdm
 import xmltodict
 from xml.parsers.expat import ExpatError
 import datetime
@@ -8,6 +17,68 @@ import neurokit2 as nk
 
 from .constants import DatabaseConfig
 
+LEADS = ["I", "2", "3"]
+# * Values of the lead argument that combine the R-peaks of all LEADS
+MULTI_LEAD_STRATEGIES = ["consensus", "best"]
+
+
+def ecg_file_path(data_dir, subject):
+    """
+    Path to the full-disclosure ECG XML file of a subject (data field 6025, instance 0).
+
+    Args:
+        data_dir (str): Directory containing ECG files
+        subject (str | int): Subject identifier
+
+    Returns:
+        str: Path to <subject>_6025_0_0.xml
+    """
+    return os.path.join(data_dir, f"{subject}_6025_0_0.xml")
+
+
+def sweep_configs(
+    stages=("noload",),
+    leads=("2",),
+    clean_methods=("neurokit",),
+    peak_methods=("neurokit",),
+):
+    """
+    Grid of HRV processing configurations.
+
+    Args:
+        stages (list[str], optional): Stages, see ECG_Processor.get_signal_stage.
+            Defaults to ("noload",)
+        leads (list[str], optional): Leads, or strategies in MULTI_LEAD_STRATEGIES.
+            Defaults to ("2",)
+        clean_methods (list[str], optional): Methods of nk.ecg_clean. Defaults to ("neurokit",)
+        peak_methods (list[str], optional): Methods of nk.ecg_peaks. Defaults to ("neurokit",)
+
+    Returns:
+        list[dict]: One configuration per combination, with keys stage, lead, clean_method
+            and peak_method. Configurations sharing a cleaned signal are adjacent.
+    """
+    return [
+        {"stage": stage, "lead": lead, "clean_method": clean, "peak_method": peak}
+        for stage, lead, clean, peak in itertools.product(
+            stages, leads, clean_methods, peak_methods
+        )
+    ]
+
+
+def config_tag(config):
+    """
+    Short name of a processing configuration, e.g. noload_2_neurokit_neurokit.
+
+    Args:
+        config (dict): Configuration, see sweep_configs
+
+    Returns:
+        str: <stage>_<lead>_<clean_method>_<peak_method>
+    """
+    return "_".join(
+        str(config[key]) for key in ["stage", "lead", "clean_method", "peak_method"]
+    )
+
 
 class ECG_Reader:
     """
@@ -210,7 +281,7 @@ class ECG_Processor:
         if not self.check_data():
             raise FileNotFoundError("ECG data does not exist for the subject")
 
-        xml_file = os.path.join(self.data_dir, f"{self.subject}_6025_0_0.xml")
+        xml_file = ecg_file_path(self.data_dir, self.subject)
         try:
             xml_reader = ECG_Reader(xml_file)
             self.signals = xml_reader.get_lead_signals()  # load all leads
@@ -252,9 +323,7 @@ class ECG_Processor:
         Returns:
             bool: True if data file exists, False otherwise
         """
-        return os.path.exists(
-            os.path.join(self.data_dir, f"{self.subject}_6025_0_0.xml")
-        )
+        return os.path.exists(ecg_file_path(self.data_dir, self.subject))
 
     def get_info(self):
         """
@@ -328,7 +397,173 @@ class ECG_Processor:
 
         return lead_signal_stage
 
-    def process_signal(self, stage_name, lead="2"):
+    def clean_signal(self, stage_name, lead="2", method="neurokit"):
+        """
+        Clean the ECG signal of a stage.
+
+        Args:
+            stage_name (str): Name of the stage, see get_signal_stage
+            lead (str | list[str], optional): Lead to clean, or several leads to clean
+                together. Defaults to "2"
+            method (str, optional): Cleaning method of nk.ecg_clean. Defaults to "neurokit"
+
+        Returns:
+            np.ndarray: Cleaned signal, or 2D array with one row per lead if several
+                leads are given
+
+        Note:
+            With the "neurokit" method, several leads are filtered by one call on the 2D
+            array, with the same filters as nk.ecg_clean
+        """
+        if isinstance(lead, str):
+            lead_signal_stage = self.get_signal_stage(stage_name, lead)
+            return nk.ecg_clean(
+                lead_signal_stage, sampling_rate=self.sampling_rate, method=method
+            )
+
+        lead_signals = np.vstack(
+            [self.get_signal_stage(stage_name, lead_name) for lead_name in lead]
+        ).astype(float)
+        if method in ["nk", "nk2", "neurokit", "neurokit2"]:
+            return _ecg_clean_neurokit_2d(lead_signals, self.sampling_rate)
+        return np.vstack(
+            [
+                nk.ecg_clean(row, sampling_rate=self.sampling_rate, method=method)
+                for row in lead_signals
+            ]
+        )
+
+    def detect_peaks(self, cleaned_signal, method="neurokit"):
+        """
+        Detect the R-peaks of a cleaned ECG signal.
+
+        Args:
+            cleaned_signal (np.ndarray): Signal returned by clean_signal
+            method (str, optional): Peak detection method of nk.ecg_peaks.
+                Defaults to "neurokit"
+
+        Returns:
+            pd.DataFrame: R-peak indicator in column ECG_R_Peaks, as nk.ecg_process
+
+        Note:
+            Artifacts are corrected as in nk.ecg_process
+        """
+        peaks, _ = nk.ecg_peaks(
+            cleaned_signal,
+            sampling_rate=self.sampling_rate,
+            method=method,
+            correct_artifacts=True,
+        )
+        return peaks
+
+    def detect_multilead_peaks(
+        self,
+        cleaned_signals,
+        leads=LEADS,
+        method="neurokit",
+        strategy="consensus",
+        tolerance_ms=50,
+        min_leads=2,
+    ):
+        """
+        Detect the R-peaks of several leads and combine them into one series.
+
+        Args:
+            cleaned_signals (np.ndarray): Cleaned signals, one row per lead
+            leads (list[str], optional): Lead of every row. Defaults to LEADS
+            method (str, optional): Peak detection method of nk.ecg_peaks.
+                Defaults to "neurokit"
+            strategy (str, optional): How to combine the leads. Defaults to "consensus"
+                - 'consensus': R-peaks found in at least min_leads leads
+                - 'best': R-peaks of the lead with the highest quality
+            tolerance_ms (float, optional): Maximum distance between the R-peaks of the
+                same beat in different leads. Defaults to 50
+            min_leads (int, optional): Number of leads a consensus R-peak must be found
+                in. Defaults to 2
+
+        Returns:
+            tuple: (pd.DataFrame, dict)
+                - R-peak indicator in column ECG_R_Peaks, as detect_peaks
+                - strategy actually used, leads ranked by quality and quality per lead
+
+        Raises:
+            ValueError: If R-peaks could not be detected in any lead
+
+        Note:
+            - Quality is the mean correlation between each beat and the median beat
+            - A failing lead is skipped. The consensus falls back to the best lead if
+              fewer than min_leads leads have R-peaks, or if the leads agree on less than
+              half of the beats of the best lead
+            - A consensus R-peak is placed where the best lead has it
+        """
+        if strategy not in MULTI_LEAD_STRATEGIES:
+            raise ValueError(f"Invalid strategy: {strategy}")
+
+        rpeaks = {}
+        quality = {}
+        for lead, cleaned_signal in zip(leads, cleaned_signals):
+            try:
+                _, info = nk.ecg_peaks(
+                    cleaned_signal,
+                    sampling_rate=self.sampling_rate,
+                    method=method,
+                    correct_artifacts=True,
+                )
+            except (OSError, MemoryError):
+                raise
+            except Exception:
+                continue
+            lead_rpeaks = np.asarray(info["ECG_R_Peaks"], dtype=int)
+            if len(lead_rpeaks) < 2:
+                continue
+            rpeaks[lead] = lead_rpeaks
+            quality[lead] = _beat_template_quality(
+                cleaned_signal, lead_rpeaks, self.sampling_rate
+            )
+        if not rpeaks:
+            raise ValueError("R-peaks could not be detected in any lead")
+
+        ranked_leads = sorted(rpeaks, key=lambda lead: quality[lead], reverse=True)
+        used_strategy = "best"
+        peak_indices = rpeaks[ranked_leads[0]]
+        if strategy == "consensus" and len(ranked_leads) >= min_leads:
+            consensus_indices = _consensus_peaks(
+                [rpeaks[lead] for lead in ranked_leads],
+                tolerance=int(tolerance_ms / 1000 * self.sampling_rate),
+                min_leads=min_leads,
+            )
+            if len(consensus_indices) >= 0.5 * len(peak_indices):
+                used_strategy = "consensus"
+                peak_indices = consensus_indices
+
+        peak_indicator = np.zeros(cleaned_signals.shape[1], dtype=int)
+        peak_indicator[peak_indices] = 1
+        peaks = pd.DataFrame({"ECG_R_Peaks": peak_indicator})
+        peak_info = {
+            "strategy": used_strategy,
+            "leads": ranked_leads if used_strategy == "consensus" else ranked_leads[:1],
+            "quality": quality,
+        }
+        return peaks, peak_info
+
+    def compute_hrv(self, peaks):
+        """
+        Calculate HRV metrics from R-peaks.
+
+        Args:
+            peaks (pd.DataFrame): R-peaks returned by detect_peaks
+
+        Returns:
+            tuple: hrv_time, hrv_freq and hrv_nonlinear DataFrames
+        """
+        hrv_time = nk.hrv_time(peaks, sampling_rate=self.sampling_rate)
+        hrv_freq = nk.hrv_frequency(peaks, sampling_rate=self.sampling_rate)
+        hrv_nonlinear = nk.hrv_nonlinear(peaks, sampling_rate=self.sampling_rate)
+        return hrv_time, hrv_freq, hrv_nonlinear
+
+    def process_signal(
+        self, stage_name, lead="2", clean_method="neurokit", peak_method="neurokit"
+    ):
         """
         Process ECG signal for a specific stage and calculate HRV metrics.
 
@@ -338,7 +573,13 @@ class ECG_Processor:
                 - 'constant': 2 minute phase at constant power
                 - 'ramp': Linear increase over 4 minutes from Start to Peak power
                 - 'noload': 1 minute recovery period
-            lead (str, optional): Lead to process. Defaults to "2"
+            lead (str, optional): Lead to process, or a strategy in MULTI_LEAD_STRATEGIES
+                to process all leads and combine their R-peaks, see
+                detect_multilead_peaks. Defaults to "2"
+            clean_method (str, optional): Cleaning method of nk.ecg_clean.
+                Defaults to "neurokit"
+            peak_method (str, optional): Peak detection method of nk.ecg_peaks.
+                Defaults to "neurokit"
 
         Returns:
             tuple: Three DataFrames containing:
@@ -352,27 +593,133 @@ class ECG_Processor:
         Note:
             Uses neurokit2 for signal processing and HRV calculation
             See: https://neuropsychology.github.io/NeuroKit/functions/hrv.html
+            Only the cleaning and peak detection steps of nk.ecg_process are run, as the
+            HRV metrics only depend on the R-peaks.
         """
         if stage_name not in self.stage_time.keys():
             raise ValueError(f"Invalid stage: {stage_name}")
 
-        lead_signal_stage = self.get_signal_stage(stage_name, lead)
-
         # Start processing the signal
-        peaks, _ = nk.ecg_process(
-            lead_signal_stage, sampling_rate=self.sampling_rate
-        )  # clean + peak detection + HR calculation + Quality assessment + QRS Complex delineation
+        if lead in MULTI_LEAD_STRATEGIES:
+            cleaned_signals = self.clean_signal(stage_name, LEADS, clean_method)
+            peaks, peak_info = self.detect_multilead_peaks(
+                cleaned_signals, LEADS, peak_method, strategy=lead
+            )
+            print(
+                f"Subject {self.subject}: R-peaks from {peak_info['strategy']} of leads {peak_info['leads']}"
+            )
+        else:
+            cleaned_signal = self.clean_signal(stage_name, lead, clean_method)
+            peaks = self.detect_peaks(cleaned_signal, peak_method)
 
         # Calculate HRV metrics
-        hrv_time = nk.hrv_time(peaks, sampling_rate=self.sampling_rate)
-        hrv_freq = nk.hrv_frequency(peaks, sampling_rate=self.sampling_rate)
-        hrv_nonlinear = nk.hrv_nonlinear(peaks, sampling_rate=self.sampling_rate)
+        hrv_time, hrv_freq, hrv_nonlinear = self.compute_hrv(peaks)
 
         print(f"Subject {self.subject}: Successfully processed {stage_name} signal for lead {lead}")
         return hrv_time, hrv_freq, hrv_nonlinear
 
+    def process_sweep(self, configs):
+        """
+        Calculate HRV metrics for several processing configurations of the loaded ECG.
+
+        Args:
+            configs (list[dict]): Configurations with keys stage, lead, clean_method and
+                peak_method, see sweep_configs
+
+        Returns:
+            list[dict]: One result per configuration, in the same order, with keys
+                config, success, and time, freq and nonlinear or error
+
+        Raises:
+            OSError, MemoryError: Errors not caused by the data are not caught
+
+        Note:
+            Intermediate results are shared between configurations: the signal is cleaned
+            once per (stage, lead, clean_method) and its peaks detected once per
+            peak_method. The multi-lead strategies share one cleaning of all leads.
+            A failed step fails all configurations that share it.
+        """
+        cleaned_signals = {}
+        peak_series = {}
+
+        def memoized(cache, key, func):
+            if key not in cache:
+                try:
+                    cache[key] = func()
+                except (OSError, MemoryError):
+                    raise
+                except Exception as e:
+                    cache[key] = e
+            if isinstance(cache[key], Exception):
+                raise cache[key]
+            return cache[key]
+
+        results = []
+        for config in configs:
+            multi_lead = config["lead"] in MULTI_LEAD_STRATEGIES
+            clean_leads = tuple(LEADS) if multi_lead else config["lead"]
+            clean_key = (config["stage"], clean_leads, config["clean_method"])
+            peak_key = (
+                config["stage"],
+                config["lead"],
+                config["clean_method"],
+                config["peak_method"],
+            )
+            try:
+                if config["stage"] not in self.stage_time.keys():
+                    raise ValueError(f"Invalid stage: {config['stage']}")
+                cleaned_signal = memoized(
+                    cleaned_signals,
+                    clean_key,
+                    lambda: self.clean_signal(*clean_key),
+                )
+                if multi_lead:
+                    peaks = memoized(
+                        peak_series,
+                        peak_key,
+                        lambda: self.detect_multilead_peaks(
+                            cleaned_signal, LEADS, config["peak_method"], config["lead"]
+                        )[0],
+                    )
+                else:
+                    peaks = memoized(
+                        peak_series,
+                        peak_key,
+                        lambda: self.detect_peaks(
+                            cleaned_signal, config["peak_method"]
+                        ),
+                    )
+                hrv_time, hrv_freq, hrv_nonlinear = self.compute_hrv(peaks)
+                results.append(
+                    {
+                        "config": config,
+                        "success": True,
+                        "time": hrv_time,
+                        "freq": hrv_freq,
+                        "nonlinear": hrv_nonlinear,
+                    }
+                )
+            except (OSError, MemoryError):
+                raise
+            except Exception as e:
+                results.append({"config": config, "success": False, "error": str(e)})
+
+        n_success = sum(result["success"] for result in results)
+        print(
+            f"Subject {self.subject}: Successfully processed {n_success}/{len(configs)} configurations"
+        )
+        return results
+
     @staticmethod
-    def plot_ecg_signal(signal, time=None, sampling_rate=500):
+    def plot_ecg_signal(
+        signal,
+        time=None,
+        sampling_rate=500,
+        panel_seconds=10,
+        max_points=4000,
+        panel_size=(15, 3),
+        fig=None,
+    ):
         """
         Plot ECG signal with a standardized grid layout.
 
@@ -380,18 +727,28 @@ class ECG_Processor:
         - Major grid lines in red at 0.2s intervals
         - Minor grid lines in black at 0.04s intervals
         - Time axis in milliseconds
-        - Automatic figure sizing based on signal length
+        - Long signals tiled into panels of fixed size and duration, one per row
 
         Args:
             signal (np.ndarray): ECG signal values
-            time (np.ndarray, optional): Time points corresponding to signal values.
+            time (np.ndarray, optional): Time points in ms corresponding to signal values.
                 If None, time will be generated based on sampling rate.
             sampling_rate (int, optional): Sampling frequency in Hz.
                 Used when time is not provided. Defaults to 500.
+            panel_seconds (float, optional): Duration shown by each panel. If None, the
+                whole signal is shown in one panel. Defaults to 10, an ECG strip.
+            max_points (int, optional): Maximum number of points drawn per panel. Longer
+                panels are reduced to their min/max envelope. Defaults to 4000.
+            panel_size (tuple, optional): (width, height) of each panel in inches.
+                Defaults to (15, 3).
+            fig (matplotlib.figure.Figure, optional): Figure to draw into, e.g. a Figure
+                with an Agg canvas for headless rendering. If None, a pyplot figure is
+                created. Defaults to None.
 
         Returns:
-            tuple: (matplotlib.figure.Figure, matplotlib.axes.Axes)
-                The created figure and axes objects
+            tuple: (matplotlib.figure.Figure, matplotlib.axes.Axes | np.ndarray)
+                The figure, and the axes if there is one panel or the array of axes
+                of the panels otherwise
 
         Raises:
             ValueError: If time is provided and its length doesn't match signal length
@@ -400,34 +757,361 @@ class ECG_Processor:
             Grid implementation based on standard ECG paper:
             - Major grid lines at 0.2s intervals
             - Minor grid lines at 0.04s intervals
+            If a panel is too long for this grid, the spacing is multiplied by 5 until
+            the lines can be told apart (1s/0.2s, 5s/1s, ...).
             Reference: https://www.indigits.com/post/2022/10/ecg_python/
         """
+        signal = np.asarray(signal)
         if time is not None:
             if len(time) != len(signal):
                 raise ValueError("Time and signal should have the same length")
+            time = np.asarray(time, dtype=float)
         else:
             time = np.arange(len(signal)) / sampling_rate * 1000  # unit: ms
 
-        fig = plt.figure(figsize=(max(15, len(time) / sampling_rate * 10), 3))
-        ax = plt.axes()
-        ax.plot(time, signal)
+        # Split the signal into panels of equal duration
+        min_t = time[0]
+        if panel_seconds is None:
+            panel_ms = max(time[-1] - min_t, 1)
+            n_panels = 1
+        else:
+            panel_ms = panel_seconds * 1000
+            n_panels = int((time[-1] - min_t) // panel_ms) + 1
+        panel_bounds = np.searchsorted(time, min_t + np.arange(n_panels + 1) * panel_ms)
+        panel_bounds[-1] = len(time)
 
-        # Setup major and minor ticks
-        min_t = int(np.min(time))
-        max_t = int(np.max(time))
-        major_ticks = np.arange(min_t, max_t + 1, sampling_rate / 10)
-        ax.set_xticks(major_ticks)
+        if fig is None:
+            fig = plt.figure(figsize=(panel_size[0], panel_size[1] * n_panels))
+        else:
+            fig.set_size_inches(panel_size[0], panel_size[1] * n_panels)
+        axes = fig.subplots(n_panels, 1, squeeze=False)[:, 0]
 
         min_y = np.min(signal)
         max_y = np.max(signal)
-        minor_ticks = np.arange(min_y, max_y + 1, 10)
-        ax.set_yticks(minor_ticks)
+        for i, ax in enumerate(axes):
+            start, end = panel_bounds[i], panel_bounds[i + 1]
+            panel_time, panel_signal = _minmax_envelope(
+                time[start:end], signal[start:end], max_points
+            )
+            ax.plot(panel_time, panel_signal, linewidth=0.8)
+
+            panel_start = min_t + i * panel_ms
+            ax.set_xlim(panel_start, panel_start + panel_ms)
+            ax.set_ylim(min_y, max(max_y, min_y + 1))
+
+            # Setup major and minor grid lines, drawn as one collection per kind instead
+            # of one line per tick, so that long recordings stay fast to render
+            major_x, minor_x = _ecg_grid_spacing(panel_ms, minor=40, max_major_lines=60)
+            major_y, minor_y = _ecg_grid_spacing(
+                max_y - min_y, minor=10, max_major_lines=10
+            )
+            x_range = ax.get_xlim()
+            y_range = ax.get_ylim()
+            # Make the major grid
+            _draw_grid_lines(
+                ax, x_range, y_range, major_x, major_y, color="red", linewidth=1.0
+            )
+            # Make the minor grid, skipping the lines of the major grid
+            _draw_grid_lines(
+                ax,
+                x_range,
+                y_range,
+                minor_x,
+                minor_y,
+                skip_every=5,
+                linestyle=":",
+                color="black",
+                linewidth=0.5,
+            )
+
+            # Label every major line, or fewer if the labels would overlap
+            label_every = max(1, round(panel_ms / major_x / 15))
+            ax.xaxis.set_major_locator(MultipleLocator(major_x * label_every))
+            ax.yaxis.set_major_locator(MultipleLocator(major_y))
+            ax.set_ylabel("Amplitude")
+        axes[-1].set_xlabel("Time (ms)")
+        # Fixed margins in inches, so every panel has the same size
+        height = panel_size[1] * n_panels
+        fig.subplots_adjust(
+            left=0.8 / panel_size[0],
+            right=1 - 0.2 / panel_size[0],
+            bottom=0.6 / height,
+            top=1 - 0.4 / height,
+            hspace=0.45,
+        )
+
+        return fig, axes[0] if n_panels == 1 else axes
 
-        # Make the major grid
-        ax.grid(which="major", linestyle="-", color="red", linewidth="1.0")
-        # Make the minor grid
-        ax.grid(which="minor", linestyle=":", color="black", linewidth="0.5")
 
-        plt.xlabel("Time (ms)")
-        plt.ylabel("Amplitude")
-        return fig, ax
+def _ecg_clean_neurokit_2d(signals, sampling_rate, powerline=50):
+    """
+    Clean several leads at once with the filters of nk.ecg_clean(method="neurokit").
+
+    Args:
+        signals (np.ndarray): Signals, one row per lead
+        sampling_rate (int): Sampling rate in Hz
+        powerline (int, optional): Powerline frequency in Hz. Defaults to 50
+
+    Returns:
+        np.ndarray: Cleaned signals, identical to cleaning each row with nk.ecg_clean
+    """
+    # Remove slow drift and dc offset with highpass Butterworth
+    sos = scipy.signal.butter(5, 0.5, btype="highpass", output="sos", fs=sampling_rate)
+    cleaned = scipy.signal.sosfiltfilt(sos, signals, axis=-1)
+
+    # Remove powerline noise with a moving average over one period
+    b = np.ones(int(sampling_rate / powerline)) if sampling_rate >= 100 else np.ones(2)
+    return scipy.signal.filtfilt(b, [len(b)], cleaned, axis=-1, method="pad")
+
+
+def _beat_template_quality(cleaned_signal, rpeaks, sampling_rate):
+    """
+    Quality of a lead: mean correlation between each beat and the median beat.
+
+    Args:
+        cleaned_signal (np.ndarray): Cleaned signal of the lead
+        rpeaks (np.ndarray): Indices of the R-peaks
+        sampling_rate (int): Sampling rate in Hz
+
+    Returns:
+        float: Quality between -1 and 1, or 0 if there are fewer than 3 complete beats
+    """
+    offsets = np.arange(-int(0.2 * sampling_rate), int(0.4 * sampling_rate))
+    rpeaks = rpeaks[
+        (rpeaks + offsets[0] >= 0) & (rpeaks + offsets[-1] < len(cleaned_signal))
+    ]
+    if len(rpeaks) < 3:
+        return 0.0
+
+    beats = cleaned_signal[rpeaks[:, None] + offsets[None, :]]
+    template = np.median(beats, axis=0)
+    beats = beats - beats.mean(axis=1, keepdims=True)
+    template = template - template.mean()
+    norms = np.linalg.norm(beats, axis=1) * np.linalg.norm(template)
+    correlations = beats @ template / np.where(norms > 0, norms, np.inf)
+    return float(correlations.mean())
+
+
+def _consensus_peaks(peak_lists, tolerance, min_leads):
+    """
+    R-peaks found in at least min_leads of the leads.
+
+    Args:
+        peak_lists (list[np.ndarray]): R-peak indices of every lead, best lead first
+        tolerance (int): Maximum distance in samples between the R-peaks of one beat
+        min_leads (int): Number of leads a beat must be found in
+
+    Returns:
+        np.ndarray: Sorted R-peak indices, taken from the best lead that found the beat
+    """
+    positions = np.concatenate(peak_lists)
+    lead_ranks = np.concatenate(
+        [np.full(len(peaks), rank) for rank, peaks in enumerate(peak_lists)]
+    )
+    order = np.lexsort((lead_ranks, positions))
+    positions, lead_ranks = positions[order], lead_ranks[order]
+
+    # R-peaks closer than the tolerance belong to the same beat
+    beat_ids = np.concatenate([[0], np.cumsum(np.diff(positions) > tolerance)])
+    n_beats = beat_ids[-1] + 1
+
+    # Count the distinct leads of every beat
+    beat_leads = np.unique(beat_ids * len(peak_lists) + lead_ranks)
+    n_leads = np.bincount(beat_leads // len(peak_lists), minlength=n_beats)
+
+    # Position in the best lead of every beat
+    order = np.lexsort((lead_ranks, beat_ids))
+    first_of_beat = np.concatenate([[True], np.diff(beat_ids[order]) > 0])
+    beat_positions = positions[order][first_of_beat]
+
+    return np.sort(beat_positions[n_leads >= min_leads])
+
+
+def _minmax_envelope(time, signal, max_points):
+    """
+    Reduce a signal to the minimum and maximum of each of max_points / 2 bins.
+
+    Args:
+        time (np.ndarray): Time points
+        signal (np.ndarray): Signal values
+        max_points (int): Maximum number of returned points
+
+    Returns:
+        tuple: (time, signal) of the envelope, or the inputs if they are short enough
+
+    Note:
+        Both extremes of every bin are kept in their original order, so QRS peaks and
+        artifacts remain visible at any zoom level, unlike with plain decimation.
+    """
+    n = len(signal)
+    n_bins = max_points // 2
+    if n <= max_points or n_bins == 0:
+        return time, signal
+
+    bin_size = int(np.ceil(n / n_bins))
+    n_bins = int(np.ceil(n / bin_size))
+    # Pad with the last value, so the bins can be reshaped into a 2D array
+    padded = np.concatenate([signal, np.repeat(signal[-1], n_bins * bin_size - n)])
+    bins = padded.reshape(n_bins, bin_size)
+
+    bin_starts = np.arange(n_bins) * bin_size
+    idx_min = np.minimum(bin_starts + bins.argmin(axis=1), n - 1)
+    idx_max = np.minimum(bin_starts + bins.argmax(axis=1), n - 1)
+    idx = np.column_stack([np.minimum(idx_min, idx_max), np.maximum(idx_min, idx_max)])
+    idx = idx.ravel()
+    return time[idx], signal[idx]
+
+
+def _draw_grid_lines(ax, x_range, y_range, x_step, y_step, skip_every=None, **kwargs):
+    """
+    Draw vertical and horizontal grid lines at multiples of x_step and y_step.
+
+    Args:
+        ax (matplotlib.axes.Axes): Axes
+        x_range (tuple): (min, max) of the time axis
+        y_range (tuple): (min, max) of the amplitude axis
+        x_step (float): Spacing of the vertical lines
+        y_step (float): Spacing of the horizontal lines
+        skip_every (int, optional): Skip every n-th line, e.g. where the major grid is
+            drawn already. Defaults to None
+        **kwargs: Style of the lines, passed to Axes.vlines and Axes.hlines
+    """
+    x_multiples = np.arange(np.ceil(x_range[0] / x_step), np.floor(x_range[1] / x_step) + 1)
+    y_multiples = np.arange(np.ceil(y_range[0] / y_step), np.floor(y_range[1] / y_step) + 1)
+    if skip_every is not None:
+        x_multiples = x_multiples[x_multiples % skip_every != 0]
+        y_multiples = y_multiples[y_multiples % skip_every != 0]
+    ax.vlines(x_multiples * x_step, *y_range, zorder=0, **kwargs)
+    ax.hlines(y_multiples * y_step, *x_range, zorder=0, **kwargs)
+
+
+def _ecg_grid_spacing(span, minor, max_major_lines):
+    """
+    Spacing of the major and minor grid lines, as on ECG paper (major = 5 * minor).
+
+    Args:
+        span (float): Range covered by the axis
+        minor (float): Spacing of the minor lines at full detail
+        max_major_lines (int): Maximum number of major lines
+
+    Returns:
+        tuple: (major, minor) spacing, the full-detail spacing multiplied by a power of 5
+    """
+    while span / (5 * minor) > max_major_lines:
+        minor *= 5
+    return 5 * minor, minor
+
+
+def _render_qc_image(eid, data_dir, output_dir, stage, lead, panel_seconds, dpi, overwrite):
+    """
+    Render the ECG signal of one subject to a PNG file, without pyplot.
+
+    Args:
+        eid (int): Subject identifier
+        data_dir (str): Directory containing ECG files
+        output_dir (str): Directory of the images
+        stage (str): Stage to render, or None for the whole recording
+        lead (str): Lead to render
+        panel_seconds (float): Duration shown by each panel
+        dpi (int): Resolution of the image
+        overwrite (bool): Whether to render images that already exist
+
+    Returns:
+        dict: success, eid and path of the image, or error
+    """
+    output_path = os.path.join(
+        output_dir, f"{eid}_{stage or 'full'}_lead{lead}.png"
+    )
+    if not overwrite and os.path.exists(output_path):
+        return {"success": True, "eid": eid, "path": output_path}
+
+    try:
+        ecg_processor = ECG_Processor(data_dir=data_dir, subject=str(eid))
+        if ecg_processor.signals is None:
+            raise FileNotFoundError("ECG data does not exist for the subject")
+        if stage is None:
+            signal = ecg_processor.get_raw_signals(lead)
+        else:
+            signal = ecg_processor.get_signal_stage(stage, lead)
+
+        # A Figure with an Agg canvas is not registered in pyplot, so it is freed after
+        # saving and does not need a display
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        _, axes = ECG_Processor.plot_ecg_signal(
+            signal,
+            sampling_rate=ecg_processor.sampling_rate,
+            panel_seconds=panel_seconds,
+            max_points=int(2 * 15 * dpi),  # two points per pixel column
+            panel_size=(15, 2),
+            fig=fig,
+        )
+        first_ax = axes if isinstance(axes, plt.Axes) else axes[0]
+        first_ax.set_title(f"Subject {eid}, lead {lead}, {stage or 'full recording'}")
+        fig.savefig(output_path, dpi=dpi)
+        return {"success": True, "eid": eid, "path": output_path}
+    except Exception as e:
+        return {"success": False, "eid": eid, "error": str(e)}
+
+
+def render_qc_images(
+    eids,
+    output_dir,
+    data_dir=DatabaseConfig.ECG_FOLDER,
+    stage=None,
+    lead="2",
+    panel_seconds=60,
+    dpi=100,
+    overwrite=False,
+    n_workers=None,
+):
+    """
+    Render QC images of the ECG signals of many subjects in parallel, on the headless Agg backend.
+
+    Args:
+        eids (list[int]): Subject identifiers
+        output_dir (str): Directory of the images, <eid>_<stage>_lead<lead>.png
+        data_dir (str, optional): Directory containing ECG files.
+            Defaults to DatabaseConfig.ECG_FOLDER
+        stage (str, optional): Stage to render, see ECG_Processor.get_signal_stage.
+            If None, the whole recording is rendered. Defaults to None
+        lead (str, optional): Lead to render. Defaults to "2"
+        panel_seconds (float, optional): Duration shown by each panel. Defaults to 60,
+            so a full recording fits in about 7 rows
+        dpi (int, optional): Resolution of the images. Defaults to 100
+        overwrite (bool, optional): Whether to render images that already exist.
+            Defaults to False
+        n_workers (int, optional): Number of processes. Defaults to cpu_count() - 1
+
+    Returns:
+        pd.DataFrame: One row per subject with columns eid, success, path and error
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if n_workers is None:
+        n_workers = max(1, cpu_count() - 1)
+    render_func = partial(
+        _render_qc_image,
+        data_dir=data_dir,
+        output_dir=output_dir,
+        stage=stage,
+        lead=lead,
+        panel_seconds=panel_seconds,
+        dpi=dpi,
+        overwrite=overwrite,
+    )
+
+    results = []
+    with Pool(n_workers) as pool:
+        pbar = tqdm(
+            pool.imap_unordered(render_func, eids, chunksize=8),
+            total=len(eids),
+            desc="Rendering ECG QC images",
+        )
+        for result in pbar:
+            results.append(result)
+            if not result["success"]:
+                print(f"Error rendering ECG for eid {result['eid']}: {result['error']}")
+
+    cnt_success = sum(result["success"] for result in results)
+    print(f"QC images rendered for {cnt_success}/{len(eids)} subjects in {output_dir}")
+    return pd.DataFrame(results, columns=["eid", "success", "path", "error"])
@@ -0,0 +1,362 @@
+"""
+Concordance index and bootstrap evaluation of survival models.
+
+This module evaluates risk scores of the exported test split with Harrell's and Uno's
+concordance index. Both are computed in O(n log^2 n) with vectorized dominance counting
+instead of comparing all pairs, and bootstrap resamples run in parallel processes that
+read the data from shared memory.
+
+Note:
+    Higher risk scores should mean earlier events, as the predictions of the Cox, RSF and
+    XGBoost models in step4_build_survival_model.
+
+Dependencies:
+    - numpy: For vectorized counting
+    - pandas: For reading the predictions
+    - multiprocessing: For parallel bootstrap
+"""
+
+import os
+from multiprocessing import Pool, cpu_count, shared_memory
+import numpy as np
+import pandas as pd
+
+
+def _prefix_dominance_counts(ranks, prefix_lengths, query_ranks):
+    """
+    Count, for each query, the elements before a position whose rank is smaller or equal.
+
+    Args:
+        ranks (np.ndarray): Integer ranks of the elements, in position order
+        prefix_lengths (np.ndarray): For each query, only positions [0, prefix_length) are counted
+        query_ranks (np.ndarray): Rank of each query
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Number of elements with a smaller rank, and with the same rank
+
+    Notes:
+        - The prefix [0, g) is the union of one aligned block of size 2^L for every bit L set in g.
+          For every level, the ranks are sorted within blocks once and all queries are answered
+          with a vectorized binary search, so the cost is O(n log^2 n)
+    """
+    n = len(ranks)
+    base = np.int64(n + 1)
+    positions = np.arange(n, dtype=np.int64)
+    less = np.zeros(len(prefix_lengths), dtype=np.int64)
+    equal = np.zeros(len(prefix_lengths), dtype=np.int64)
+
+    level = 0
+    while (1 << level) <= n:
+        keys = np.sort((positions >> level) * base + ranks)
+        has_block = ((prefix_lengths >> level) & 1) == 1
+        block_keys = ((prefix_lengths[has_block] >> level) - 1) * base
+        query_keys = block_keys + query_ranks[has_block]
+        start = np.searchsorted(keys, block_keys, side="left")
+        lo = np.searchsorted(keys, query_keys, side="left")
+        hi = np.searchsorted(keys, query_keys, side="right")
+        less[has_block] += lo - start
+        equal[has_block] += hi - lo
+        level += 1
+    return less, equal
+
+
+def _concordance_counts(time, event, risk):
+    """
+    Count concordant, risk-tied and comparable pairs for every subject with an event.
+
+    A pair (i, j) is comparable if subject i has an event and t_i < t_j, or t_i == t_j and j is censored.
+    It is concordant if risk_i > risk_j.
+
+    Args:
+        time (np.ndarray): Follow-up times
+        event (np.ndarray): Event indicators (1 = event, 0 = censored)
+        risk (np.ndarray): Risk scores
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Indices of the subjects with an event,
+            and their numbers of concordant, risk-tied and comparable pairs
+    """
+    n = len(time)
+    event = event.astype(bool)
+    time_ids = np.unique(time, return_inverse=True)[1].astype(np.int64).ravel()
+    risk_ranks = np.unique(risk, return_inverse=True)[1].astype(np.int64).ravel()
+    event_idx = np.flatnonzero(event)
+
+    # * Step1/2: subjects with a strictly longer time. Sorted by time descending, they are a prefix.
+    order = np.argsort(-time_ids, kind="stable")
+    n_longer = n - np.searchsorted(np.sort(time_ids), time_ids[event_idx], side="right")
+    concordant, tied = _prefix_dominance_counts(risk_ranks[order], n_longer, risk_ranks[event_idx])
+    comparable = n_longer.copy()
+
+    # * Step2/2: censored subjects with the same time
+    base = np.int64(n + 1)
+    censored_keys = np.sort(time_ids[~event] * base + risk_ranks[~event])
+    time_keys = time_ids[event_idx] * base
+    query_keys = time_keys + risk_ranks[event_idx]
+    start = np.searchsorted(censored_keys, time_keys, side="left")
+    lo = np.searchsorted(censored_keys, query_keys, side="left")
+    hi = np.searchsorted(censored_keys, query_keys, side="right")
+    end = np.searchsorted(censored_keys, time_keys + base, side="left")
+    concordant += lo - start
+    tied += hi - lo
+    comparable += end - start
+
+    return event_idx, concordant, tied, comparable
+
+
+def censoring_survival(time, event, eval_time):
+    """
+    Kaplan-Meier estimate of the censoring survival function G(t) = P(C > t).
+
+    Args:
+        time (np.ndarray): Follow-up times used for the estimate
+        event (np.ndarray): Event indicators. Censored subjects (0) are the "events" of G
+        eval_time (np.ndarray): Times at which G is evaluated (right-continuous step function)
+
+    Returns:
+        np.ndarray: G at eval_time
+
+    Notes:
+        - Same estimator as scikit-survival's CensoringDistributionEstimator
+    """
+    unique_time, inverse = np.unique(time, return_inverse=True)
+    n_censored = np.bincount(inverse.ravel(), weights=(1 - event.astype(bool)).astype(float), minlength=len(unique_time))
+    n_at_time = np.bincount(inverse.ravel(), minlength=len(unique_time))
+    # events at a censoring time are assumed to happen first, so they leave the risk set of C
+    n_at_risk = len(time) - np.concatenate([[0], np.cumsum(n_at_time)[:-1]]) - (n_at_time - n_censored)
+    survival = np.cumprod(1 - np.divide(n_censored, n_at_risk, out=np.zeros(len(unique_time)), where=n_censored != 0))
+
+    idx = np.searchsorted(unique_time, eval_time, side="right") - 1
+    return np.where(idx >= 0, survival[np.clip(idx, 0, None)], 1.0)
+
+
+def _c_indices(time, event, risk, tau=None, censoring_time=None, censoring_event=None):
+    """
+    Harrell's and Uno's C-index from one pass of pair counting.
+
+    Args:
+        time (np.ndarray): Follow-up times
+        event (np.ndarray): Event indicators
+        risk (np.ndarray): Risk scores
+        tau (float, optional): Truncation time of Uno's C-index. Defaults to None (no truncation)
+        censoring_time (np.ndarray, optional): Times used to estimate the censoring distribution,
+            e.g. of the train split. Defaults to None (the evaluated data)
+        censoring_event (np.ndarray, optional): Event indicators matching censoring_time. Defaults to None
+
+    Returns:
+        tuple[float, float]: Harrell's and Uno's C-index
+
+    Raises:
+        ValueError: If the censoring survival function is zero at the time of an event before tau
+    """
+    event_idx, concordant, tied, comparable = _concordance_counts(time, event, risk)
+    harrell = (concordant.sum() + 0.5 * tied.sum()) / comparable.sum()
+
+    if censoring_time is None:
+        censoring_time, censoring_event = time, event
+    event_time = time[event_idx]
+    in_window = event_time < tau if tau is not None else np.ones(len(event_idx), dtype=bool)
+    g = censoring_survival(censoring_time, censoring_event, event_time[in_window])
+    if np.any(g <= 0):
+        raise ValueError("Censoring survival function is zero at some event times, use a smaller tau")
+    weights = 1.0 / np.square(g)
+    uno = np.sum(weights * (concordant[in_window] + 0.5 * tied[in_window])) / np.sum(weights * comparable[in_window])
+    return harrell, uno
+
+
+def harrell_c_index(time, event, risk):
+    """
+    Harrell's concordance index.
+
+    Args:
+        time (array-like): Follow-up times
+        event (array-like): Event indicators (1 = event, 0 = censored)
+        risk (array-like): Risk scores, higher means earlier event
+
+    Returns:
+        float: Proportion of comparable pairs that are concordant, with ties in risk counted as 0.5
+    """
+    _, concordant, tied, comparable = _concordance_counts(np.asarray(time), np.asarray(event), np.asarray(risk))
+    return (concordant.sum() + 0.5 * tied.sum()) / comparable.sum()
+
+
+def uno_c_index(time, event, risk, tau=None, censoring_time=None, censoring_event=None):
+    """
+    Uno's concordance index with inverse probability of censoring weights.
+
+    Args:
+        time (array-like): Follow-up times
+        event (array-like): Event indicators (1 = event, 0 = censored)
+        risk (array-like): Risk scores, higher means earlier event
+        tau (float, optional): Only events before tau are used. Defaults to None
+        censoring_time (array-like, optional): Times used to estimate the censoring distribution,
+            e.g. of the train split. Defaults to None (the evaluated data)
+        censoring_event (array-like, optional): Event indicators matching censoring_time. Defaults to None
+
+    Returns:
+        float: Weighted proportion of concordant pairs, each pair weighted by G(t_i)^-2
+
+    Notes:
+        - Pairs and weights follow scikit-survival's concordance_index_ipcw
+    """
+    if censoring_time is not None:
+        censoring_time, censoring_event = np.asarray(censoring_time), np.asarray(censoring_event)
+    return _c_indices(np.asarray(time), np.asarray(event), np.asarray(risk), tau, censoring_time, censoring_event)[1]
+
+
+# Data of the bootstrap workers, attached once per process
+_worker_data = {}
+
+
+def _init_bootstrap_worker(shm_name, n, tau):
+    """Attach the shared (3, n) array of time, event and risk in a worker process."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_data["shm"] = shm  # keep a reference, the buffer is released with it
+    _worker_data["data"] = np.ndarray((3, n), dtype=np.float64, buffer=shm.buf)
+    _worker_data["tau"] = tau
+
+
+def _bootstrap_replicates(seed, replicate_ids, data=None, tau=None):
+    """
+    C-indices of bootstrap replicates.
+
+    Args:
+        seed (int): Seed of the bootstrap
+        replicate_ids (list[int]): Replicates to compute. Replicate b always uses the generator seeded
+            with (seed, b), so the result does not depend on the number of workers
+        data (np.ndarray, optional): (3, n) array of time, event and risk. Defaults to the shared array
+        tau (float, optional): Truncation time of Uno's C-index. Defaults to the one of the worker
+
+    Returns:
+        list[tuple[float, float]]: Harrell's and Uno's C-index of each replicate
+    """
+    if data is None:
+        data, tau = _worker_data["data"], _worker_data["tau"]
+    n = data.shape[1]
+    results = []
+    for b in replicate_ids:
+        idx = np.random.default_rng([seed, b]).integers(0, n, n)
+        try:
+            results.append(_c_indices(data[0, idx], data[1, idx], data[2, idx], tau))
+        except ValueError:
+            results.append((np.nan, np.nan))
+    return results
+
+
+def bootstrap_c_index(time, event, risk, n_bootstrap=200, alpha=0.05, tau=None, seed=1234, n_workers=None):
+    """
+    Harrell's and Uno's C-index with percentile bootstrap confidence intervals.
+
+    Args:
+        time (array-like): Follow-up times
+        event (array-like): Event indicators (1 = event, 0 = censored)
+        risk (array-like): Risk scores, higher means earlier event
+        n_bootstrap (int, optional): Number of bootstrap resamples. Defaults to 200
+        alpha (float, optional): 1 - confidence level. Defaults to 0.05
+        tau (float, optional): Truncation time of Uno's C-index. Defaults to None
+        seed (int, optional): Seed of the resampling. Defaults to 1234
+        n_workers (int, optional): Number of processes. Defaults to the number of CPUs minus one
+
+    Returns:
+        pd.DataFrame: Rows "harrell" and "uno", columns estimate, lower and upper
+
+    Notes:
+        - Time, event and risk are copied once into shared memory, workers only receive replicate ids
+        - Replicates where Uno's weights are undefined are left out of its interval
+    """
+    data = np.vstack([np.asarray(time, dtype=np.float64), np.asarray(event, dtype=np.float64), np.asarray(risk, dtype=np.float64)])
+    n = data.shape[1]
+    estimate = _c_indices(data[0], data[1], data[2], tau)
+
+    if n_workers is None:
+        n_workers = max(1, cpu_count() - 1)  # Leave one core free
+    n_workers = min(n_workers, n_bootstrap)
+    replicate_blocks = [block.tolist() for block in np.array_split(np.arange(n_bootstrap), n_workers * 4) if len(block)]
+
+    if n_workers == 1:
+        replicates = [result for block in replicate_blocks for result in _bootstrap_replicates(seed, block, data, tau)]
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        try:
+            np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data
+            with Pool(n_workers, initializer=_init_bootstrap_worker, initargs=(shm.name, n, tau)) as pool:
+                blocks = pool.starmap(_bootstrap_replicates, [(seed, block) for block in replicate_blocks])
+            replicates = [result for block in blocks for result in block]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    replicates = np.array(replicates, dtype=np.float64)
+    lower = np.nanquantile(replicates, alpha / 2, axis=0)
+    upper = np.nanquantile(replicates, 1 - alpha / 2, axis=0)
+    return pd.DataFrame({"estimate": estimate, "lower": lower, "upper": upper}, index=["harrell", "uno"])
+
+
+def _read_table(file_path):
+    """Read a CSV, Parquet or Feather file depending on its extension."""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".parquet":
+        return pd.read_parquet(file_path)
+    if extension == ".feather":
+        return pd.read_feather(file_path)
+    return pd.read_csv(file_path)
+
+
+def load_predictions(data_path, prediction_path, primary_key="eid", time_col="time", event_col="event"):
+    """
+    Join the exported test split with the risk scores of one or more models.
+
+    Args:
+        data_path (str): Exported test split (CSV, Parquet or Feather) with the primary key, time and event
+        prediction_path (str): File with the primary key and one risk score column per model
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        time_col (str, optional): Name of the time column. Defaults to "time"
+        event_col (str, optional): Name of the event column. Defaults to "event"
+
+    Returns:
+        pd.DataFrame: Primary key, time, event and the risk score columns
+
+    Raises:
+        ValueError: If some subjects of the test split have no prediction
+    """
+    df_data = _read_table(data_path)[[primary_key, time_col, event_col]]
+    df_pred = _read_table(prediction_path)
+    df = df_data.merge(df_pred, on=primary_key, how="left", validate="one_to_one")
+
+    score_cols = [col for col in df_pred.columns if col != primary_key]
+    n_missing = df[score_cols].isna().any(axis=1).sum()
+    if n_missing:
+        raise ValueError(f"{n_missing} subjects of {data_path} have no prediction in {prediction_path}")
+    return df
+
+
+def evaluate_predictions(
+    df, score_cols=None, time_col="time", event_col="event", n_bootstrap=200, alpha=0.05, tau=None, seed=1234, n_workers=None
+):
+    """
+    C-indices with bootstrap confidence intervals for several models.
+
+    Args:
+        df (pd.DataFrame): Output of load_predictions
+        score_cols (list[str], optional): Risk score columns to evaluate. Defaults to all columns
+            except the primary key, time and event
+        time_col (str, optional): Name of the time column. Defaults to "time"
+        event_col (str, optional): Name of the event column. Defaults to "event"
+        n_bootstrap (int, optional): Number of bootstrap resamples. Defaults to 200
+        alpha (float, optional): 1 - confidence level. Defaults to 0.05
+        tau (float, optional): Truncation time of Uno's C-index. Defaults to None
+        seed (int, optional): Seed of the resampling, shared by all models. Defaults to 1234
+        n_workers (int, optional): Number of processes. Defaults to the number of CPUs minus one
+
+    Returns:
+        pd.DataFrame: One row per (model, metric) with estimate, lower and upper
+    """
+    if score_cols is None:
+        score_cols = [col for col in df.columns if col not in ["eid", time_col, event_col]]
+
+    results = []
+    for col in score_cols:
+        result = bootstrap_c_index(df[time_col], df[event_col], df[col], n_bootstrap, alpha, tau, seed, n_workers)
+        results.append(result.rename_axis("metric").reset_index().assign(model=col))
+        print(f"{col}: Harrell's C = {result.loc['harrell', 'estimate']:.3f}, Uno's C = {result.loc['uno', 'estimate']:.3f}")
+    return pd.concat(results, ignore_index=True)[["model", "metric", "estimate", "lower", "upper"]]
@@ -0,0 +1,176 @@
+"""
+On-disk cache of per-subject HRV results.
+
+Every result of extract_HRV.process_single_subject is stored under a key that hashes
+everything the result depends on: the identity of the ECG file (name, size, modification
+time), the stage, the lead, the neurokit2 version and the processing parameters. A rerun
+after adding subjects or changing one stage only computes the keys that are not cached.
+
+Entries are gzip-compressed pickles in 256 subfolders (first two hex digits of the key),
+written atomically so that parallel workers can share the cache. The least recently used
+entries are evicted once the cache exceeds its size limit.
+
+Dependencies:
+    - pandas: For (de)serializing the HRV DataFrames
+    - neurokit2: Its version is part of the key
+"""
+
+import hashlib
+import json
+import os
+import pandas as pd
+import neurokit2 as nk
+
+from .constants import DatabaseConfig
+
+# * Bump when the processing in ECG_Processor changes in a way the parameters do not capture
+CACHE_FORMAT_VERSION = 1
+CACHE_SUFFIX = ".pkl.gz"
+
+
+def processing_params(clean_method="neurokit", peak_method="neurokit", sampling_rate=DatabaseConfig.SAMPLING_RATE):
+    """
+    Processing parameters of ECG_Processor.process_signal that are part of the cache key.
+
+    Args:
+        clean_method (str, optional): Method of nk.ecg_clean. Defaults to "neurokit"
+        peak_method (str, optional): Method of nk.ecg_peaks. Defaults to "neurokit"
+        sampling_rate (int, optional): Sampling rate in Hz. Defaults to DatabaseConfig.SAMPLING_RATE
+
+    Returns:
+        dict: Parameters, so that extract_HRV.py and sweep_HRV.py share the entries of the same configuration
+    """
+    return {"clean_method": clean_method, "peak_method": peak_method, "sampling_rate": sampling_rate}
+
+
+class HRVCache:
+    """
+    Content-addressed cache of per-subject HRV results.
+
+    Attributes:
+        cache_dir (str): Folder of the cache
+        max_bytes (int): Size above which evict() removes the least recently used entries
+
+    Note:
+        The object only holds the folder and the limit, so it can be passed to worker processes.
+    """
+
+    def __init__(self, cache_dir=DatabaseConfig.HRV_CACHE_DIR, max_bytes=DatabaseConfig.HRV_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, file_path, stage, lead, params=None):
+        """
+        Cache key of the result of one subject.
+
+        Args:
+            file_path (str): Path to the ECG XML file
+            stage (str): Stage of the test
+            lead (str): Lead
+            params (dict, optional): Processing parameters, e.g. sampling rate and methods. Defaults to None
+
+        Returns:
+            str: SHA-256 hex digest
+        """
+        try:
+            file_stat = os.stat(file_path)
+            file_identity = [os.path.basename(file_path), file_stat.st_size, file_stat.st_mtime_ns]
+        except FileNotFoundError:
+            file_identity = [os.path.basename(file_path), None, None]
+        payload = {
+            "format": CACHE_FORMAT_VERSION,
+            "file": file_identity,
+            "stage": stage,
+            "lead": lead,
+            "neurokit2": nk.__version__,
+            "params": params or {},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_path(self, key):
+        """Path to the entry of a key."""
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_SUFFIX)
+
+    def get(self, key):
+        """
+        Read a cached result.
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            dict: Cached result, or None if the key is not cached or the entry is unreadable
+        """
+        entry_path = self._entry_path(key)
+        try:
+            result = pd.read_pickle(entry_path, compression="gzip")
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+        os.utime(entry_path)  # mark as recently used for evict()
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result.
+
+        Args:
+            key (str): Cache key
+            result (dict): Result of one subject
+        """
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        pd.to_pickle(result, temp_path, compression="gzip")
+        os.replace(temp_path, entry_path)
+
+    def _entries(self):
+        """List the entries as (modification time, size, path)."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(CACHE_SUFFIX):
+                    entry_stat = entry.stat()
+                    entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """
+        Total size of the cache.
+
+        Returns:
+            tuple: (number of entries, size in bytes)
+        """
+        entries = self._entries()
+        return len(entries), sum(entry[1] for entry in entries)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            int: Number of removed entries
+        """
+        entries = sorted(self._entries())
+        total_bytes = sum(entry[1] for entry in entries)
+        n_removed = 0
+        for _, entry_size, entry_path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= entry_size
+            n_removed += 1
+        if n_removed:
+            print(f"{n_removed} HRV cache entries have been evicted, {total_bytes / 1024**2:.1f} MiB left")
+        return n_removed
+
+    def clear(self):
+        """Remove all entries."""
+        for _, _, entry_path in self._entries():
+            os.remove(entry_path)
@@ -0,0 +1,294 @@
+"""
+Persisted train/test splits and imputed analysis datasets.
+
+A split is written once to the SPLITS table (one fold per eid) together with its seed and
+stratification in SPLIT_METADATA. Imputed values are stored in an indexed table, so a train or
+test matrix, imputed or not, is assembled by a single join instead of re-reading several CSV files.
+
+Note:
+    The split reproduces export_split_data.ipynb and the imputed datasets reproduce
+    incorporate_imputation.ipynb. Subjects are taken from the materialized cohort tables of
+    cohort_utils, so the exclusion criteria are not evaluated again for every split.
+
+Dependencies:
+    - sqlite3: For database operations
+    - pandas: For data manipulation
+    - scikit-learn: For the stratified split
+"""
+
+import datetime
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from .constants import DatabaseConfig, TableNames, ConnectionProfiles
+from .cohort_utils import materialize_cohort
+from .sql_utils import (
+    db_connection,
+    build_export_query,
+    export_joined_data,
+    generate_table_from_dataframe,
+    EXPORT_TABLES,
+)
+
+FOLDS = ["train", "test"]
+
+
+def create_split(
+    split_name="main",
+    cohort="eligible",
+    test_size=0.2,
+    random_state=1234,
+    stratify_column="event",
+    overwrite=False,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Split the subjects of the joined analysis dataset into train and test folds and store the assignment.
+
+    Args:
+        split_name (str, optional): Name of the split. Defaults to "main"
+        cohort (str, optional): Name of the cohort in CohortCriteria.CRITERIA. Its table is materialized
+            or refreshed first, see cohort_utils.materialize_cohort. Defaults to "eligible"
+        test_size (float, optional): Proportion of the test fold. Defaults to 0.2
+        random_state (int, optional): Seed of the split. Defaults to 1234
+        stratify_column (str, optional): Column of STATUS to stratify on. If None, the split is not stratified.
+            Defaults to "event"
+        overwrite (bool, optional): Whether to replace an existing split with the same name. Defaults to False
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        pd.DataFrame: Assignment with columns eid and fold
+
+    Process:
+        1. Reads the eids (and the stratification column) of the subjects of the cohort table present in
+           all export tables
+        2. Splits them with train_test_split, in eid order as in export_split_data.ipynb
+        3. Stores the folds and the metadata of the split
+
+    Raises:
+        ValueError: If the split exists and overwrite is False
+        ValueError: If the cohort is not registered
+    """
+    cohort_table = materialize_cohort(cohort, db_file_path=db_file_path, primary_key=primary_key)
+    with db_connection(db_file_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TableNames.SPLITS} (
+                split_name TEXT NOT NULL,
+                {primary_key} INTEGER NOT NULL,
+                fold TEXT NOT NULL,
+                PRIMARY KEY (split_name, {primary_key}),
+                FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
+            );
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TableNames.SPLIT_METADATA} (
+                split_name TEXT PRIMARY KEY,
+                cohort TEXT,
+                test_size REAL,
+                random_state INTEGER,
+                stratify_column TEXT,
+                n_train INTEGER,
+                n_test INTEGER,
+                created_at TEXT
+            );
+        """)
+
+        split_existing = cursor.execute(
+            f"SELECT split_name FROM {TableNames.SPLIT_METADATA} WHERE split_name = ?;", (split_name,)
+        ).fetchone()
+        if split_existing:
+            if not overwrite:
+                raise ValueError(f"Split {split_name} already exists, use overwrite=True to replace it")
+            cursor.execute(f"DELETE FROM {TableNames.SPLITS} WHERE split_name = ?;", (split_name,))
+            cursor.execute(f"DELETE FROM {TableNames.SPLIT_METADATA} WHERE split_name = ?;", (split_name,))
+
+        # * Step1/3: Subjects of the joined dataset. The other tables only restrict the subjects.
+        tables = {table_name: [] for table_name in EXPORT_TABLES}
+        if stratify_column is not None:
+            tables[TableNames.STATUS] = [stratify_column]
+        query, output_columns, params = build_export_query(cursor, cohort_table, tables, None, primary_key)
+        df = pd.DataFrame(cursor.execute(query, params).fetchall(), columns=output_columns)
+
+        # * Step2/3: Stratified split
+        df_train, df_test = train_test_split(
+            df,
+            test_size=test_size,
+            random_state=random_state,
+            stratify=df[stratify_column] if stratify_column is not None else None,
+        )
+        df_split = pd.concat([df_train[[primary_key]].assign(fold="train"), df_test[[primary_key]].assign(fold="test")])
+        df_split = df_split.sort_values(primary_key, ignore_index=True)
+
+        # * Step3/3: Store the split
+        cursor.executemany(
+            f"INSERT INTO {TableNames.SPLITS} VALUES (?, ?, ?);",
+            [(split_name, int(eid), fold) for eid, fold in zip(df_split[primary_key], df_split["fold"])],
+        )
+        cursor.execute(
+            f"INSERT INTO {TableNames.SPLIT_METADATA} VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            (
+                split_name,
+                cohort,
+                test_size,
+                random_state,
+                stratify_column,
+                len(df_train),
+                len(df_test),
+                datetime.datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+
+    print(f"Split {split_name} has been created: {len(df_train)} train and {len(df_test)} test subjects")
+    return df_split
+
+
+def list_splits(db_file_path=DatabaseConfig.DB_PATH):
+    """
+    List the stored splits.
+
+    Args:
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+
+    Returns:
+        pd.DataFrame: Metadata with columns split_name, cohort, test_size, random_state, stratify_column,
+            n_train, n_test and created_at
+    """
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        table_existing = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;", (TableNames.SPLIT_METADATA,)
+        ).fetchone()
+        if not table_existing:
+            return pd.DataFrame(
+                columns=[
+                    "split_name",
+                    "cohort",
+                    "test_size",
+                    "random_state",
+                    "stratify_column",
+                    "n_train",
+                    "n_test",
+                    "created_at",
+                ]
+            )
+        return pd.read_sql_query(f"SELECT * FROM {TableNames.SPLIT_METADATA} ORDER BY split_name;", conn)
+
+
+def store_imputed_values(
+    csv_file_path,
+    table_name=TableNames.IMPUTED_MISSFOREST,
+    round_columns=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Store imputed values in an indexed table, so they can be joined into the analysis datasets.
+
+    Args:
+        csv_file_path (str): Path to the imputed CSV file, e.g. eligible_data_imputed_missForest.csv
+        table_name (str, optional): Name of the table to create. Defaults to TableNames.IMPUTED_MISSFOREST
+        round_columns (dict, optional): Mapping from column name to the number of decimals.
+            Defaults to {"total_chol": 3, "hdl_chol": 3} as in incorporate_imputation.ipynb
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+    """
+    if round_columns is None:
+        round_columns = {"total_chol": 3, "hdl_chol": 3}
+
+    df = pd.read_csv(csv_file_path)
+    df = df.round({col: decimals for col, decimals in round_columns.items() if col in df.columns})
+    generate_table_from_dataframe(table_name, df, db_file_path, primary_key)
+
+
+def _fold_subquery(split_name, fold, primary_key="eid"):
+    """Parenthesized subquery with the eids of one fold, usable as a cohort table, and the values it binds."""
+    if fold not in FOLDS:
+        raise ValueError(f"Unknown fold: {fold}, should be one of {FOLDS}")
+    return f"(SELECT {primary_key} FROM {TableNames.SPLITS} WHERE split_name = ? AND fold = ?)", [split_name, fold]
+
+
+def read_split_data(
+    split_name="main",
+    fold="train",
+    imputed_table=None,
+    tables=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Read the analysis dataset of one fold.
+
+    Args:
+        split_name (str, optional): Name of the split. Defaults to "main"
+        fold (str, optional): "train" or "test". Defaults to "train"
+        imputed_table (str, optional): Table with imputed values, e.g. TableNames.IMPUTED_MISSFOREST.
+            If None, the unimputed values are read. Defaults to None
+        tables (dict, optional): Tables and columns to read, see sql_utils.EXPORT_TABLES. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        pd.DataFrame: Dataset of the fold, ordered by eid
+
+    Raises:
+        ValueError: If fold is not "train" or "test"
+    """
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        cursor = conn.cursor()
+        fold_subquery, fold_params = _fold_subquery(split_name, fold, primary_key)
+        query, output_columns, params = build_export_query(
+            cursor, fold_subquery, tables, imputed_table, primary_key, fold_params
+        )
+        return pd.DataFrame(cursor.execute(query, params).fetchall(), columns=output_columns)
+
+
+def export_split_data(
+    output_path,
+    split_name="main",
+    fold="train",
+    imputed_table=None,
+    tables=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+    chunk_size=10000,
+    output_formats=("csv",),
+    compression=None,
+    csv_index=True,
+):
+    """
+    Export the analysis dataset of one fold to CSV, Parquet and/or Feather files, chunk by chunk.
+
+    Args:
+        output_path (str): Path to the output file. Its extension is replaced by the one of each format
+        split_name (str, optional): Name of the split. Defaults to "main"
+        fold (str, optional): "train" or "test". Defaults to "train"
+        imputed_table (str, optional): Table with imputed values. If None, the unimputed values are exported.
+            Defaults to None
+        tables (dict, optional): Tables and columns to export, see sql_utils.EXPORT_TABLES. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        chunk_size (int, optional): Number of rows written at a time. Defaults to 10000
+        output_formats (str | list[str], optional): Formats to write, see sql_utils.export_joined_data.
+            Defaults to ("csv",)
+        compression (str, optional): Compression of the Parquet/Feather files. Defaults to None
+        csv_index (bool, optional): Whether to write a leading row number column to the CSV file, as the
+            notebooks did. The R models in step4_build_survival_model drop this first column. Defaults to True
+
+    Returns:
+        int: Number of exported rows
+    """
+    fold_subquery, fold_params = _fold_subquery(split_name, fold, primary_key)
+    return export_joined_data(
+        output_path,
+        tables=tables,
+        cohort_table=fold_subquery,
+        cohort_params=fold_params,
+        imputed_table=imputed_table,
+        db_file_path=db_file_path,
+        primary_key=primary_key,
+        chunk_size=chunk_size,
+        output_formats=output_formats,
+        compression=compression,
+        csv_index=csv_index,
+    )
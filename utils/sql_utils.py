@@ -3,10 +3,14 @@ SQLite database utility functions with CSV integration.
 
 This module provides functions for managing SQLite database operations, particularly
 focused on creating and updating tables using CSV data. Key functionalities include:
-- Creating new tables from CSV files
+- Creating new tables from CSV files, optionally with array fields in a long or blob table
+- Creating or appending to result tables from DataFrames or streams of record batches
 - Updating existing tables with CSV data
 - Querying table information and contents
 - Managing column definitions and data types
+- Opening connections with tuned PRAGMA profiles for bulk loading or normal use
+- Building declared secondary indexes and checking query plans of the analysis workload
+- Streaming the joined analysis dataset of a cohort to CSV, Parquet or Feather files
 
 Note:
     This module handles the integration between CSV files and SQLite database,
@@ -15,16 +19,135 @@ Note:
 Dependencies:
     - sqlite3: For database operations
     - pandas: For data manipulation
-    - pickle: For storing column definitions
+    - pyarrow: For typed Parquet/Feather exports
 """
 
-import pickle
+import itertools
+import json
+import os
 import sqlite3
+from contextlib import contextmanager
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
-from .constants import DatabaseConfig, TableNames
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .constants import DatabaseConfig, TableNames, ConnectionProfiles, TableIndexes, CohortCriteria
+from .csv_utils import iter_selected_rows, query_column_catalog
+
+# sqlite3 only accepts Python scalars, so numpy scalars coming from DataFrames are converted
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.int32, int)
+sqlite3.register_adapter(np.float32, float)
+sqlite3.register_adapter(np.bool_, bool)
+
+
+@contextmanager
+def db_connection(db_file_path=DatabaseConfig.DB_PATH, profile=ConnectionProfiles.SAFE):
+    """
+    Open a SQLite connection with a PRAGMA profile and wrap the work in one transaction.
+
+    Args:
+        db_file_path (str, optional): Path to the SQLite database file.
+            Defaults to DatabaseConfig.DB_PATH
+        profile (dict, optional): PRAGMA settings to apply, e.g. ConnectionProfiles.BULK_LOAD
+            for building tables or ConnectionProfiles.READ_ONLY for reading. Defaults to ConnectionProfiles.SAFE
+
+    Yields:
+        sqlite3.Connection: Connection with an open transaction, or in autocommit mode for a read-only profile
+
+    Notes:
+        - The transaction is committed when the block exits normally and rolled back on error
+        - DDL statements run inside the same transaction, so do not call conn.commit() in the block
+        - A profile with query_only ON opens no transaction, every statement reads the latest committed data
+        - A WAL journal is switched back to the rollback journal on exit, also after an error,
+          so no -wal file is left behind
+
+    Example:
+        >>> with db_connection(profile=ConnectionProfiles.BULK_LOAD) as conn:
+        ...     conn.execute("CREATE TABLE t (eid INTEGER PRIMARY KEY)")
+    """
+    conn = sqlite3.connect(db_file_path, isolation_level=None)  # transactions are managed explicitly
+    read_only = str(profile.get("query_only", "")).upper() == "ON"
+    try:
+        # * PRAGMAs such as journal_mode and foreign_keys have no effect inside a transaction
+        for pragma, value in profile.items():
+            conn.execute(f"PRAGMA {pragma} = {value};")
+        if read_only:
+            yield conn
+            return
+        conn.execute("BEGIN;")
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+        if conn.in_transaction:
+            conn.execute("COMMIT;")
+    finally:
+        try:
+            if str(profile.get("journal_mode", "")).upper() == "WAL":
+                if conn.in_transaction:  # e.g. COMMIT failed
+                    conn.execute("ROLLBACK;")
+                conn.execute(f"PRAGMA journal_mode = {ConnectionProfiles.SAFE['journal_mode']};")
+        except sqlite3.Error as e:
+            print(f"Journal mode of {db_file_path} could not be restored: {str(e)}")
+        finally:
+            conn.close()
+
+
+def _insert_dataframe(cursor, table_name, df, batch_size=ConnectionProfiles.BULK_INSERT_BATCH_SIZE):
+    """
+    Insert the rows of a DataFrame into an existing table with batched executemany.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of a connection with an open transaction
+        table_name (str): Name of the table to insert into
+        df (pd.DataFrame): Data to insert. Column names must match the table columns
+        batch_size (int, optional): Number of rows for each executemany call.
+            Defaults to ConnectionProfiles.BULK_INSERT_BATCH_SIZE
+
+    Returns:
+        int: Number of inserted rows
+    """
+    columns = ", ".join(f"`{col}`" for col in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+    insert_sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders});"  # prepared once, reused by every batch
+
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    n_rows = 0
+    while batch := list(itertools.islice(rows, batch_size)):
+        cursor.executemany(insert_sql, batch)
+        n_rows += len(batch)
+    return n_rows
+
+
+def update_column(cursor, table_name, column_name, values, primary_key="eid", batch_size=ConnectionProfiles.BULK_INSERT_BATCH_SIZE):
+    """
+    Set the values of one column for many rows with batched executemany.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of a connection with an open transaction
+        table_name (str): Name of the table to update
+        column_name (str): Name of the column to update. It must already exist
+        values (pd.Series): New values indexed by the primary key. NA values are written as NULL
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        batch_size (int, optional): Number of rows for each executemany call.
+            Defaults to ConnectionProfiles.BULK_INSERT_BATCH_SIZE
+
+    Returns:
+        int: Number of rows that were updated
+    """
+    update_sql = f"UPDATE {table_name} SET `{column_name}` = ? WHERE {primary_key} = ?;"
+    values = values.astype(object).where(values.notna(), None)
+    rows = zip(values.tolist(), values.index.tolist())
+    n_rows = 0
+    while batch := list(itertools.islice(rows, batch_size)):
+        cursor.executemany(update_sql, batch)
+        n_rows += cursor.rowcount
+    return n_rows
 
 
 def print_table_info(table_name, db_file_path=DatabaseConfig.DB_PATH):
@@ -39,10 +162,8 @@ def print_table_info(table_name, db_file_path=DatabaseConfig.DB_PATH):
         None: Prints the table information including column names, types, and constraints
     """
     print(f"Printing Information for table: {table_name}")
-    conn = sqlite3.connect(db_file_path)
-    cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name});")
-    columns = cursor.fetchall()
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        columns = conn.execute(f"PRAGMA table_info({table_name});").fetchall()
     for column in columns:
         print(column)
 
@@ -70,12 +191,13 @@ def query_eids(cursor=None, db_file_path=DatabaseConfig.DB_PATH, primary_key="ei
     Raises:
         sqlite3.Error: If database connection or query fails
     """
-    if cursor is None:
-        conn = sqlite3.connect(db_file_path)
-        cursor = conn.cursor()
     query_eid_sql = f"SELECT {primary_key} FROM {TableNames.PROCESSED};"
-    cursor.execute(query_eid_sql)
-    eids = cursor.fetchall()
+    if cursor is None:
+        with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+            eids = conn.execute(query_eid_sql).fetchall()
+    else:
+        cursor.execute(query_eid_sql)
+        eids = cursor.fetchall()
     eids = [eid[0] for eid in eids]
     return eids
 
@@ -84,7 +206,7 @@ def _get_column_defs(
     selected_column_IDs,
     primary_key="eid",
     existing_column_sql_defs=None,
-    column_defs_path=DatabaseConfig.COLUMN_DEFS_PATH,
+    csv_file_path=DatabaseConfig.CSV_PATH,
 ):
     """
     Get SQL column definitions based on selected column IDs.
@@ -93,7 +215,8 @@ def _get_column_defs(
         selected_columns_ID (list): List of column IDs to process
         primary_key (str, optional): Name of the primary key column. Defaults to "eid"
         existing_column_sql_defs (list, optional): List of existing column definitions. Defaults to None
-        column_defs_path (str, optional): Path to column definitions file. Defaults to DatabaseConfig.COLUMN_DEFS_PATH
+        csv_file_path (str, optional): Path to the CSV file whose column catalog is used.
+            Defaults to DatabaseConfig.CSV_PATH
 
     Returns:
         tuple: (selected_column_sql_defs, selected_column_csv)
@@ -101,44 +224,28 @@ def _get_column_defs(
             - selected_column_csv (list): Column names for CSV extraction
 
     Raises:
-        ValueError: If column definitions file cannot be loaded
+        FileNotFoundError: If there is no valid column catalog, see csv_utils.generate_column_defs
     """
+    # * The catalog is indexed by field ID, so only the selected columns are read
+    catalog = query_column_catalog(selected_column_IDs, csv_file_path)
 
-    with open(column_defs_path, "rb") as f:
-        column_defs = pickle.load(f)
+    # escape the numbers as SQL column names
+    selected_column_sql_defs = [f"`{name}` {dtype}" for name, dtype in zip(catalog["column_name"], catalog["dtype"])]
 
-        # escape the numbers as SQL column names
-        escaped_column_defs = [
-            f"`{col_def.split()[0]}` {' '.join(col_def.split()[1:])}" if primary_key not in col_def else col_def
-            for col_def in column_defs
+    if existing_column_sql_defs:
+        len_before = len(selected_column_sql_defs)
+        selected_column_sql_defs = [
+            col_def for col_def in selected_column_sql_defs if col_def not in existing_column_sql_defs
         ]
+        len_after = len(selected_column_sql_defs)
+        if len_before - len_after > 0:
+            print(f"{len_before - len_after} columns already exist in the table")
 
-        # select the columns based on the selected_columns_ID
-        selected_column_sql_defs = []  # define Used to construct the SQL table
-        for col in escaped_column_defs:
-            if primary_key in col:
-                continue
-            col_int = col.replace("`", "")
-            if int(col_int.split("-")[0]) in selected_column_IDs:
-                selected_column_sql_defs.append(col)
-
-        if existing_column_sql_defs:
-            len_before = len(selected_column_sql_defs)
-            selected_column_sql_defs = [
-                col_def for col_def in selected_column_sql_defs if col_def not in existing_column_sql_defs
-            ]
-            len_after = len(selected_column_sql_defs)
-            if len_before - len_after > 0:
-                print(f"{len_before - len_after} columns already exist in the table")
-
-        selected_column_csv = [primary_key]  # define Used to extract from the CSV file
-        for selected_column_sql_def in selected_column_sql_defs:
-            if primary_key in selected_column_sql_def:
-                continue
-            selected_column_sql_def = selected_column_sql_def.replace("`", "")
-            selected_column_csv.append(selected_column_sql_def.split(" ")[0])
+    selected_column_csv = [primary_key]  # define Used to extract from the CSV file
+    for selected_column_sql_def in selected_column_sql_defs:
+        selected_column_csv.append(selected_column_sql_def.split(" ")[0].replace("`", ""))
 
-        return selected_column_sql_defs, selected_column_csv
+    return selected_column_sql_defs, selected_column_csv
 
 
 def _process_chunk(chunk_raw, selected_column_csv, eids, primary_key="eid"):
@@ -189,44 +296,189 @@ def _process_chunk(chunk_raw, selected_column_csv, eids, primary_key="eid"):
     return chunk
 
 
-def _get_non_empty_columns(cursor, table_name_temp, primary_key="eid"):
+def _stream_selected_columns(
+    csv_file_path, selected_column_csv, eids, non_null_counts, chunk_size=5000, primary_key="eid"
+):
+    """
+    Stream the selected columns of the main CSV file and count non-null values on the fly.
+
+    Args:
+        csv_file_path (str): Path to the CSV file
+        selected_column_csv (list): List of columns to extract from the CSV file
+        eids (list): List of valid eids to filter by
+        non_null_counts (pd.Series): Number of non-null values for each selected column, updated in place
+            with every chunk
+        chunk_size (int, optional): Number of rows to process at once. Defaults to 5000
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Yields:
+        pd.DataFrame: Processed chunk that only contains rows of the eids
+
+    Notes:
+        - Only the rows of the eids are read, from the Parquet mirror if it exists, otherwise
+          using the byte-offset row index of the CSV file
+        - Chunks are not kept, so the caller should write each one before asking for the next
+    """
+    with tqdm(total=len(eids), desc="Processing CSV", unit="rows") as pbar:
+        for chunk in iter_selected_rows(selected_column_csv, eids, csv_file_path, chunk_size):
+            chunk = _process_chunk(chunk, selected_column_csv, eids, primary_key)
+            non_null_counts += chunk[selected_column_csv].notna().sum()
+            pbar.update(len(chunk))
+            yield chunk
+
+
+def _count_non_null_for_eids(csv_file_path, selected_column_csv, eids, chunk_size=5000):
     """
-    Get list of non-empty columns from temporary table.
+    Count the non-null values of the selected columns among the rows of the eids, without converting them.
 
     Args:
-        cursor: SQLite cursor
-        table_name_temp (str): Name of temporary table
+        csv_file_path (str): Path to the CSV file
+        selected_column_csv (list): List of columns to count
+        eids (list): List of valid eids to filter by
+        chunk_size (int, optional): Number of rows to read at once. Defaults to 5000
+
+    Returns:
+        pd.Series: Number of non-null values for each selected column
+
+    Notes:
+        - A column has no value for the eids in the raw CSV exactly when it has none after _process_chunk,
+          so the counts can settle the columns of a table before any row is written
+    """
+    non_null_counts = pd.Series(0, index=selected_column_csv, dtype="int64")
+    with tqdm(total=len(eids), desc="Counting values", unit="rows") as pbar:
+        for chunk in iter_selected_rows(selected_column_csv, eids, csv_file_path, chunk_size):
+            non_null_counts += chunk[selected_column_csv].notna().sum()
+            pbar.update(len(chunk))
+    return non_null_counts
+
+
+def _catalog_non_null_counts(selected_column_csv, csv_file_path=DatabaseConfig.CSV_PATH):
+    """
+    Number of non-null values of the selected columns over the whole CSV file, from the column catalog.
+
+    Args:
+        selected_column_csv (list): List of column names
+        csv_file_path (str, optional): Path to the CSV file. Defaults to DatabaseConfig.CSV_PATH
+
+    Returns:
+        pd.Series: Non-null count of each column, in the order of selected_column_csv. The primary key has no count
+    """
+    catalog = query_column_catalog(file_path=csv_file_path, column_names=selected_column_csv)
+    return catalog.set_index("column_name")["non_null"].reindex(selected_column_csv)
+
+
+def _get_non_empty_columns_from_counts(non_null_counts, primary_key="eid"):
+    """
+    Get list of non-empty columns from non-null counts, of the column catalog or collected while streaming.
+
+    Args:
+        non_null_counts (pd.Series): Number of non-null values for each column
         primary_key (str): Name of the primary key column. Defaults to "eid"
 
     Returns:
-        list: List of non-empty column names
+        list: List of non-empty column names, in the original order
     """
-    cursor.execute(f"PRAGMA table_info({table_name_temp})")
-    selected_columns_sql_name = [row[1] for row in cursor.fetchall()]
     non_empty_columns_sql_name = []
-
-    pattern_empty = None  # define the pattern of a previous empty column
-    for col_name in tqdm(selected_columns_sql_name, desc="Dropping empty columns"):
-        pattern_current = col_name.replace("`", "").split("-")[0]
-        if pattern_empty is not None and pattern_current == pattern_empty:
-            print(f"Empty column {col_name} will be dropped")
-            continue
-        cursor.execute(f"""
-            SELECT COUNT(*) 
-            FROM {table_name_temp} 
-            WHERE `{col_name}` IS NOT NULL;
-        """)
-        count = cursor.fetchone()[0]
-        if (count > 0 and col_name != primary_key) or col_name == primary_key:
+    for col_name, count in non_null_counts.items():
+        if count > 0 or col_name == primary_key:
             non_empty_columns_sql_name.append(col_name)
-            pattern_empty = None
         else:
             print(f"Empty column {col_name} will be dropped")
-            pattern_empty = col_name.replace("`", "").split("-")[0]
-
     return non_empty_columns_sql_name
 
 
+# * Storage of array fields split off the wide table by generate_table_from_main_csv
+ARRAY_STORAGES = ["long", "blob"]
+
+
+def _create_array_table(cursor, array_table_name, array_storage, primary_key="eid"):
+    """
+    Create the table that stores array fields.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of a connection with an open transaction
+        array_table_name (str): Name of the table to create
+        array_storage (str): "long" for one row per value, "blob" for one array per subject, field and instance
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Notes:
+        - The table is WITHOUT ROWID, so its rows are clustered by subject and the values of one
+          subject are read by a single range scan of the primary key
+        - The value column of the long table has no declared type, so integers, reals and text
+          are kept as they are
+    """
+    if array_storage == "long":
+        value_sql_defs = "array_index INTEGER NOT NULL, value,"
+        key_columns = f"{primary_key}, field_id, instance, array_index"
+    else:
+        value_sql_defs = "dtype TEXT NOT NULL, length INTEGER NOT NULL, data BLOB NOT NULL,"
+        key_columns = f"{primary_key}, field_id, instance"
+    cursor.execute(f"""
+        CREATE TABLE {array_table_name} (
+            {primary_key} INTEGER NOT NULL,
+            field_id INTEGER NOT NULL,
+            instance INTEGER NOT NULL,
+            {value_sql_defs}
+            PRIMARY KEY ({key_columns}),
+            FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
+        ) WITHOUT ROWID;
+    """)
+
+
+def _array_rows(chunk, array_catalog, array_storage, primary_key="eid"):
+    """
+    Convert the array columns of a processed chunk into rows of the array table.
+
+    Args:
+        chunk (pd.DataFrame): Chunk returned by _process_chunk
+        array_catalog (pd.DataFrame): Column catalog rows of the array columns
+        array_storage (str): "long" or "blob", see _create_array_table
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        pd.DataFrame: Rows to insert. Only non-empty values are stored, so it has no row if
+            array_catalog is empty
+    """
+    eids = chunk[primary_key].to_numpy()
+    frames = []
+    for (field_id, instance), columns in array_catalog.groupby(["field_id", "instance"], sort=False):
+        values = chunk[columns["column_name"]].to_numpy(dtype=object)
+        # the main CSV import stores missing strings as "nan"
+        present = ~(pd.isna(values) | pd.DataFrame(values).isin(["", "nan"]).to_numpy())
+        array_indexes = columns["array_index"].to_numpy()
+
+        if array_storage == "long":
+            rows, cols = np.nonzero(present)
+            frames.append(pd.DataFrame({
+                primary_key: eids[rows],
+                "field_id": field_id,
+                "instance": instance,
+                "array_index": array_indexes[cols],
+                "value": values[rows, cols],
+            }))
+            continue
+
+        # numeric arrays are stored as float64 bytes with NaN gaps, text arrays as JSON lists
+        numeric = columns["dtype"].isin(["int64", "float64"]).all()
+        blob_rows = []
+        for i in np.nonzero(present.any(axis=1))[0]:
+            length = array_indexes[present[i]].max() + 1
+            if numeric:
+                subject_values = np.full(length, np.nan)
+                subject_values[array_indexes[present[i]]] = values[i, present[i]].astype(float)
+                blob_rows.append((eids[i], field_id, instance, "float64", length, subject_values.tobytes()))
+            else:
+                subject_values = [None] * length
+                for array_index, value in zip(array_indexes[present[i]], values[i, present[i]]):
+                    subject_values[array_index] = value
+                blob_rows.append((eids[i], field_id, instance, "json", length, json.dumps(subject_values).encode()))
+        frames.append(pd.DataFrame(blob_rows, columns=[primary_key, "field_id", "instance", "dtype", "length", "data"]))
+    if not frames:
+        value_columns = ["array_index", "value"] if array_storage == "long" else ["dtype", "length", "data"]
+        return pd.DataFrame(columns=[primary_key, "field_id", "instance", *value_columns])
+    return pd.concat(frames, ignore_index=True)
+
+
 def generate_table_from_main_csv(
     table_name,
     selected_columns_ID,
@@ -234,6 +486,9 @@ def generate_table_from_main_csv(
     db_file_path=DatabaseConfig.DB_PATH,
     chunk_size=5000,
     primary_key="eid",
+    array_fields=None,
+    array_storage="long",
+    array_table_name=None,
 ):
     """
     Create a new table from the main CSV file, which contains all subject data.
@@ -246,87 +501,227 @@ def generate_table_from_main_csv(
         db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
         chunk_size (int, optional): Number of rows to process at once. Defaults to 5000
         primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        array_fields (list, optional): Field IDs among selected_columns_ID with many instances or array
+            values, e.g. the exercise trend fields 5983-5988. They are stored in the array table instead of
+            one wide column per value. Defaults to None
+        array_storage (str, optional): How the array fields are stored. Defaults to "long"
+            - 'long': One row (eid, field_id, instance, array_index, value) per non-empty value
+            - 'blob': One row (eid, field_id, instance, dtype, length, data) per subject, field and instance,
+              with the values packed as float64 bytes (numeric fields) or a JSON list (text fields)
+        array_table_name (str, optional): Name of the array table. Defaults to "<table_name>_array"
 
     Process:
-        1. Creates a temporary table with all selected columns
-        2. Loads data from CSV in chunks
-        3. Removes empty columns
-        4. Creates final table with non-empty columns
-        5. Transfers data from temporary to final table
+        1. Leaves out the columns that are empty in the whole CSV file, according to the column catalog
+        2. Counts the values of the remaining columns among the rows of the eids, and leaves out the empty ones
+        3. Creates the table with the non-empty columns only, and the array table if array_fields is given
+        4. Loads data from CSV in chunks, inserting every chunk as it is read
 
     Notes:
         - Only processes rows that exist in PROCESSED table
         - Automatically determines appropriate data types for columns
         - Maintains foreign key relationship with PROCESSED table
         - Skips completely empty columns
+        - Only one chunk is held in memory at a time. The rows of the eids are read twice, once to count
+          the values and once to insert them, so the table is written once with its final columns
+        - Read the array fields back with read_array_field and read_subject_arrays
 
     Raises:
         ValueError: If selected_columns_ID is not a list
+        ValueError: If array_storage is invalid
         ValueError: If primary key contains NA values
+        FileNotFoundError: If there is no valid column catalog, see csv_utils.generate_column_defs
         sqlite3.Error: If database operations fail
     """
 
     # make sure selected_columns_ID is a list
     if not isinstance(selected_columns_ID, list):
         raise ValueError("selected_columns_ID must be a list")
+    if array_storage not in ARRAY_STORAGES:
+        raise ValueError(f"Invalid array_storage: {array_storage}, should be one of {ARRAY_STORAGES}")
+    array_fields = [field_id for field_id in (array_fields or []) if field_id in selected_columns_ID]
+    array_table_name = array_table_name or f"{table_name}_array"
 
-    conn = sqlite3.connect(db_file_path)
-    cursor = conn.cursor()
-    table_name_temp = f"{table_name}_temp"  # define temporary table that will be dropped later
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
 
-    # * Step1/5: Select based on provided selected_columns_ID
-    selected_column_sql_defs, selected_column_csv = _get_column_defs(selected_columns_ID, primary_key)
+        # * Step1/4: Select based on provided selected_columns_ID, without the columns empty in the CSV file
+        wide_columns_ID = [column_id for column_id in selected_columns_ID if column_id not in array_fields]
+        selected_column_sql_defs, selected_column_csv = _get_column_defs(wide_columns_ID, primary_key, csv_file_path=csv_file_path)
+        selected_column_csv = _get_non_empty_columns_from_counts(
+            _catalog_non_null_counts(selected_column_csv, csv_file_path), primary_key
+        )
+        array_catalog = None
+        if array_fields:
+            array_catalog = query_column_catalog(array_fields, csv_file_path)
+            array_catalog = array_catalog[array_catalog["non_null"] > 0]
+        array_columns = array_catalog["column_name"].tolist() if array_fields else []
+
+        # * Step2/4: Drop all columns that are empty for the eids
+        eids = query_eids(cursor)
+
+        print(f"Counting values for table: {table_name}")
+        non_empty_columns_sql_name = _get_non_empty_columns_from_counts(
+            _count_non_null_for_eids(csv_file_path, selected_column_csv, eids, chunk_size), primary_key
+        )
+        print(f"There will be {len(non_empty_columns_sql_name)} columns in the table: {table_name}")
+        non_empty_column_sql_defs = [
+            col_def
+            for col_def in selected_column_sql_defs
+            if col_def.split(" ")[0].replace("`", "") in non_empty_columns_sql_name
+        ]
 
-    # * Step2/5: Create the temporary table
-    print(f"Creating temporary table: {table_name_temp}")
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    create_table_sql = f"""
-        CREATE TABLE IF NOT EXISTS {table_name_temp} (
-            {primary_key} INTEGER PRIMARY KEY, 
-            {", ".join(selected_column_sql_defs)},
-            FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
-        );
+        # * Step3/4: Create the formal table
+        print(f"Creating the formal table: {table_name}")
+        table_sql_defs = [
+            f"{primary_key} INTEGER PRIMARY KEY",
+            *non_empty_column_sql_defs,
+            f"FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})",
+        ]
+        cursor.execute(f"CREATE TABLE {table_name} ({', '.join(table_sql_defs)});")
+        if array_fields:
+            print(f"Array fields {array_fields} will be stored in table {array_table_name} ({array_storage})")
+            cursor.execute(f"DROP TABLE IF EXISTS {array_table_name}")
+            _create_array_table(cursor, array_table_name, array_storage, primary_key)
+
+        # * Step4/4: Insert the data chunk by chunk
+        print(f"Inserting data into the formal table: {table_name}")
+        non_null_counts = pd.Series(0, index=non_empty_columns_sql_name + array_columns, dtype="int64")
+        for chunk in _stream_selected_columns(
+            csv_file_path, non_empty_columns_sql_name + array_columns, eids, non_null_counts, chunk_size, primary_key
+        ):
+            _insert_dataframe(cursor, table_name, chunk[non_empty_columns_sql_name])
+            if array_fields:
+                _insert_dataframe(cursor, array_table_name, _array_rows(chunk, array_catalog, array_storage, primary_key))
+
+        _create_declared_indexes(cursor, table_name)
+
+    print(f"Table {table_name} has been created successfully.")
+
+
+def _arrays_from_rows(rows, blob_storage):
     """
-    cursor.execute(create_table_sql)
+    Rebuild arrays from the rows of an array table.
 
-    # * Step3/5: Insert the data into the table
-    eids = query_eids(cursor)
+    Args:
+        rows (list[tuple]): Rows (field_id, instance, array_index, value) of the long storage, or
+            (field_id, instance, dtype, length, data) of the blob storage, ordered by field_id and instance
+        blob_storage (bool): Whether the rows come from the blob storage
 
-    print(f"Inserting data into temporary table: {table_name_temp}")
-    with tqdm(total=DatabaseConfig.TOTAL_ROWS, desc="Processing CSV", unit="rows") as pbar:
-        for chunk in pd.read_csv(csv_file_path, chunksize=chunk_size, dtype=str, usecols=selected_column_csv):
-            chunk = _process_chunk(chunk, selected_column_csv, eids)
-            chunk.to_sql(table_name_temp, conn, if_exists="append", index=False)  # insert the csv into SQL database
-            pbar.update(chunk_size)
+    Returns:
+        dict: Mapping from (field_id, instance) to np.ndarray. Numeric arrays are float64 with NaN for
+            missing values, text arrays are object arrays with None
+    """
+    arrays = {}
+    if blob_storage:
+        for field_id, instance, dtype, _, data in rows:
+            if dtype == "float64":
+                arrays[(field_id, instance)] = np.frombuffer(data, dtype=np.float64).copy()
+            else:
+                arrays[(field_id, instance)] = np.array(json.loads(data), dtype=object)
+        return arrays
+
+    for (field_id, instance), group in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+        group = list(group)
+        array_indexes = np.array([row[2] for row in group])
+        values = [row[3] for row in group]
+        if all(isinstance(value, (int, float)) for value in values):
+            array = np.full(array_indexes.max() + 1, np.nan)
+        else:
+            array = np.full(array_indexes.max() + 1, None, dtype=object)
+        array[array_indexes] = values
+        arrays[(field_id, instance)] = array
+    return arrays
+
+
+def _query_array_table(cursor, array_table_name, eid, field_id=None, instance=None, primary_key="eid"):
+    """Read the rows of one subject from an array table, by a range scan of its primary key."""
+    table_columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({array_table_name});").fetchall()]
+    if not table_columns:
+        raise ValueError(f"Table {array_table_name} does not exist")
+    blob_storage = "data" in table_columns
+    value_columns = "dtype, length, data" if blob_storage else "array_index, value"
+
+    conditions, params = [f"{primary_key} = ?"], [int(eid)]
+    if field_id is not None:
+        conditions.append("field_id = ?")
+        params.append(int(field_id))
+    if instance is not None:
+        conditions.append("instance = ?")
+        params.append(int(instance))
+    rows = cursor.execute(
+        f"SELECT field_id, instance, {value_columns} FROM {array_table_name} WHERE {' AND '.join(conditions)} "
+        f"ORDER BY field_id, instance{'' if blob_storage else ', array_index'};",
+        params,
+    ).fetchall()
+    return _arrays_from_rows(rows, blob_storage)
+
+
+def read_array_field(
+    eid,
+    field_id,
+    instance=0,
+    array_table_name=TableNames.ECG_ARRAY,
+    cursor=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Rebuild the array of one field of one subject, e.g. the heart rate trend (5983) of a fitness test.
 
-    # * Step4/5: Drop all columns that are empty in the temporary table
-    print(f"Dropping empty columns in the temporary table: {table_name_temp}")
-    non_empty_columns_sql_name = _get_non_empty_columns(cursor, table_name_temp)
-    print(f"There will be {len(non_empty_columns_sql_name)} columns in the table: {table_name}")
+    Args:
+        eid (int): eid of the subject
+        field_id (int): Field ID
+        instance (int, optional): Instance (assessment visit). Defaults to 0
+        array_table_name (str, optional): Array table written by generate_table_from_main_csv.
+            Defaults to TableNames.ECG_ARRAY
+        cursor (sqlite3.Cursor, optional): Cursor to reuse when reading many subjects. If None, a connection
+            is opened. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
 
-    # * Step5/5: Create the formal table and drop the temporary table
-    print(f"Creating the formal table: {table_name}")
-    create_table_sql = f"""
-        CREATE TABLE {table_name} (
-            {primary_key} INTEGER PRIMARY KEY,
-            {", ".join(f"`{col}`" for col in non_empty_columns_sql_name if col != primary_key)},
-            FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
-        );
+    Returns:
+        np.ndarray: Values indexed by array index. Numeric fields are float64 with NaN for missing values,
+            text fields are object arrays with None. Empty if the subject has no value
+
+    Raises:
+        ValueError: If the array table does not exist
     """
-    cursor.execute(create_table_sql)
+    if cursor is None:
+        with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+            return read_array_field(eid, field_id, instance, array_table_name, conn.cursor(), primary_key=primary_key)
+    arrays = _query_array_table(cursor, array_table_name, eid, field_id, instance, primary_key)
+    return arrays.get((field_id, instance), np.array([], dtype=np.float64))
 
-    print(f"Inserting data into the formal table: {table_name}")
-    cols_str = ", ".join(f"`{col}`" for col in non_empty_columns_sql_name)
-    cursor.execute(f"""
-        INSERT INTO {table_name} 
-        SELECT {cols_str}
-        FROM {table_name_temp};
-    """)
 
-    cursor.execute(f"DROP TABLE {table_name_temp}")
-    conn.commit()
-    conn.close()
-    print(f"Table {table_name} has been created successfully.")
+def read_subject_arrays(
+    eid,
+    array_table_name=TableNames.ECG_ARRAY,
+    cursor=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+):
+    """
+    Rebuild all array fields of one subject.
+
+    Args:
+        eid (int): eid of the subject
+        array_table_name (str, optional): Array table written by generate_table_from_main_csv.
+            Defaults to TableNames.ECG_ARRAY
+        cursor (sqlite3.Cursor, optional): Cursor to reuse when reading many subjects. If None, a connection
+            is opened. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+
+    Returns:
+        dict: Mapping from (field_id, instance) to np.ndarray, see read_array_field
+
+    Raises:
+        ValueError: If the array table does not exist
+    """
+    if cursor is None:
+        with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+            return read_subject_arrays(eid, array_table_name, conn.cursor(), primary_key=primary_key)
+    return _query_array_table(cursor, array_table_name, eid, primary_key=primary_key)
 
 
 def update_table_from_csv(
@@ -350,103 +745,134 @@ def update_table_from_csv(
 
     Process:
         1. Checks if table exists
-        2. Creates temporary table for new columns
-        3. Loads and processes data from CSV
-        4. Removes empty columns
+        2. Selects the columns that are not yet in the table and not empty in the whole CSV file,
+           according to the column catalog
+        3. Loads data from CSV in chunks into a temporary table, counting non-null values of each column
+        4. Selects the columns that are not empty for the eids
         5. Adds non-empty columns to existing table
-        6. Updates data in the main table
+        6. Updates data in the main table with a single join
 
     Notes:
         - Only adds columns that don't already exist in the table
         - Only processes rows that have ECG data
         - Maintains foreign key relationship with PROCESSED_TABLE_NAME
         - Skips empty columns
+        - Only one chunk is held in memory at a time
+        - Uses UPDATE ... FROM (SQLite >= 3.33.0), otherwise refills the table from a joined copy.
+          Both are a single pass over the table instead of one subquery per cell
+        - The refill runs with foreign keys disabled, as in drop_columns_from_table, so deleting the rows
+          of a referenced table (e.g. PROCESSED) neither fails nor fires ON DELETE actions. All foreign
+          keys of the database are checked before committing
 
     Raises:
         ValueError: If table doesn't exist, if selected_columns_ID is not a list,
                    or if primary key contains NA values
+        sqlite3.IntegrityError: If a foreign key is violated after the refill
     """
 
     # make sure selected_columns_ID is a list
     if not isinstance(selected_columns_ID, list):
         raise ValueError("selected_columns_ID must be a list")
 
-    conn = sqlite3.connect(db_file_path)
-    cursor = conn.cursor()
-    table_name_temp = f"{table_name}_temp"
-
-    # * Step1/6: Check if the table exists
-    cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';")
-    if cursor.fetchone() is None:
-        raise ValueError(f"Table {table_name} does not exist.")
-
-    # * Step2/6: Select based on provided selected_columns_ID
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    existing_columns = [row[1] for row in cursor.fetchall()]
-    existing_column_sql_defs = [f"`{col}` {col.split()[1]}" for col in existing_columns]
-    selected_column_sql_defs, selected_column_csv = _get_column_defs(selected_columns_ID, primary_key, existing_column_sql_defs)
+    update_from_supported = sqlite3.sqlite_version_info >= (3, 33, 0)
+    # * PRAGMA foreign_keys cannot be changed inside the transaction
+    profile = ConnectionProfiles.BULK_LOAD
+    if not update_from_supported:
+        profile = {**ConnectionProfiles.BULK_LOAD, "foreign_keys": "OFF"}
+    with db_connection(db_file_path, profile) as conn:
+        cursor = conn.cursor()
+        table_name_temp = f"{table_name}_temp"
+
+        # * Step1/6: Check if the table exists
+        cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';")
+        if cursor.fetchone() is None:
+            raise ValueError(f"Table {table_name} does not exist.")
+
+        # * Step2/6: Select based on provided selected_columns_ID
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        existing_columns_info = cursor.fetchall()
+        existing_columns = [row[1] for row in existing_columns_info]
+        existing_column_sql_defs = [f"`{row[1]}` {row[2]}" for row in existing_columns_info]
+        selected_column_sql_defs, selected_column_csv = _get_column_defs(
+            selected_columns_ID, primary_key, existing_column_sql_defs, csv_file_path
+        )
 
-    # * Step3/6: Create a temporary table
-    print(f"Creating temporary table: {table_name_temp}")
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    create_table_sql = f"""
-        CREATE TABLE {table_name_temp} (
-            {primary_key} INTEGER PRIMARY KEY,
-            {", ".join(selected_column_sql_defs)},
-            FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
-        );
-    """
-    cursor.execute(create_table_sql)
+        selected_column_csv = _get_non_empty_columns_from_counts(
+            _catalog_non_null_counts(selected_column_csv, csv_file_path), primary_key
+        )
+        selected_column_sql_defs = [
+            col_def
+            for col_def in selected_column_sql_defs
+            if col_def.split(" ")[0].replace("`", "") in selected_column_csv
+        ]
+        if len(selected_column_sql_defs) == 0:
+            print(f"No new columns to add to the table: {table_name}")
+            return
 
-    # * Step4/6: Insert the data into the temporary table
-    eids = query_eids(cursor)
-
-    print(f"Inserting data into temporary table: {table_name_temp}")
-    with tqdm(total=DatabaseConfig.TOTAL_ROWS, desc="Processing CSV", unit="rows") as pbar:
-        for chunk in pd.read_csv(csv_file_path, chunksize=chunk_size, dtype=str, usecols=selected_column_csv):
-            chunk = _process_chunk(chunk, selected_column_csv, eids)
-            chunk.to_sql(table_name_temp, conn, if_exists="append", index=False)
-            pbar.update(chunk_size)
-
-    # * Step5/6: Drop all columns that are empty in the temporary table
-    print(f"Dropping empty columns in the temporary table: {table_name_temp}")
-    non_empty_columns_sql_name = _get_non_empty_columns(cursor, table_name_temp)
-    print(f"There will be {len(non_empty_columns_sql_name)} columns added to the table: {table_name}")
-
-    # * Step6/6: Add remanings columns to the formal table and drop the temporary table
-    print(f"Updating the formal table: {table_name}")
-    # Obtain the definitions for non-empty columns
-    non_empty_columns_sql_defs = []
-    for selected_column_sql_def in selected_column_sql_defs:
-        if selected_column_sql_def.split(" ")[0].replace("`", "") in non_empty_columns_sql_name:
-            non_empty_columns_sql_defs.append(selected_column_sql_def)
-    if len(non_empty_columns_sql_defs) == 0:
-        print(f"No new columns to add to the table: {table_name}")
-        return
+        # * Step3/6: Load the data into a temporary table and count non-null values of each column
+        eids = query_eids(cursor)
 
-    print(f"Inserting data into the formal table: {table_name}")
-    for col_def in non_empty_columns_sql_defs:
-        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_def};")
-    alter_table_sql = f"""
-        UPDATE {table_name} AS t1
-        SET {
-        ", ".join(
-            f"`{col}` = (SELECT `{col}` FROM {table_name_temp} t2 WHERE t2.{primary_key} = t1.{primary_key})"
-            for col in non_empty_columns_sql_name
-        )
-    }        
-        -- Only update rows that exist in the temporary table
-        WHERE EXISTS (
-            SELECT 1 
-            FROM {table_name_temp} t2 
-            WHERE t2.{primary_key} = t1.{primary_key}
-        )
-    """
-    cursor.execute(alter_table_sql)
+        print(f"Creating temporary table: {table_name_temp}")
+        cursor.execute(f"""
+            CREATE TABLE {table_name_temp} (
+                {primary_key} INTEGER PRIMARY KEY,
+                {", ".join(selected_column_sql_defs)}
+            );
+        """)
+        print(f"Loading data for table: {table_name}")
+        non_null_counts = pd.Series(0, index=selected_column_csv, dtype="int64")
+        for chunk in _stream_selected_columns(
+            csv_file_path, selected_column_csv, eids, non_null_counts, chunk_size, primary_key
+        ):
+            _insert_dataframe(cursor, table_name_temp, chunk[selected_column_csv])
+
+        # * Step4/6: Select the columns that are not empty for the eids
+        non_empty_columns_sql_name = _get_non_empty_columns_from_counts(non_null_counts, primary_key)
+        non_empty_columns_sql_defs = [
+            col_def
+            for col_def in selected_column_sql_defs
+            if col_def.split(" ")[0].replace("`", "") in non_empty_columns_sql_name
+        ]
+        print(f"There will be {len(non_empty_columns_sql_defs)} columns added to the table: {table_name}")
+        if len(non_empty_columns_sql_defs) == 0:
+            print(f"No new columns to add to the table: {table_name}")
+            cursor.execute(f"DROP TABLE {table_name_temp}")
+            return
+        new_columns = [col for col in non_empty_columns_sql_name if col != primary_key]
+
+        # * Step5/6: Add remaining columns to the formal table
+        print(f"Updating the formal table: {table_name}")
+        for col_def in non_empty_columns_sql_defs:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_def};")
+
+        # * Step6/6: Fill the new columns with one join and drop the temporary table
+        print(f"Inserting data into the formal table: {table_name}")
+        if update_from_supported:
+            cursor.execute(f"""
+                UPDATE {table_name}
+                SET {", ".join(f"`{col}` = t2.`{col}`" for col in new_columns)}
+                FROM {table_name_temp} AS t2
+                WHERE t2.{primary_key} = {table_name}.{primary_key};
+            """)
+        else:
+            # * Older SQLite has no UPDATE ... FROM. We refill the table from a joined copy instead,
+            # * which keeps the original table object, so its keys and indexes are preserved.
+            cursor.execute(f"""
+                CREATE TEMP TABLE {table_name}_joined AS
+                SELECT {", ".join(f"t1.`{col}`" for col in existing_columns)}, {", ".join(f"t2.`{col}`" for col in new_columns)}
+                FROM {table_name} AS t1 LEFT JOIN {table_name_temp} AS t2 ON t2.{primary_key} = t1.{primary_key};
+            """)
+            cursor.execute(f"DELETE FROM {table_name};")
+            cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {table_name}_joined;")
+            cursor.execute(f"DROP TABLE {table_name}_joined")
+            violations = cursor.execute("PRAGMA foreign_key_check;").fetchall()
+            if violations:
+                raise sqlite3.IntegrityError(
+                    f"Refilling table '{table_name}' violates {len(violations)} foreign key constraints"
+                )
+
+        cursor.execute(f"DROP TABLE {table_name_temp}")
 
-    cursor.execute(f"DROP TABLE {table_name_temp}")
-    conn.commit()
-    conn.close()
     print(f"Table {table_name} has been updated successfully.")
 
 
@@ -502,20 +928,16 @@ def generate_table_from_result_csv(
             Defaults to 6
 
     Process:
-        1. Checks and drops existing table if requested
-        2. Reads the CSV file into memory
-        3. Sets precision for float columns
-        4. Filters columns if column_names provided
-        5. Drops columns with all NA values if drop_NA is True
-        6. Creates table with foreign key constraint to PROCESSED table
-        7. Inserts data from DataFrame
+        1. Reads the CSV file into memory
+        2. Writes it with generate_table_from_batches, which filters the columns, rounds the float
+           columns, drops the columns with all NA values and creates the table in one transaction
 
     Notes:
         - Designed for smaller result files, not the main CSV
         - Loads entire file into memory (not chunked)
         - Automatically determines column types
         - Maintains foreign key relationship with PROCESSED table
-        - Float values are formatted with specified precision
+        - Float values are rounded to the specified precision
         - Drops columns (not rows) with all NA values
         - Creates table manually to ensure foreign key constraint
 
@@ -526,63 +948,308 @@ def generate_table_from_result_csv(
         pd.errors.EmptyDataError: If CSV file is empty
         TypeError: If column_names is provided but not a list
     """
-    conn = sqlite3.connect(db_file_path)
-    cursor = conn.cursor()
+    df = pd.read_csv(csv_file_path)
+    generate_table_from_batches(
+        table_name,
+        df,
+        column_names=column_names,
+        db_file_path=db_file_path,
+        primary_key=primary_key,
+        if_exists="replace" if drop_existing else "append",
+        drop_NA=drop_NA,
+        precision=precision,
+    )
+
+
+def generate_table_from_dataframe(
+    table_name,
+    df,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+    drop_existing=True,
+):
+    """
+    Create a new table from a DataFrame, with a foreign key constraint to the PROCESSED table.
 
-    if drop_existing:
-        table_existing = cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';").fetchone()
-        if table_existing:
-            print(f"Table {table_name} exists and will be dropped")
-            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    Args:
+        table_name (str): Name of the table to create
+        df (pd.DataFrame): Data to insert. Must contain the primary key column
+        db_file_path (str, optional): Path to the SQLite database.
+            Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column.
+            Defaults to "eid"
+        drop_existing (bool, optional): Whether to drop the table if it exists. Otherwise the rows are
+            appended to it. Defaults to True
 
-    df = pd.read_csv(csv_file_path)
-    # set precision for all float columns
+    Raises:
+        ValueError: If primary key column is missing
+    """
+    generate_table_from_batches(
+        table_name,
+        df,
+        db_file_path=db_file_path,
+        primary_key=primary_key,
+        if_exists="replace" if drop_existing else "append",
+    )
+
+
+def _round_float_columns(df, precision):
+    """Round the float columns of a DataFrame to a number of decimal places."""
     float_cols = df.select_dtypes(include=["float64", "float32"]).columns
-    for col in float_cols:
-        df[col] = df[col].apply(
-            lambda x: np.format_float_positional(x, precision=precision, unique=False, trim="k") if pd.notnull(x) else x
-        )
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df.round({col: precision for col in float_cols})
 
-    if column_names:
-        df = df[[primary_key, *column_names]]
 
-    if drop_NA:
-        df_shape_before = df.shape
-        df.dropna(how="all", inplace=True, axis=1)  # drop columns instead of rows
-        df_shape_after = df.shape
-        print(f"Dropped NA columns: {df_shape_before[1] - df_shape_after[1]} columns are dropped")
+def _iter_dataframes(data):
+    """Yield the batches of a DataFrame, a pyarrow RecordBatch/Table or an iterable of them as DataFrames."""
+    if isinstance(data, (pd.DataFrame, pa.RecordBatch, pa.Table)):
+        data = [data]
+    for batch in data:
+        yield batch.to_pandas() if isinstance(batch, (pa.RecordBatch, pa.Table)) else batch
 
-    df_columns = df.columns.tolist()
-    df_types = df.dtypes.to_dict()
 
-    if primary_key not in df_columns:
-        raise ValueError(f"Primary key column '{primary_key}' not found in CSV file")
+def _create_result_table(cursor, table_name, df, primary_key="eid"):
+    """
+    Create a table with the columns and dtypes of a DataFrame and a foreign key to the PROCESSED table.
 
-    column_sql_defs = []
-    for col in df_columns:
-        if col != primary_key:
-            sql_type = _pandas_to_sql_type(df_types[col])
-            column_sql_defs.append(f"{col} {sql_type}")
+    Args:
+        cursor (sqlite3.Cursor): Cursor of a connection with an open transaction
+        table_name (str): Name of the table to create
+        df (pd.DataFrame): Data whose columns define the table. Must contain the primary key column
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+    """
+    column_sql_defs = [f"`{col}` {_pandas_to_sql_type(dtype)}" for col, dtype in df.dtypes.items() if col != primary_key]
 
     print(f"Creating table: {table_name}")
-    cursor.execute("PRAGMA foreign_keys = ON;")
     # * We should not create table directly from pandas dataframe, as SQLite doesn't support adding foreign key after creation
     create_table_sql = f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
-            {primary_key} INTEGER PRIMARY KEY, 
-            {", ".join(column_sql_defs)},
+            {primary_key} INTEGER PRIMARY KEY,
+            {"".join(f"{col_def}, " for col_def in column_sql_defs)}
             FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
         );
     """
     cursor.execute(create_table_sql)
 
-    # Insert values into the table
-    df.to_sql(table_name, conn, if_exists="append", index=False)
 
-    conn.commit()
-    conn.close()
-    print(f"Table {table_name} has been created successfully.")
+def generate_table_from_batches(
+    table_name,
+    data,
+    column_names: list[str] = None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+    if_exists="replace",
+    drop_NA=False,
+    precision=None,
+    batch_size=ConnectionProfiles.BULK_INSERT_BATCH_SIZE,
+):
+    """
+    Create or append to a result table, with a foreign key constraint to the PROCESSED table, straight from memory.
+
+    Producers such as extract_HRV.py write their results with this function instead of going through a CSV file
+    and generate_table_from_result_csv.
+
+    Args:
+        table_name (str): Name of the table
+        data (pd.DataFrame | pa.RecordBatch | pa.Table | Iterable): Data to write, or an iterable of such batches.
+            Every batch must contain the primary key column
+        column_names (list[str], optional): Columns to write besides the primary key. If None, all columns are
+            written. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        if_exists (str, optional): What to do if the table exists. Defaults to "replace"
+            - 'replace': Drop the table and create it again
+            - 'append': Insert the rows into the existing table
+            - 'fail': Raise a ValueError
+        drop_NA (bool, optional): Whether to drop columns with all NA values. Only possible for a single
+            DataFrame, as the table is created from the first batch of a stream. Defaults to False
+        precision (int, optional): Number of decimal places for float values. If None, floats are not rounded.
+            Defaults to None
+        batch_size (int, optional): Number of rows for each executemany call.
+            Defaults to ConnectionProfiles.BULK_INSERT_BATCH_SIZE
+
+    Returns:
+        int: Number of written rows
+
+    Process:
+        1. Drops the existing table or checks it according to if_exists
+        2. Selects the columns and rounds the float columns of every batch
+        3. Creates the table from the columns and dtypes of the first batch if it does not exist
+        4. Inserts every batch with batched executemany
+
+    Notes:
+        - All batches are written in one transaction, so the table is unchanged if any batch fails
+        - Columns of the table that are missing from a batch are written as NULL
+        - The secondary indexes declared in TableIndexes.INDEXES are created after the insert
+
+    Raises:
+        ValueError: If if_exists is invalid, the table exists and if_exists is 'fail', drop_NA is used with a
+            stream, a batch misses the primary key or has columns the table does not have, or there is no batch
+        sqlite3.IntegrityError: If a primary key is duplicated or not in the PROCESSED table
+    """
+    if if_exists not in ["replace", "append", "fail"]:
+        raise ValueError(f"Invalid if_exists: {if_exists}, should be 'replace', 'append' or 'fail'")
+
+    def prepare(df):
+        if primary_key not in df.columns:
+            raise ValueError(f"Primary key column '{primary_key}' not found in DataFrame")
+        if column_names:
+            df = df[[primary_key, *column_names]]
+        if precision is not None:
+            df = _round_float_columns(df, precision)
+        return df
+
+    if isinstance(data, pd.DataFrame):
+        df = prepare(data)
+        if drop_NA:
+            n_columns_before = df.shape[1]
+            df = df.dropna(how="all", axis=1)  # drop columns instead of rows
+            print(f"Dropped NA columns: {n_columns_before - df.shape[1]} columns are dropped")
+        batches = [df]
+    elif drop_NA:
+        raise ValueError("drop_NA is only supported for a single DataFrame")
+    else:
+        batches = (prepare(df) for df in _iter_dataframes(data))
+
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+
+        table_existing = cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;", (table_name,)
+        ).fetchone()
+        if table_existing and if_exists == "fail":
+            raise ValueError(f"Table {table_name} already exists")
+        if table_existing and if_exists == "replace":
+            print(f"Table {table_name} exists and will be dropped")
+            cursor.execute(f"DROP TABLE {table_name}")
+            table_existing = None
+        table_columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name});")] if table_existing else None
+
+        n_rows = 0
+        for df in batches:
+            if table_columns is None:
+                _create_result_table(cursor, table_name, df, primary_key)
+                table_columns = df.columns.tolist()
+            unknown_columns = [col for col in df.columns if col not in table_columns]
+            if unknown_columns:
+                raise ValueError(f"Columns {unknown_columns} are not in table {table_name}")
+            n_rows += _insert_dataframe(cursor, table_name, df, batch_size)
+
+        if table_columns is None:
+            raise ValueError(f"No data to write to table {table_name}")
+
+        _create_declared_indexes(cursor, table_name)
+
+    print(f"{n_rows} rows have been written to table {table_name}")
+    return n_rows
+
+
+def generate_long_table(
+    long_table_name,
+    code_field,
+    date_field=None,
+    source_table=TableNames.ICD,
+    code_type="TEXT",
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+    chunk_size=10000,
+    drop_existing=True,
+):
+    """
+    Create a long table (eid, instance, array_index, code[, date]) from the wide array columns of a field.
+
+    Args:
+        long_table_name (str): Name of the long table to create
+        code_field (int): Field ID of the codes, e.g. 41270. All its "<field>-<instance>.<array>" columns are used
+        date_field (int, optional): Field ID of the dates aligned with the codes, e.g. 41280.
+            The date of "<code_field>-i.j" is read from "<date_field>-i.j". Defaults to None
+        source_table (str, optional): Table with the wide columns. Defaults to TableNames.ICD
+        code_type (str, optional): SQL type of the code column. Defaults to "TEXT"
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        chunk_size (int, optional): Number of subjects read at a time. Defaults to 10000
+        drop_existing (bool, optional): Whether to drop the long table if it exists. Defaults to True
+
+    Process:
+        1. Finds the wide columns of the fields in the source table
+        2. Creates the long table with a composite primary key
+        3. Reads the wide table in chunks, melts each chunk and inserts the non-empty entries
+        4. Creates the declared indexes
+
+    Notes:
+        - Only non-empty codes are stored, so the long table is much smaller than the wide one
+        - Codes are looked up by range or GLOB on the indexed code column instead of scanning
+          hundreds of columns per subject
+
+    Raises:
+        ValueError: If the source table has no column of code_field
+    """
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+
+        # * Step1/4: Find the wide columns
+        cursor.execute(f"PRAGMA table_info({source_table})")
+        existing_columns = [row[1] for row in cursor.fetchall()]
+        code_columns = [col for col in existing_columns if col.startswith(f"{code_field}-")]
+        if not code_columns:
+            raise ValueError(f"No column of field {code_field} found in table '{source_table}'")
+        suffixes = [col.split("-", 1)[1] for col in code_columns]  # "<instance>.<array>"
+        date_columns = []
+        if date_field is not None:
+            date_columns = [f"{date_field}-{suffix}" for suffix in suffixes]
+            date_columns = [col if col in existing_columns else None for col in date_columns]
+
+        # * Step2/4: Create the long table
+        if drop_existing:
+            cursor.execute(f"DROP TABLE IF EXISTS {long_table_name}")
+        date_sql_def = "date DATE," if date_field is not None else ""
+        cursor.execute(f"""
+            CREATE TABLE {long_table_name} (
+                {primary_key} INTEGER NOT NULL,
+                instance INTEGER NOT NULL,
+                array_index INTEGER NOT NULL,
+                code {code_type},
+                {date_sql_def}
+                PRIMARY KEY ({primary_key}, instance, array_index),
+                FOREIGN KEY ({primary_key}) REFERENCES {TableNames.PROCESSED} ({primary_key})
+            );
+        """)
+
+        # * Step3/4: Melt the wide table chunk by chunk
+        instances = np.array([int(suffix.split(".")[0]) for suffix in suffixes])
+        array_indexes = np.array([int(suffix.split(".")[1]) for suffix in suffixes])
+        selected_columns = [col for col in [*code_columns, *date_columns] if col is not None]
+        query_sql = f"SELECT {primary_key}, {', '.join(f'`{col}`' for col in selected_columns)} FROM {source_table}"
+
+        n_rows = 0
+        for chunk in tqdm(pd.read_sql_query(query_sql, conn, chunksize=chunk_size), desc=f"Creating {long_table_name}"):
+            eids = chunk[primary_key].to_numpy()
+            codes = chunk[code_columns].to_numpy(dtype=object)
+
+            # column-major order: all subjects of the first array column, then the second, ...
+            df_long = pd.DataFrame({
+                primary_key: np.tile(eids, len(code_columns)),
+                "instance": np.repeat(instances, len(eids)),
+                "array_index": np.repeat(array_indexes, len(eids)),
+                "code": codes.ravel(order="F"),
+            })
+            if date_field is not None:
+                dates = np.full(codes.shape, None, dtype=object)
+                for i, col in enumerate(date_columns):
+                    if col is not None:
+                        dates[:, i] = chunk[col].to_numpy(dtype=object)
+                df_long["date"] = dates.ravel(order="F")
+
+            # the main CSV import stores missing strings as "nan"
+            df_long = df_long[df_long["code"].notna() & ~df_long["code"].isin(["", "nan"])]
+            if date_field is not None:
+                df_long["date"] = df_long["date"].where(~df_long["date"].isin(["", "nan"]), None)
+            _insert_dataframe(cursor, long_table_name, df_long)
+            n_rows += len(df_long)
+
+        # * Step4/4: Create indexes
+        _create_declared_indexes(cursor, long_table_name)
+
+    print(f"Table {long_table_name} has been created successfully with {n_rows} rows.")
 
 
 def drop_column_from_table(table_name, column_name, db_file_path=DatabaseConfig.DB_PATH):
@@ -595,30 +1262,585 @@ def drop_column_from_table(table_name, column_name, db_file_path=DatabaseConfig.
         db_file_path (str, optional): Path to the SQLite database.
             Defaults to DatabaseConfig.DB_PATH
 
+    Note:
+        See drop_columns_from_table, which removes several columns at once
+    """
+    drop_columns_from_table(table_name, [column_name], db_file_path)
+
+
+def _rebuilt_table_sql(cursor, table_name, new_table_name, drop_columns):
+    """
+    CREATE TABLE statement of a table without some of its columns, keeping its column and table constraints.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        table_name (str): Name of the existing table
+        new_table_name (str): Name of the table to create
+        drop_columns (list[str]): Columns to leave out
+
+    Returns:
+        str: CREATE TABLE statement with the types, NOT NULL, DEFAULT, PRIMARY KEY, UNIQUE and FOREIGN KEY
+            constraints of the kept columns. UNIQUE and FOREIGN KEY constraints over a dropped column are left out
+    """
+    table_info = cursor.execute(f"PRAGMA table_info({table_name});").fetchall()
+    pk_columns = [row[1] for row in sorted(table_info, key=lambda row: row[5]) if row[5] > 0]
+    inline_pk = len(pk_columns) == 1 and [row[2].upper() for row in table_info if row[5] > 0] == ["INTEGER"]
+
+    # Column constraints
+    column_sql_defs = []
+    for _, name, sql_type, notnull, default_value, pk in table_info:
+        if name in drop_columns:
+            continue
+        column_sql_def = f"`{name}` {sql_type}".rstrip()
+        if pk and inline_pk:
+            column_sql_def += " PRIMARY KEY"  # keeps the column as the rowid alias
+        if notnull:
+            column_sql_def += " NOT NULL"
+        if default_value is not None:
+            column_sql_def += f" DEFAULT {default_value}"
+        column_sql_defs.append(column_sql_def)
+
+    # Table constraints
+    table_constraints = []
+    if pk_columns and not inline_pk:
+        table_constraints.append(f"PRIMARY KEY ({', '.join(f'`{col}`' for col in pk_columns)})")
+    for _, index_name, _, origin, _ in cursor.execute(f"PRAGMA index_list({table_name});").fetchall():
+        if origin != "u":
+            continue
+        unique_columns = [row[2] for row in cursor.execute(f"PRAGMA index_info(`{index_name}`);").fetchall()]
+        if not set(unique_columns) & set(drop_columns):
+            table_constraints.append(f"UNIQUE ({', '.join(f'`{col}`' for col in unique_columns)})")
+    foreign_keys = {}
+    for fk_id, _, ref_table, from_column, to_column, on_update, on_delete, _ in cursor.execute(
+        f"PRAGMA foreign_key_list({table_name});"
+    ).fetchall():
+        foreign_keys.setdefault(fk_id, {"table": ref_table, "from": [], "to": [], "actions": (on_update, on_delete)})
+        foreign_keys[fk_id]["from"].append(from_column)
+        foreign_keys[fk_id]["to"].append(to_column)
+    for fk_id in sorted(foreign_keys, reverse=True):  # PRAGMA foreign_key_list numbers them last to first
+        foreign_key = foreign_keys[fk_id]
+        if set(foreign_key["from"]) & set(drop_columns):
+            continue
+        fk_sql = f"FOREIGN KEY ({', '.join(foreign_key['from'])}) REFERENCES {foreign_key['table']}"
+        if None not in foreign_key["to"]:
+            fk_sql += f" ({', '.join(foreign_key['to'])})"
+        for action_name, action in zip(["ON UPDATE", "ON DELETE"], foreign_key["actions"]):
+            if action != "NO ACTION":
+                fk_sql += f" {action_name} {action}"
+        table_constraints.append(fk_sql)
+
+    return f"CREATE TABLE {new_table_name} ({', '.join(column_sql_defs + table_constraints)});"
+
+
+def drop_columns_from_table(table_name, column_names, db_file_path=DatabaseConfig.DB_PATH):
+    """
+    Remove several columns from an existing table in one operation, keeping its constraints and indexes.
+
+    Args:
+        table_name (str): Name of the table to modify
+        column_names (list[str]): Names of the columns to remove
+        db_file_path (str, optional): Path to the SQLite database.
+            Defaults to DatabaseConfig.DB_PATH
+
     Process:
-        - Connects to the database
-        - Drops the column from the table
-        - Commits and closes the connection
+        1. Checks that the columns exist and are not part of the primary key
+        2. Drops the indexes over the removed columns
+        3. Removes a single column with ALTER TABLE DROP COLUMN (SQLite >= 3.35). Several columns, or a column
+           that the native statement refuses, are removed by rebuilding the table once
+        4. Checks the foreign keys of the table before committing
+
+    Notes:
+        - ALTER TABLE DROP COLUMN rewrites the whole table for every column, so a single rebuild is
+          much faster when removing more than one column
+        - The rebuild keeps types, NOT NULL, DEFAULT, PRIMARY KEY, UNIQUE and FOREIGN KEY constraints and
+          the other indexes. CHECK constraints, triggers and views are not recreated
+        - Foreign keys are disabled during the rebuild, as recommended by SQLite, so tables referencing
+          this one are not affected
+        - Everything runs in one transaction, so the table is unchanged if any step fails
+
+    Raises:
+        ValueError: If the table or a column does not exist, or a column is part of the primary key
+        sqlite3.IntegrityError: If the rebuilt table violates its foreign keys
+    """
+    drop_columns = list(dict.fromkeys(column_names))
+    if not drop_columns:
+        return
+
+    # * PRAGMA foreign_keys cannot be changed inside the transaction
+    profile = {**ConnectionProfiles.BULK_LOAD, "foreign_keys": "OFF"}
+    with db_connection(db_file_path, profile) as conn:
+        cursor = conn.cursor()
+
+        # * Step1/4: Check the columns
+        table_info = cursor.execute(f"PRAGMA table_info({table_name});").fetchall()
+        if not table_info:
+            raise ValueError(f"Table '{table_name}' not found")
+        existing_columns = [row[1] for row in table_info]
+        missing_columns = [col for col in drop_columns if col not in existing_columns]
+        if missing_columns:
+            raise ValueError(f"Columns {missing_columns} not found in table '{table_name}'")
+        pk_columns = [row[1] for row in table_info if row[5] > 0 and row[1] in drop_columns]
+        if pk_columns:
+            raise ValueError(f"Columns {pk_columns} are part of the primary key of table '{table_name}'")
+
+        # * Step2/4: Drop the indexes over the removed columns and remember the others
+        kept_index_sqls = []
+        for index_name, index_sql in cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL;",
+            (table_name,),
+        ).fetchall():
+            index_columns = [row[2] for row in cursor.execute(f"PRAGMA index_info(`{index_name}`);").fetchall()]
+            if set(index_columns) & set(drop_columns):
+                print(f"Index {index_name} is dropped, as it covers removed columns")
+                cursor.execute(f"DROP INDEX `{index_name}`;")
+            else:
+                kept_index_sqls.append(index_sql)
+
+        # * Step3/4: Remove the columns natively or by rebuilding the table
+        dropped_natively = False
+        if len(drop_columns) == 1 and sqlite3.sqlite_version_info >= (3, 35, 0):
+            try:
+                cursor.execute(f"ALTER TABLE {table_name} DROP COLUMN `{drop_columns[0]}`;")
+                dropped_natively = True
+            except sqlite3.OperationalError as e:
+                # e.g. the column is part of a UNIQUE or FOREIGN KEY constraint
+                print(f"ALTER TABLE DROP COLUMN failed ({e}), the table is rebuilt instead")
+
+        if not dropped_natively:
+            table_name_temp = f"{table_name}_rebuild"
+            kept_columns = ", ".join(f"`{col}`" for col in existing_columns if col not in drop_columns)
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name_temp};")
+            cursor.execute(_rebuilt_table_sql(cursor, table_name, table_name_temp, drop_columns))
+            cursor.execute(f"INSERT INTO {table_name_temp} ({kept_columns}) SELECT {kept_columns} FROM {table_name};")
+            cursor.execute(f"DROP TABLE {table_name};")
+            cursor.execute(f"ALTER TABLE {table_name_temp} RENAME TO {table_name};")
+            for index_sql in kept_index_sqls:
+                cursor.execute(index_sql)
+
+        # * Step4/4: Check the foreign keys of the table
+        violations = cursor.execute(f"PRAGMA foreign_key_check({table_name});").fetchall()
+        if violations:
+            raise sqlite3.IntegrityError(f"Table '{table_name}' violates {len(violations)} foreign key constraints")
+
+    method = "ALTER TABLE DROP COLUMN" if dropped_natively else "rebuilding the table"
+    print(f"Columns {drop_columns} have been removed from table '{table_name}' by {method}")
+
+
+def _create_declared_indexes(cursor, table_name):
     """
-    conn = sqlite3.connect(db_file_path)
-    cursor = conn.cursor()
+    Create the secondary indexes declared in TableIndexes.INDEXES for a table.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        table_name (str): Name of the table
 
-    # * Step1/4: Check if the column exists
+    Returns:
+        list[str]: Names of the indexes that exist for the declared columns
+    """
     cursor.execute(f"PRAGMA table_info({table_name})")
     existing_columns = [row[1] for row in cursor.fetchall()]
-    if column_name not in existing_columns:
-        raise ValueError(f"Column '{column_name}' not found in table '{table_name}'")
-
-    # * Step2/4: Create a new table with the column dropped
-    used_columns = [col for col in existing_columns if col != column_name]
-    table_name_temp = f"{table_name}_temp"
-    cursor.execute(f"CREATE TABLE {table_name_temp} AS SELECT {', '.join(used_columns)} FROM {table_name}")
-
-    # * Step3/4: Drop the original table
-    cursor.execute(f"DROP TABLE {table_name}")
-
-    # * Step4/4: Rename the new table to the original table name
-    cursor.execute(f"ALTER TABLE {table_name_temp} RENAME TO {table_name}")
-    conn.commit()
-    conn.close()
-    print(f"Column '{column_name}' has been removed from table '{table_name}'")
+
+    index_names = []
+    for columns in TableIndexes.INDEXES.get(table_name, []):
+        missing_columns = [col for col in columns if col not in existing_columns]
+        if missing_columns:
+            print(f"Index on {table_name} ({', '.join(columns)}) is skipped, missing columns: {missing_columns}")
+            continue
+        index_name = f"idx_{table_name}_{'_'.join(columns)}"
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(f'`{col}`' for col in columns)});")
+        index_names.append(index_name)
+    return index_names
+
+
+def create_indexes(table_names=None, db_file_path=DatabaseConfig.DB_PATH, analyze=True):
+    """
+    Build the secondary indexes declared in TableIndexes.INDEXES.
+
+    Args:
+        table_names (list[str], optional): Tables to index. If None, all tables declared
+            in TableIndexes.INDEXES that exist in the database. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database.
+            Defaults to DatabaseConfig.DB_PATH
+        analyze (bool, optional): Whether to run ANALYZE afterwards, so that the query
+            planner knows the selectivity of each index. Defaults to True
+
+    Returns:
+        list[str]: Names of the indexes that exist after the call
+
+    Notes:
+        - Indexes are created with IF NOT EXISTS, so this function can be rerun after every
+          table (re)creation, e.g. after the Status table is built in the notebooks
+    """
+    with db_connection(db_file_path, ConnectionProfiles.BULK_LOAD) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        existing_tables = [row[0] for row in cursor.fetchall()]
+        if table_names is None:
+            table_names = [table for table in TableIndexes.INDEXES if table in existing_tables]
+
+        index_names = []
+        for table_name in table_names:
+            if table_name not in existing_tables:
+                raise ValueError(f"Table {table_name} does not exist.")
+            index_names.extend(_create_declared_indexes(cursor, table_name))
+
+        if analyze:
+            cursor.execute("ANALYZE;")
+
+    print(f"{len(index_names)} indexes are available: {index_names}")
+    return index_names
+
+
+# * Queries that the analysis repeatedly runs. Their plans are checked by check_workload_plans.
+_DEFAULT_EXCLUSION_CRITERIA = CohortCriteria.CRITERIA["eligible"]
+WORKLOAD_QUERIES = {
+    "eligible_cohort": f"SELECT s.eid FROM {TableNames.STATUS} s WHERE {_DEFAULT_EXCLUSION_CRITERIA};",
+    "cvd_cases": f"""
+        SELECT i.eid FROM {TableNames.ICD} i INNER JOIN {TableNames.PROCESSED} p ON i.eid = p.eid
+        WHERE p.CVD = 1;
+    """,
+    **{
+        f"export_{table_name}": f"""
+            SELECT t.* FROM {table_name} t INNER JOIN {TableNames.COHORT_PREFIX}eligible c ON t.eid = c.eid;
+        """
+        for table_name in [
+            TableNames.COVARIATES,
+            TableNames.HRV_TIME,
+            TableNames.HRV_FREQ,
+            TableNames.HRV_POINCARE,
+            TableNames.HRV_ENTROPY,
+            TableNames.HRV_FRACTAL,
+        ]
+    },
+}
+
+
+def register_workload_query(name, query):
+    """
+    Register a query whose plan should be checked by check_workload_plans.
+
+    Args:
+        name (str): Name of the query. An existing query with the same name is replaced
+        query (str): SQL query
+    """
+    WORKLOAD_QUERIES[name] = query
+
+
+def explain_query_plan(cursor, query):
+    """
+    Get the plan SQLite will use for a query.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        query (str): SQL query to explain
+
+    Returns:
+        list[str]: Detail of each step in the plan, e.g. "SEARCH s USING INDEX ..."
+    """
+    cursor.execute(f"EXPLAIN QUERY PLAN {query}")
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def check_workload_plans(query_names=None, db_file_path=DatabaseConfig.DB_PATH):
+    """
+    Run EXPLAIN QUERY PLAN on the registered workload queries and flag full table scans.
+
+    Args:
+        query_names (list[str], optional): Names of queries in WORKLOAD_QUERIES to check.
+            If None, all registered queries are checked. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database.
+            Defaults to DatabaseConfig.DB_PATH
+
+    Returns:
+        pd.DataFrame: One row per plan step with columns query, detail and full_scan
+
+    Notes:
+        - A step is a full scan if it reads every row of a table ("SCAN <table>").
+          Scans of a covering index are not flagged
+        - Queries on tables that do not exist yet are reported with the error as detail
+    """
+    if query_names is None:
+        query_names = list(WORKLOAD_QUERIES.keys())
+
+    records = []
+    with db_connection(db_file_path, ConnectionProfiles.READ_ONLY) as conn:
+        cursor = conn.cursor()
+        for query_name in query_names:
+            try:
+                details = explain_query_plan(cursor, WORKLOAD_QUERIES[query_name])
+            except sqlite3.OperationalError as e:
+                records.append({"query": query_name, "detail": f"Error: {e}", "full_scan": None})
+                continue
+            for detail in details:
+                # "SCAN TABLE t" before SQLite 3.36, "SCAN t" afterwards
+                full_scan = detail.startswith("SCAN ") and "COVERING INDEX" not in detail and "CONSTANT ROW" not in detail
+                records.append({"query": query_name, "detail": detail, "full_scan": full_scan})
+                if full_scan:
+                    print(f"Query {query_name} performs a full scan: {detail}")
+
+    return pd.DataFrame(records, columns=["query", "detail", "full_scan"])
+
+
+# * Tables joined by export_joined_data, in output column order. None means all columns except the primary key.
+EXPORT_TABLES = {
+    TableNames.STATUS: ["event", "time"],  # only these two columns are needed for survival analysis
+    TableNames.COVARIATES: None,
+    TableNames.HRV_TIME: None,
+    TableNames.HRV_FREQ: None,
+    TableNames.HRV_POINCARE: None,
+    TableNames.HRV_ENTROPY: None,
+    TableNames.HRV_FRACTAL: None,
+}
+
+
+def build_export_query(
+    cursor,
+    cohort_table,
+    tables=None,
+    imputed_table=None,
+    primary_key="eid",
+    cohort_params=None,
+):
+    """
+    Build one SQL query that joins the export tables on the primary key for a cohort.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        cohort_table (str): Table (or parenthesized subquery) with the eids of the cohort, i.e. a table
+            from cohort_utils.materialize_cohort or the eids of a split fold
+        tables (dict, optional): Mapping from table name to the list of columns to export, in output order.
+            None as the list means all columns except the primary key. Defaults to EXPORT_TABLES
+        imputed_table (str, optional): Table with imputed values. Exported columns that also exist in this table
+            are taken from it, and are NULL for subjects missing from it. Defaults to None
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        cohort_params (list, optional): Values bound to the ? placeholders of cohort_table. Defaults to None
+
+    Returns:
+        tuple[str, list[str], list]: The query, the names of its output columns and the values to bind
+            when executing it
+
+    Raises:
+        ValueError: If two tables export a column with the same name
+    """
+    if tables is None:
+        tables = EXPORT_TABLES
+
+    imputed_columns = []
+    if imputed_table is not None:
+        cursor.execute(f"PRAGMA table_info({imputed_table});")
+        imputed_columns = [row[1] for row in cursor.fetchall() if row[1] != primary_key]
+
+    select_sqls = [f"t0.{primary_key}"]
+    output_columns = [primary_key]
+    join_sqls = []
+    for i, (table_name, columns) in enumerate(tables.items()):
+        if columns is None:
+            cursor.execute(f"PRAGMA table_info({table_name});")
+            columns = [row[1] for row in cursor.fetchall() if row[1] != primary_key]
+        duplicated_columns = [col for col in columns if col in output_columns]
+        if duplicated_columns:
+            raise ValueError(f"Columns {duplicated_columns} of table {table_name} are already exported")
+        select_sqls.extend(f"imp.`{col}`" if col in imputed_columns else f"t{i}.`{col}`" for col in columns)
+        output_columns.extend(columns)
+        if i == 0:
+            join_sqls.append(f"{table_name} t0")
+        else:
+            join_sqls.append(f"INNER JOIN {table_name} t{i} ON t{i}.{primary_key} = t0.{primary_key}")
+
+    if imputed_table is not None:
+        join_sqls.append(f"LEFT JOIN {imputed_table} imp ON imp.{primary_key} = t0.{primary_key}")
+    # * The exclusion criteria were evaluated once when the cohort was materialized
+    join_sqls.append(f"INNER JOIN {cohort_table} c ON c.{primary_key} = t0.{primary_key}")
+
+    query = f"""
+        SELECT {", ".join(select_sqls)}
+        FROM {" ".join(join_sqls)}
+        ORDER BY t0.{primary_key};
+    """
+    return query, output_columns, list(cohort_params or [])
+
+
+# * File extension and default compression of every export format
+EXPORT_FORMATS = {
+    "csv": (".csv", None),
+    "parquet": (".parquet", "zstd"),
+    "feather": (".feather", "lz4"),  # lz4 decompresses fast, use compression="uncompressed" for zero-copy memory mapping
+}
+
+
+def _infer_export_schema(cursor, query, output_columns, params=()):
+    """
+    Infer the Arrow schema of an export query from the storage classes of its values.
+
+    Args:
+        cursor (sqlite3.Cursor): SQLite cursor
+        query (str): Export query, see build_export_query
+        output_columns (list[str]): Names of the output columns of the query
+        params (list, optional): Values bound to the placeholders of the query. Defaults to ()
+
+    Returns:
+        pa.Schema: int64 for integer-only columns (e.g. categories), float64 if any value is real,
+            date32 for text columns that only hold YYYY-MM-DD dates, string otherwise
+
+    Notes:
+        - SQLite types are per value, so the declared column type is not enough,
+          e.g. Status.time is declared as DATE but holds days
+        - All types are found in one aggregate pass over the query
+    """
+    date_glob = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+    aggregate_sqls = []
+    for i in range(len(output_columns)):
+        col = f"q.`{i}`"
+        aggregate_sqls.extend([
+            f"MAX(typeof({col}) = 'integer')",
+            f"MAX(typeof({col}) = 'real')",
+            f"MAX(typeof({col}) = 'text')",
+            f"MIN(CASE WHEN typeof({col}) = 'text' THEN {col} GLOB '{date_glob}' END)",
+        ])
+    # columns of the subquery are renamed by position, as different tables may use reserved names
+    column_aliases = ", ".join(f"`{i}`" for i in range(len(output_columns)))
+    cursor.execute(f"""
+        WITH q({column_aliases}) AS ({query.strip().rstrip(";")})
+        SELECT {", ".join(aggregate_sqls)} FROM q;
+    """, params)
+    flags = cursor.fetchone()
+
+    fields = []
+    for i, col in enumerate(output_columns):
+        has_integer, has_real, has_text, all_dates = flags[4 * i : 4 * i + 4]
+        if has_text:
+            arrow_type = pa.date32() if all_dates and not (has_integer or has_real) else pa.string()
+        elif has_real:
+            arrow_type = pa.float64()
+        elif has_integer:
+            arrow_type = pa.int64()
+        else:
+            arrow_type = pa.float64()  # all values are NULL
+        fields.append(pa.field(col, arrow_type))
+    return pa.schema(fields)
+
+
+def _rows_to_record_batch(rows, schema):
+    """
+    Convert rows fetched from SQLite into an Arrow record batch with the given schema.
+
+    Args:
+        rows (list[tuple]): Rows fetched from the export query
+        schema (pa.Schema): Schema from _infer_export_schema
+
+    Returns:
+        pa.RecordBatch: Typed record batch
+    """
+    arrays = []
+    for values, field in zip(zip(*rows), schema):
+        if pa.types.is_date32(field.type):
+            arrays.append(pa.array(values, pa.string()).cast(pa.date32()))
+        elif pa.types.is_string(field.type):
+            arrays.append(pa.array([str(value) if value is not None else None for value in values], pa.string()))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_joined_data(
+    output_path,
+    cohort_table,
+    tables=None,
+    imputed_table=None,
+    db_file_path=DatabaseConfig.DB_PATH,
+    primary_key="eid",
+    chunk_size=10000,
+    output_formats=("csv",),
+    compression=None,
+    csv_index=False,
+    cohort_params=None,
+):
+    """
+    Export the joined analysis dataset of a cohort to CSV, Parquet and/or Feather files, chunk by chunk.
+
+    Args:
+        output_path (str): Path to the output file. Its extension is replaced by the one of each format
+        cohort_table (str): Table with the eids of the cohort, e.g. from cohort_utils.materialize_cohort
+        tables (dict, optional): Mapping from table name to the list of columns to export.
+            Defaults to EXPORT_TABLES
+        imputed_table (str, optional): Table with imputed values that replace the exported columns
+            of the same name. Defaults to None
+        db_file_path (str, optional): Path to the SQLite database. Defaults to DatabaseConfig.DB_PATH
+        primary_key (str, optional): Name of the primary key column. Defaults to "eid"
+        chunk_size (int, optional): Number of rows fetched and written at a time. Defaults to 10000
+        output_formats (str | list[str], optional): Formats to write, any of "csv", "parquet" and "feather".
+            Defaults to ("csv",)
+        compression (str, optional): Compression of the Parquet/Feather files. If None, the default of
+            each format in EXPORT_FORMATS is used, and "uncompressed" writes uncompressed files. Defaults to None
+        csv_index (bool, optional): Whether to write a leading unnamed row number column to the CSV file,
+            as pandas does with index=True. The R models drop the first column of their CSV inputs.
+            Defaults to False
+        cohort_params (list, optional): Values bound to the ? placeholders of cohort_table. Defaults to None
+
+    Returns:
+        int: Number of exported rows
+
+    Notes:
+        - Replaces the per-table SELECTs and pandas merges of export_split_data.ipynb with a single
+          join on the primary key (the rowid of every table), so memory is bounded by chunk_size
+        - Rows are ordered by eid, and only subjects present in every table are exported (inner join)
+        - Parquet/Feather files keep integer categories as int64 and dates as date32, so R can read them
+          with arrow::read_parquet / arrow::read_feather instead of parsing text
+        - The types are inferred from the whole query before writing, so the CSV file formats a column the
+          same way in every chunk, e.g. integers are never written as 1.0
+
+    Raises:
+        ValueError: If an output format is not supported
+    """
+    if isinstance(output_formats, str):
+        output_formats = [output_formats]
+    unknown_formats = [fmt for fmt in output_formats if fmt not in EXPORT_FORMATS]
+    if unknown_formats:
+        raise ValueError(f"Unsupported output formats: {unknown_formats}, should be in {list(EXPORT_FORMATS)}")
+    output_root = os.path.splitext(output_path)[0]
+    output_paths = {fmt: output_root + EXPORT_FORMATS[fmt][0] for fmt in output_formats}
+
+    with db_connection(db_file_path) as conn:
+        cursor = conn.cursor()
+        query, output_columns, params = build_export_query(
+            cursor, cohort_table, tables, imputed_table, primary_key, cohort_params
+        )
+        # * Every format is written through the schema, so a column has the same type in all chunks
+        schema = _infer_export_schema(cursor, query, output_columns, params)
+
+        writers = {}
+        try:
+            for fmt, path in output_paths.items():
+                fmt_compression = compression if compression is not None else EXPORT_FORMATS[fmt][1]
+                if fmt_compression == "uncompressed":
+                    fmt_compression = None
+                if fmt == "csv":
+                    writers[fmt] = open(path, "w", newline="")
+                    pd.DataFrame(columns=output_columns).to_csv(writers[fmt], index=csv_index)
+                elif fmt == "parquet":
+                    writers[fmt] = pq.ParquetWriter(path, schema, compression=fmt_compression)
+                else:
+                    options = pa.ipc.IpcWriteOptions(compression=fmt_compression)
+                    writers[fmt] = pa.ipc.new_file(path, schema, options=options)
+
+            cursor.execute(query, params)
+            n_rows = 0
+            with tqdm(desc=f"Exporting to {output_root}", unit=" rows") as pbar:
+                while rows := cursor.fetchmany(chunk_size):
+                    record_batch = _rows_to_record_batch(rows, schema)
+                    for fmt, writer in writers.items():
+                        if fmt != "csv":
+                            writer.write_batch(record_batch)
+                    if "csv" in writers:
+                        # nullable Int64 keeps integers as 1 instead of 1.0 in chunks with NULLs
+                        df_chunk = record_batch.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+                        df_chunk.index = range(n_rows, n_rows + len(rows))
+                        df_chunk.to_csv(writers["csv"], index=csv_index, header=False)
+                    n_rows += len(rows)
+                    pbar.update(len(rows))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    print(f"{n_rows} rows have been exported to {', '.join(output_paths.values())}")
+    return n_rows